@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+#Benchmark of the shell emulation commands of Brw_functions.py
+
+#This script builds a synthetic Brewer tree in a temporary folder (a Prog410-like program folder with its OP_ST.FIL,
+#and a bdataNNN/NNN folder with its OP_ST.NNN and daily data files), and times the emulated commands:
+# copy, copy a+b c, append, noeof, dir, setdate, look4duplicates, md, wait and cmd.
+#Every command is timed in two ways:
+# -"process": end-to-end, as PCBASIC invokes it (a new python interpreter for every SHELL call, including its startup).
+# -"inprocess": calling Brw_functions.run_command in this same python process.
+#After every run, the result is checked against the expected COMMAND.COM-style behavior (for example, the SUB
+#characters removed from the copied files, or the appended file growing by the size of the appended one).
+#The results are saved into a JSON file, to be able to compare different versions of Brw_functions.
+
+#It also checks the startup of every command (python >= 3.7): the modules imported by Brw_functions.py are measured
+#with 'python -X importtime', and the check fails if their import time, without the module of the command that is
+#lazily loaded (like Brw_dir.py), exceeds the startup budget (--startup-budget, ms), if the module of a command is
+#imported by another command, or if subprocess is imported. The lazily loaded modules are reported apart.
+#The same check is run for every registered command by tests/test_Brw_benchmark.py.
+
+#Example of use:
+#   python Brw_benchmark.py --files=2000 --size=1000000 --collisions=5 --repeat=10 --output=bench_results.json
+
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import datetime
+import platform
+import subprocess
+
+BRWFUNCT_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brw_functions.py')
+STARTUP_BUDGET=15. #Default maximum import time (ms) of every command, see startup
+
+try:
+    from StringIO import StringIO #python 2
+except ImportError:
+    from io import StringIO #python 3
+
+
+#-----------------Synthetic Brewer tree---------------
+def build_tree(root,instr='072',nfiles=500,size=100000,ncollisions=0):
+    '''
+    env = build_tree(root,instr='072',nfiles=500,size=100000,ncollisions=0)
+
+    Build a synthetic Brewer tree in the folder <root>:
+     root/brw#NNN/Prog410: OP_ST.FIL, main.asc and <nfiles> routines (*.rtn, some of them in uppercases)
+     root/brw#NNN/bdataNNN/NNN: OP_ST.NNN and <nfiles> daily data files of <size> bytes (with some SUB chars)
+    <ncollisions> number of files created twice, with different capitalization, in each folder (like DIR.TMP and dir.tmp)
+    <env> dictionary with the environment variables that a launcher would define for this tree.
+    '''
+    prog=os.path.join(root,'brw#'+instr,'Prog410')
+    bdata=os.path.join(root,'brw#'+instr,'bdata'+instr,instr)
+    for d in [prog,bdata]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    with open(os.path.join(prog,'OP_ST.FIL'),'w') as f:
+        f.write(instr+'\n'+'C:\\brw#'+instr+'\\bdata'+instr+'\\\n')
+    with open(os.path.join(bdata,'OP_ST.'+instr),'w') as f:
+        f.write('\r\n'.join([instr,'C:\\brw#'+instr+'\\bdata'+instr+'\\']+[str(i).rjust(2) for i in range(40)])+'\r\n')
+    with open(os.path.join(prog,'main.asc'),'w') as f:
+        f.write('10 REM synthetic main.asc\r\n')
+    for i in range(nfiles):
+        name='r'+str(i).zfill(4)+'.rtn'
+        if i%10==0:
+            name=name.upper()
+        with open(os.path.join(prog,name),'wb') as f:
+            f.write(b'10 REM routine\r\n'*20+b'\x1a')
+    line=b'dsum 12:00:01  306.3  0.123  45678  12345  1.234\r\n'
+    block=(line*(1+65536//len(line)))[:65535]+b'\x1a'
+    for i in range(nfiles):
+        with open(os.path.join(bdata,'B'+str(i).zfill(5)+'.'+instr),'wb') as f:
+            n=size
+            while n>0:
+                f.write(block[:n])
+                n-=len(block)
+    for i in range(ncollisions):
+        for d in [prog,bdata]:
+            open(os.path.join(d,'COLL'+str(i)+'.TMP'),'w').close()
+            open(os.path.join(d,'coll'+str(i)+'.tmp'),'w').close()
+    return {'PROGRAM_PATH':prog,'MOUNT_C':root,'MOUNT_D':'','BDATA':bdata,'INSTR':instr}
+
+def nosub(path):
+    #Contents of the file <path> without SUB characters
+    with open(path,'rb') as f:
+        return f.read().replace(b'\x1a',b'')
+
+
+#-----------------Commands---------------
+def get_commands(env):
+    '''
+    List of (name, arguments, prepare, check) of the commands to benchmark.
+    <prepare> function called before every run, <check> function called after every run, that returns True if the
+    result matches the expected COMMAND.COM-style behavior.
+    '''
+    prog=env['PROGRAM_PATH']
+    bdata=env['BDATA']
+    instr=env['INSTR']
+    bfile='C:\\brw#'+instr+'\\bdata'+instr+'\\'+instr+'\\B00000.'+instr
+    bfile_path=os.path.join(bdata,'B00000.'+instr)
+    bfile2_path=os.path.join(bdata,'B00001.'+instr)
+    state={}
+
+    def nothing():
+        pass
+
+    def check_copy():
+        return nosub(os.path.join(prog,'copy_dest.tmp'))==nosub(bfile_path)
+
+    def check_copy_append():
+        return nosub(os.path.join(prog,'copy_dest.tmp'))==nosub(bfile_path)+nosub(bfile2_path)
+
+    def prepare_append():
+        #A small file appended to a daily file, as the brewer software does all the day
+        with open(os.path.join(prog,'append_src.tmp'),'wb') as f:
+            f.write(b'ds 12:00:01 306.3 0.123\r\n'*8+b'\x1a')
+        with open(os.path.join(prog,'append_dest.tmp'),'ab') as f:
+            pass
+        state['append_size']=len(nosub(os.path.join(prog,'append_dest.tmp')))
+
+    def check_append():
+        size=len(nosub(os.path.join(prog,'append_dest.tmp')))
+        return size==state['append_size']+len(nosub(os.path.join(prog,'append_src.tmp')))
+
+    def check_noeof():
+        return nosub(os.path.join(prog,'tmp.tmp'))==nosub(bfile_path)
+
+    def check_dir():
+        with open(os.path.join(prog,'dir.tmp'),'r') as f:
+            listed=[i.strip() for i in f.readlines()]
+        expected=sorted([os.path.join(prog,i).lower() for i in os.listdir(prog) if i.lower().endswith('.rtn')])
+        return listed==expected
+
+    def check_setdate():
+        with open(os.path.join(bdata,'OP_ST.'+instr),'r') as f:
+            cs=f.read().split('\n')
+        dt=datetime.datetime.now()
+        return cs[6].strip()==str(dt.day).zfill(2) and cs[7].strip()==str(dt.month).zfill(2)
+
+    def check_nothing():
+        return True
+
+    def prepare_md():
+        shutil.rmtree(os.path.join(prog,'md_dest'),ignore_errors=True)
+
+    def check_md():
+        return os.path.isdir(os.path.join(prog,'md_dest'))
+
+    shutil.copy(bfile2_path,os.path.join(prog,'append_dest.tmp'))
+    return [('copy',['copy',bfile,'copy_dest.tmp'],nothing,check_copy),
+            ('copy_append',['copy',bfile+'+'+bfile.replace('B00000','B00001'),'copy_dest.tmp'],nothing,check_copy_append),
+            ('append',['append','append_src.tmp','append_dest.tmp'],prepare_append,check_append),
+            ('noeof',['noeof',bfile],nothing,check_noeof),
+            ('dir',['dir','*.rtn','/l','/o:n','/b','>dir.tmp'],nothing,check_dir),
+            ('setdate',['setdate'],nothing,check_setdate),
+            ('look4duplicates',['look4duplicates','/s'],nothing,check_nothing),
+            ('md',['md','C:\\brw#'+instr+'\\Prog410\\md_dest'],prepare_md,check_md),
+            ('wait',['wait',bfile],nothing,check_nothing),
+            ('cmd',['cmd'],nothing,check_nothing)]
+
+
+#-----------------Timing---------------
+def run_process(python,args,env):
+    #Run the command as PCBASIC does: a new python interpreter for the SHELL call.
+    penv=dict(os.environ)
+    penv.update(dict((k,env[k]) for k in ['PROGRAM_PATH','MOUNT_C','MOUNT_D']))
+    penv.pop('BREWFUNCT_LOG_DIR',None)
+    penv.pop('BREWFUNCT_SOCKET',None)
+    t0=time.time()
+    with open(os.devnull,'w') as devnull:
+        subprocess.call([python,BRWFUNCT_PATH]+args,cwd=env['PROGRAM_PATH'],env=penv,stdout=devnull)
+    return time.time()-t0
+
+def run_inprocess(args,env):
+    #Run the command in this same python process.
+    import Brw_functions
+    ini_env=dict(os.environ)
+    ini_cwd=os.getcwd()
+    ini_stdout=sys.stdout
+    try:
+        os.environ.update(dict((k,env[k]) for k in ['PROGRAM_PATH','MOUNT_C','MOUNT_D']))
+        os.environ.pop('BREWFUNCT_LOG_DIR',None)
+        os.chdir(env['PROGRAM_PATH'])
+        sys.stdout=StringIO()
+        t0=time.time()
+        Brw_functions.run_command(args)
+        return time.time()-t0
+    finally:
+        sys.stdout=ini_stdout
+        os.chdir(ini_cwd)
+        os.environ.clear()
+        os.environ.update(ini_env)
+
+def importtime(python,args,env):
+    '''
+    total, modules = importtime(python,args,env)
+
+    Import time of the modules imported by 'python Brw_functions.py <args>', measured with 'python -X importtime',
+    without counting the modules that the python interpreter imports by itself (measured with 'python -c pass').
+    <total> seconds. <modules> dictionary {module name: cumulative import time in seconds} of the top level imports,
+    in the order they were imported (python >= 3.7 keeps the order of the dictionaries).
+    '''
+    penv=dict(os.environ)
+    penv.update(dict((k,env[k]) for k in ['PROGRAM_PATH','MOUNT_C','MOUNT_D']))
+    penv.pop('BREWFUNCT_SOCKET',None)
+    def run(cmd):
+        p=subprocess.Popen([python,'-X','importtime']+cmd,cwd=env['PROGRAM_PATH'],env=penv,
+                           stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+        err=p.communicate()[1]
+        modules={}
+        for line in err.splitlines():
+            if line.startswith('import time:') and not line.endswith('imported package'):
+                selftime,cumulative,name=line[12:].split('|')
+                if not name.startswith('  '): #Top level import
+                    modules[name.strip()]=int(cumulative)/1e6
+        return modules
+    baseline=run(['-c','pass'])
+    modules=dict((k,v) for k,v in run([BRWFUNCT_PATH]+args).items() if k not in baseline)
+    return sum(modules.values()),modules
+
+def check_startup(args,env,budget,python=sys.executable):
+    '''
+    result = check_startup(args,env,budget,python=sys.executable)
+
+    Check the startup of the command <args>: the import time of its modules, without the module of the command that
+    is lazily loaded (see Brw_functions.COMMANDS) and the modules imported after it, while the command runs, must be
+    lower than <budget> seconds. The modules of the other commands cannot be imported, and subprocess is never imported.
+    <result> dictionary {'import_time','modules','lazy','lazy_time','ok'}: <modules> and <lazy> are dictionaries
+    {module name: import time in seconds} of the imported modules, and of the lazily loaded ones.
+    '''
+    sys.path.insert(0,os.path.dirname(BRWFUNCT_PATH))
+    import Brw_functions
+    cmdmodules=set([Brw_functions.COMMANDS[i][0] for i in Brw_functions.COMMANDS])-set(['Brw_functions'])
+    total,modules=importtime(python,args,env)
+    allowed=set([Brw_functions.COMMANDS[args[0]][0]])-set(['Brw_functions'])
+    names=list(modules)
+    first=min([names.index(i) for i in allowed if i in modules]+[len(names)])
+    lazy=dict((k,modules[k]) for k in names[first:])
+    eager=total-sum(lazy.values())
+    ok=eager<=budget and 'subprocess' not in modules and len([i for i in modules if i in cmdmodules-allowed])==0
+    return {'import_time':eager,'modules':modules,'lazy':lazy,'lazy_time':sum(lazy.values()),'ok':ok}
+
+def startup(env,budget,python=sys.executable):
+    '''
+    results = startup(env,budget,python=sys.executable)
+
+    Check the startup of every command (see check_startup).
+    <results> dictionary {command name: {'import_time','modules','lazy','lazy_time','ok'}}
+    '''
+    results={}
+    for name,args,prepare,check in get_commands(env):
+        prepare()
+        result=check_startup(args,env,budget,python=python)
+        results[name]=result
+        lazy=''.join([", lazy "+i+" "+('%.2f' % (1000*result['lazy'][i]))+" ms" for i in result['lazy']])
+        sys.stdout.write(name.ljust(16)+'startup'.ljust(10)+" imports "+('%.2f' % (1000*result['import_time'])).rjust(8)+" ms"+lazy+("" if result['ok'] else "  !!! over the startup budget, or unexpected imports: "+', '.join(sorted(result['modules'])))+"\n")
+    return results
+
+def stats(times):
+    times=sorted(times)
+    return {'n':len(times),
+            'min':times[0],
+            'median':times[len(times)//2],
+            'mean':sum(times)/len(times),
+            'max':times[-1]}
+
+def benchmark(env,repeat=5,python=sys.executable,modes=('process','inprocess')):
+    '''
+    results = benchmark(env,repeat=5,python=sys.executable,modes=('process','inprocess'))
+
+    Time every command <repeat> times in each one of the <modes>.
+    <results> dictionary {command name: {mode: {'n','min','median','mean','max','ok'}}}, times in seconds.
+    '''
+    sys.path.insert(0,os.path.dirname(BRWFUNCT_PATH))
+    results={}
+    for name,args,prepare,check in get_commands(env):
+        results[name]={}
+        for mode in modes:
+            times=[]
+            ok=True
+            for i in range(repeat):
+                prepare()
+                if mode=='process':
+                    times.append(run_process(python,args,env))
+                else:
+                    times.append(run_inprocess(args,env))
+                ok=ok and check()
+            results[name][mode]=stats(times)
+            results[name][mode]['ok']=ok
+            sys.stdout.write(name.ljust(16)+mode.ljust(10)+" median "+('%.2f' % (1000*results[name][mode]['median'])).rjust(9)+" ms"+("" if ok else "  !!! result differs from the expected behavior")+"\n")
+    return results
+
+
+#-----------------Main---------------
+def main(ini_arguments):
+    parser=argparse.ArgumentParser(description="Benchmark of the shell emulation commands of Brw_functions.py")
+    parser.add_argument('--files',type=int,default=500,help="number of routines and of daily data files")
+    parser.add_argument('--size',type=int,default=100000,help="size in bytes of the daily data files")
+    parser.add_argument('--collisions',type=int,default=0,help="number of case-collisions (like DIR.TMP/dir.tmp) in each folder")
+    parser.add_argument('--repeat',type=int,default=5,help="number of runs of every command")
+    parser.add_argument('--python',default=sys.executable,help="python executable used for the 'process' mode")
+    parser.add_argument('--modes',default='process,inprocess',help="comma separated list of modes: process, inprocess")
+    parser.add_argument('--startup-budget',type=float,default=STARTUP_BUDGET,help="maximum import time (ms) of Brw_functions.py and its modules for every command, without the lazily loaded module of the command")
+    parser.add_argument('--output',default='',help="JSON file where to save the results")
+    parser.add_argument('--keep',action='store_true',help="do not delete the synthetic tree at the end")
+    args=parser.parse_args(ini_arguments)
+
+    root=tempfile.mkdtemp(prefix='Brw_benchmark_')
+    try:
+        env=build_tree(root,nfiles=args.files,size=args.size,ncollisions=args.collisions)
+        results=benchmark(env,repeat=args.repeat,python=args.python,modes=args.modes.split(','))
+        if subprocess.call([args.python,'-X','importtime','-c','pass'],stderr=open(os.devnull,'w'))==0: #python >= 3.7
+            for name,result in startup(env,args.startup_budget/1000.,python=args.python).items():
+                results[name]['startup']=result
+    finally:
+        if args.keep:
+            sys.stdout.write("Synthetic tree kept at "+root+"\n")
+        else:
+            shutil.rmtree(root,ignore_errors=True)
+
+    if args.output!='':
+        with open(args.output,'w') as f:
+            json.dump({'date':datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),
+                       'python':args.python,
+                       'python_version':platform.python_version(),
+                       'platform':platform.platform(),
+                       'parameters':{'files':args.files,'size':args.size,'collisions':args.collisions,'repeat':args.repeat,
+                                     'startup_budget':args.startup_budget},
+                       'results':results},f,indent=1)
+        sys.stdout.write("Results saved at "+args.output+"\n")
+    return 0 if all([results[i][m]['ok'] for i in results for m in results[i]]) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+#dir command of Brw_functions.py: emulation of the DOS dir command, with its output redirected into a file.
+#Example of use: python Brw_functions.py dir *.rtn /l /o:n /b >dir.tmp
+
+#This module is only imported by Brw_functions.py when the dir command is dispatched (see COMMANDS).
+
+import os
+import re
+import time
+import fnmatch
+from Brw_functions import add2log, checkpathformat, replacedrive, exists2, scandir2, AtomicFile, getcontext, getenv, abspath2, getcache, RACY_TIME
+
+
+def shell_dir(arguments):
+    # Example1: ['dir','*.rtn', '/l', '/o:n', '/b', '>dir.tmp'] current path, with wildcard filter
+    # Example2: ['dir','C:\brw#072\bdata\', '/l', '/o:n', '/b', '>dir.tmp'] full path case
+    # Example3: ['dir','>dir.tmp'] current path
+    #Supported switches:
+    # /b bare list of directories and files, with no additional information (always done, 1 column, full paths)
+    # /l lowercase output
+    # /s list also the files of the subdirectories (recursive)
+    # /a list also the hidden files. /a:d only directories, /a:-d only files.
+    # /o:n, /o:-n sort by name. /o:d, /o:-d sort by date. /o:s, /o:-s sort by size. ('-' means reversed)
+    #The output file is not rewritten if its contents would not change (see getfingerprint).
+    if getenv('PROGRAM_PATH') is not None:
+        PROGRAM_PATH=checkpathformat(getenv('PROGRAM_PATH')) #Check path format
+        path=abspath2(PROGRAM_PATH)
+        switches=[]
+        tmpfile=''
+        dir_understood=True
+        pathgiven=False
+        for ix in range(1,len(arguments)):
+            i=arguments[ix]
+            if '>' in i: #Save into file >
+                if len(i)>1:
+                    #case [...,">dir.tmp"]
+                    tmpfile=replacedrive(i[1:])
+                elif ix+1<len(arguments):
+                    #case [..., ">", "dir.tmp"]
+                    tmpfile=replacedrive(arguments[ix+1])
+                else:
+                    dir_understood=False
+                    break
+                head,tail=os.path.split(tmpfile)
+                if head=="":
+                    tmpfile = os.path.join(PROGRAM_PATH, tmpfile) #if no head given, add current path
+                break
+            elif i.startswith('/'):
+                switches.append(i.lower())
+            elif i!='' and not pathgiven:
+                pathgiven=True
+                i=replacedrive(i)
+                head,tail=os.path.split(i) #analyze arguments[1]
+                #Examples:
+                # Case of full path: 'C:/brw#072/bdata/*.rtn' -> head="C:/brw#072/bdata/", tail="*.rtn"
+                # Case of no head: '*.rtn' -> head="", tail="*.rtn"
+                if head=="": #if no head
+                    path=os.path.join(path,i) #add the current path as head
+                else:
+                    path=i
+        add2log("Brw_functions.py, shell_dir, emulating dir " + ' '.join([path]+switches) + (" >"+tmpfile if tmpfile!='' else '') + ".")
+
+        if not dir_understood:
+            add2log("Brw_functions.py, shell_dir, cannot understand the DIR command",level="WARNING")
+        elif tmpfile!='':
+            #Split the path in the directory to list and the wildcard pattern. The same entries as the glob module
+            #(used before) are listed: a path without wildcards lists only itself, and a path ending with '/' lists the
+            #directory itself, not its contents. (But the names are matched case insensitively, see compile_wildcard)
+            dirpath,pattern=os.path.split(path)
+            if not os.path.isdir(dirpath):
+                #Check if the directory exist with a different capitalization
+                [exist], [realfilepath], [realfilename] = exists2([dirpath.rstrip('/')],warn=False)
+                if exist:
+                    dirpath=realfilepath
+
+            #Sorting keys, in the order they were given.
+            sortkeys=[]
+            for i in switches:
+                if i in ['/o:n','/o:-n']:
+                    sortkeys.append((0,i=='/o:-n'))
+                elif i in ['/o:d','/o:-d']:
+                    sortkeys.append((1,i=='/o:-d'))
+                elif i in ['/o:s','/o:-s']:
+                    sortkeys.append((2,i=='/o:-s'))
+
+            [exist], [realfilepath], [realfilename] = exists2([tmpfile],warn=False)
+            if exist: #if dir.tmp already exist with a different capitalization, ie DIR.TMP instead of dir.tmp
+                tmpfile=realfilepath
+
+            #If the listed directories and the output file have not changed since the last time, nothing is done.
+            #(Not for the outputs sorted by date or size, which can change without changing the directories)
+            cache=getcache()
+            cacheable=len([i for i in sortkeys if i[0]!=0])==0
+            options=[dirpath,pattern]+switches
+            fingerprint=cache['dirlistings'].pop(tmpfile,None) if not cacheable else cache['dirlistings'].get(tmpfile)
+            if fingerprint is not None and (not cacheable or fingerprint['options']!=options):
+                fingerprint=None
+            if fingerprint is not None and not dirschanged(fingerprint) and getfingerprint(tmpfile)==fingerprint['output']:
+                add2log("Brw_functions.py, shell_dir, DIR output unchanged, "+tmpfile+" not rewritten.")
+                return
+
+            lowercase='/l' in switches
+            scantime=time.time()
+            dirs=[]
+            hidden=len([i for i in switches if i.startswith('/a')])>0
+            names=None
+            if pattern=='': #The directory itself
+                dirs.append([dirpath,getfingerprint(dirpath)])
+                dir_output=[(path,None)] if os.path.isdir(dirpath) else []
+                sortkeys=[]
+            else:
+                if cache['watcher'] is not None and cacheable and len([i for i in switches if i=='/s' or i.startswith('/a:')])==0:
+                    names=cache['watcher'].listdir(os.path.realpath(dirpath)) #From the live index (see startwatcher)
+                if names is not None:
+                    dirs.append([dirpath,getfingerprint(dirpath)])
+                    match=compile_wildcard(pattern)
+                    prefix=os.path.join(dirpath,'')
+                    dir_output=[(prefix+name,None) for name in names if (hidden or name[:1]!='.') and match(name)]
+                else:
+                    if not os.path.isdir(dirpath):
+                        add2log("Brw_functions.py, shell_dir, directory "+dirpath+" not found, the DIR output is empty.",level="WARNING")
+                    dir_output=iterdir(dirpath,compile_wildcard(pattern),recursive='/s' in switches,hidden=hidden,
+                                       onlydirs='/a:d' in switches,onlyfiles='/a:-d' in switches,dirs=dirs)
+            if len(sortkeys)==0:
+                #The output, as it is listed
+                dir_output=((l.lower() if lowercase else l)+'\n' for l,entry in dir_output)
+            elif len([i for i in sortkeys if i[0]!=0])==0:
+                #Only sorted by name, the entries are not needed
+                dir_output=[(l.lower() if lowercase else l) for l,entry in dir_output]
+                for key,reverse in sortkeys:
+                    dir_output.sort(reverse=reverse) #Sort the output alphabetically
+                dir_output=[l+'\n' for l in dir_output]
+            else:
+                dir_output=[(l.lower() if lowercase else l,entry) for l,entry in dir_output]
+                for key,reverse in sortkeys:
+                    if key==0:
+                        dir_output.sort(key=lambda x: x[0],reverse=reverse) #Sort the output alphabetically
+                    elif key==1:
+                        dir_output.sort(key=lambda x: x[1].stat().st_mtime,reverse=reverse) #Sort the output by date
+                    else:
+                        dir_output.sort(key=lambda x: x[1].stat().st_size,reverse=reverse) #Sort the output by size
+                dir_output=[l+'\n' for l,entry in dir_output]
+
+            if fingerprint is None:
+                #Nothing to compare with: the lines are written into the output file as they are listed (or sorted)
+                with AtomicFile(tmpfile,'w') as af:
+                    digest=writeoutput(af.file,dir_output)
+                getcontext().metrics['bytes_written']+=digest[0]
+                add2log("Brw_functions.py, shell_dir, DIR output saved at " + tmpfile + ".")
+            else:
+                #The output is kept in memory, to only rewrite the output file if it has changed
+                dir_output=''.join(dir_output)
+                digest=hashoutput(dir_output)
+                if fingerprint['digest']==digest and getfingerprint(tmpfile)==fingerprint['output']:
+                    #The directories have changed, but not the output
+                    add2log("Brw_functions.py, shell_dir, DIR output unchanged, "+tmpfile+" not rewritten.")
+                else:
+                    with AtomicFile(tmpfile,'w') as af:
+                        af.file.write(dir_output)
+                    getcontext().metrics['bytes_written']+=digest[0]
+                    add2log("Brw_functions.py, shell_dir, DIR output saved at " + tmpfile + ".")
+            if cacheable:
+                cache['dirlistings'][tmpfile]={'options':options,'dirs':dirs,'scantime':scantime,'digest':digest,
+                                               'output':getfingerprint(tmpfile)}
+                cache['changed']=True
+    else:
+        add2log("Brw_functions.py, shell_dir, cannot emulate DIR since PROGRAM_PATH is not found as enviroment variable. ",level="WARNING")
+
+def compile_wildcard(pattern):
+    '''
+    match = compile_wildcard(pattern)
+
+    Build a function to check if a filename matches the wildcard <pattern> (case insensitive, as in DOS).
+    <match> function match(filename), that returns True if the filename matches the pattern.
+    Apart from the case, the names are matched as with the glob module: '*.*' only matches the filenames with a dot.
+    '''
+    pattern=pattern.replace('[','[[]') #'[' is not a special character in DOS
+    return re.compile(fnmatch.translate(pattern),re.IGNORECASE).match
+
+def iterdir(dirpath,match,recursive=False,hidden=False,onlydirs=False,onlyfiles=False,dirs=None):
+    '''
+    Generator of the (filepath, entry) of the files and directories of <dirpath> whose name passes the <match> function,
+    in a single scan of the directory. The entry (os.DirEntry) caches the result of its stat() calls.
+    <recursive> if True, also the files of the subdirectories are listed.
+    <hidden> if True, also the hidden files (starting with '.') are listed.
+    <onlydirs>, <onlyfiles> if True, only the directories, or only the files are listed.
+    <dirs> if given, list where the [path, fingerprint] of every scanned directory is appended (see getfingerprint),
+     taken before scanning it.
+    '''
+    prefix=os.path.join(dirpath,'')
+    if dirs is not None:
+        dirs.append([dirpath,getfingerprint(dirpath)])
+    checkdir=recursive or onlydirs or onlyfiles
+    subdirs=[]
+    try:
+        entries=scandir2(dirpath)
+    except OSError: #The directory does not exist, or it cannot be read: nothing is listed
+        return
+    for entry in entries:
+        name=entry.name
+        if not hidden and name[:1]=='.':
+            continue
+        if checkdir:
+            isdir=entry.is_dir()
+            if isdir and recursive:
+                subdirs.append(prefix+name)
+            if (onlydirs and not isdir) or (onlyfiles and isdir):
+                continue
+        if match(name):
+            yield prefix+name,entry
+    for subdir in subdirs:
+        for i in iterdir(subdir,match,recursive,hidden,onlydirs,onlyfiles,dirs):
+            yield i
+
+def getfingerprint(path):
+    #[modification time, inode, size] of the file or directory <path>, or None if it does not exist.
+    try:
+        st=os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime,st.st_ino,st.st_size]
+
+def dirschanged(fingerprint):
+    '''
+    True if any of the directories listed in a dir output <fingerprint> has changed since it was taken, or if it was
+    modified less than RACY_TIME seconds before the listing (a file created in the same second would not change the
+    directory modification time in some filesystems, see getdirindex).
+    '''
+    for path,dirfingerprint in fingerprint['dirs']:
+        if dirfingerprint is None or getfingerprint(path)!=dirfingerprint or fingerprint['scantime']-dirfingerprint[0]<=RACY_TIME:
+            return True
+    return False
+
+def writeoutput(f,lines):
+    #Write the <lines> of a dir output into the file <f>, and return their checksum, as hashoutput.
+    import zlib
+    size=0
+    crc=0
+    for l in lines:
+        f.write(l)
+        if not isinstance(l,bytes):
+            l=l.encode('utf-8','surrogateescape')
+        size+=len(l)
+        crc=zlib.crc32(l,crc)
+    return [size,crc & 0xffffffff]
+
+def hashoutput(dir_output):
+    #Checksum of the contents of a dir output (zlib is much faster to import than hashlib)
+    import zlib
+    if not isinstance(dir_output,bytes):
+        dir_output=dir_output.encode('utf-8','surrogateescape')
+    return [len(dir_output),zlib.crc32(dir_output) & 0xffffffff]
@@ -20,19 +20,20 @@
 # function to perform the request.
 
 
+#Only the modules needed by every SHELL call are imported here, to keep the startup of this script as fast as possible.
+#The modules needed by only some commands are imported when those commands are dispatched (see COMMANDS).
 import sys
 import os
-import datetime
 import time
-import subprocess
-import glob
-import platform
-from copy import deepcopy
-
+import atexit
 try:
-    python_version=platform.python_version_tuple()
-except:
-    raise("No python detected")
+    from _thread import get_ident #python 3
+except ImportError:
+    from thread import get_ident #python 2
+
+if __name__ == '__main__':
+    #The command modules import this script as Brw_functions: make them use this same module, instead of a second copy.
+    sys.modules['Brw_functions']=sys.modules[__name__]
 
 if os.name == 'nt': #if Windows:
     newline='\r\n'
@@ -40,50 +41,430 @@ else:
     newline='\n'
 
 
-ini_arguments=sys.argv[1:] #Get the shell call arguments. Example ['/C', 'copy re-sb.rtn re.rtn']
-arguments=[]
-if len(ini_arguments)>0:
-    for i in ini_arguments:
-        if i=="/C":
-            pass #ignore the /C command (it is to close the cmd console)
-        else:
-            arguments=arguments+i.split(" ") #Example ['copy', 're-sb.rtn', 're.rtn']
-else:
-    arguments=['']
-
-command = ' '.join(arguments) #Build a command line string
-command = str(command.replace('\r', '\\r').replace('\n', '\\n'))
+#Daemon mode:
+#Starting a new python interpreter for every SHELL call is most of the time needed to emulate a copy or a dir.
+#To avoid it, Brw_functions can be started once as a long-lived daemon, listening on a Unix socket (Linux)
+#or on a named pipe (Windows), given by the BREWFUNCT_SOCKET environment variable:
+#   python Brw_functions.py --daemon
+#and then the PCBASIC launcher option --shell can point to the thin client shim instead of to this file:
+#   --shell="python C:\...\Brw_functions_client.py"
+#The client forwards the arguments, the environment variables and the current directory of each SHELL call to the
+#daemon, and writes back its output. If the daemon is not running, the client executes the command by itself.
+
+#Batch mode:
+#Several commands can be executed in the same python process, by giving them one per line, from a file or from stdin:
+#   python Brw_functions.py --batch commands.txt
+#   printf "setdate\nlook4duplicates\n" | python Brw_functions.py --batch
+
+#Metrics:
+#If BREWFUNCT_METRICS_DIR is defined as an environment variable, the wall time, bytes read and written, files touched
+#and number of directory scans of every command are appended into BREWFUNCT_METRICS_DIR/Brw_functions_metrics.csv,
+#and accumulated into the Prometheus textfile BREWFUNCT_METRICS_DIR/Brw_functions.prom (or BREWFUNCT_METRICS_PROM),
+#that can be exported with the textfile collector of node_exporter.
+
+
+
+#-----------------Context---------------
+#Everything that a SHELL call depends on (environment variables, current directory, stdout) and the state kept between
+#SHELL calls (log file, directories index) is taken from the context of the current thread.
+#When Brw_functions runs as a script, there is only the default context (the process environment, current directory
+#and stdout). The daemon runs every request in its own context, so the requests of different instruments
+#(see Multi-instrument mode) can be executed at the same time, by different threads.
+class Context(object):
+    '''
+    Context where the commands are executed.
+    <env> dictionary with the environment variables (None: os.environ)
+    <cwd> current working directory (None: os.getcwd())
+    <stdout> file object where the output of the command is written (None: sys.stdout)
+    <logstate> state of the Brw_functions log file, kept between commands (see flushlog)
+    <cache> directories index, kept between commands (see getdirindex)
+    '''
+    def __init__(self,env=None,cwd=None,stdout=None,logstate=None,cache=None):
+        self.env=env
+        self.cwd=cwd
+        self.stdout=stdout
+        self.logstate=newlogstate() if logstate is None else logstate
+        self.cache=newcache() if cache is None else cache
+        self.metrics={'command':'','t0':0.,'bytes_read':0,'bytes_written':0,'files':set(),'dirscans':0}
+        self.waited=None #(number of queued commands, seconds) waited before the command, in async mode (see wait_pending)
+
+def newlogstate():
+    #Brw_functions log file: the lines are kept in memory, and written at once into the log file of the day by flushlog()
+    return {'envdir':None,'logdir':'','envmaxsize':None,'maxsize':0,'day':'','path':'','fd':None,'lines':[]}
+
+def newcache():
+    #Index of the directories contents, for the case insensitive searches of exists2, and fingerprints of the outputs
+    #of the dir command (see Brw_dir.py):
+    #{'dirindex': {path: [mtime, scantime, {lowercase filename: real filename}]},
+    # 'dirlistings': {output filepath: fingerprint}, 'loaded': bool, 'changed': bool,
+    # 'watcher': live index of the directories (see startwatcher), or None}
+    return {'dirindex':{},'dirlistings':{},'loaded':False,'changed':False,'watcher':None}
+
+contexts={} #{thread identifier: Context}
+defaultcontext=Context()
+
+def getcontext():
+    #Context of the current thread
+    return contexts.get(get_ident(),defaultcontext)
+
+def getenv(key,default=None):
+    #Value of the environment variable <key> in the current context
+    env=getcontext().env
+    return (os.environ if env is None else env).get(key,default)
+
+def getcwd():
+    #Current working directory of the current context
+    return getcontext().cwd or os.getcwd()
+
+def getstdout():
+    #stdout of the current context
+    return getcontext().stdout or sys.stdout
+
+def abspath2(path):
+    #os.path.abspath(path), but relative to the current directory of the current context
+    return os.path.normpath(os.path.join(getcwd(),path))
+
+def incontext(function):
+    '''
+    wrapper = incontext(function)
 
-#print "initial arguments:" +str(ini_arguments)
-#print "final arguments:" +str(arguments)
-#print "final cmd command:"+str(command)
+    Return a <wrapper> of <function> that runs it in the context of the calling thread, for example to use the
+    current context from the threads of a pool: pool.map(incontext(function),items)
+    '''
+    context=getcontext()
+    def wrapper(*args,**kwargs):
+        ident=get_ident()
+        previous=contexts.get(ident)
+        contexts[ident]=context
+        try:
+            return function(*args,**kwargs)
+        finally:
+            if previous is None:
+                del contexts[ident]
+            else:
+                contexts[ident]=previous
+    return wrapper
 
 
 
 #-----------------Misc functions---------------
+
 def add2log(s,level="INFO"):
     '''
     Add entry to the sys.stdout (to have a logging line written in the pcbasic session log file)
     Optionally, if write2log is True, and 'BREWFUNCT_LOG_DIR' is defined as an environment variable in
     the pcbasic launcher, it will also write the same line into the Brw_functions log file.
+    The lines for the Brw_functions log file are buffered, and written by flushlog() once per SHELL call.
     '''
     #Write to stdout
     s=s.replace("[","(").replace("]",")")
-    sys.stdout.write("["+level+"] ["+s+"]"+newline)
+    getstdout().write("["+level+"] ["+s+"]"+newline)
     #Optionally, write to a Brw_functions log file:
-    if 'BREWFUNCT_LOG_DIR' in os.environ:
-        BREWFUNCT_LOG_DIR=checkpathformat(os.environ['BREWFUNCT_LOG_DIR'])
-        if BREWFUNCT_LOG_DIR!="": #if a path was given
-            if os.path.exists(BREWFUNCT_LOG_DIR): #if the path exist
-                dt=datetime.datetime.now()
-                fname="Brw_functions_log_"+dt.strftime("%Y%m%d")+".txt"
-                try:
-                    with open(os.path.join(BREWFUNCT_LOG_DIR,fname),'a') as lf:
-                        lf.write("["+dt.strftime("%Y%m%dT%H%M%S.%fZ")[:-4]+"] ["+level+"] ["+s+"]"+newline)
-                except Exception as e:
-                    sys.stdout.write("[ERROR] [Cannot write into Brw_functions log file, exception happened: "+str(e)+".]"+newline)
-            else:
-                sys.stdout.write("[ERROR] [Cannot write into Brw_functions log file, BREWFUNCT_LOG_DIR does not exist: "+str(BREWFUNCT_LOG_DIR)+".]"+newline)
+    if getlogdir()!="":
+        import datetime
+        dt=datetime.datetime.now()
+        getcontext().logstate['lines'].append((dt.strftime("%Y%m%d"),"["+dt.strftime("%Y%m%dT%H%M%S.%fZ")[:-4]+"] ["+level+"] ["+s+"]"+newline))
+
+def getlogdir():
+    #Get the Brw_functions log directory from the BREWFUNCT_LOG_DIR environment variable ('' if not defined).
+    #It is only checked again if the environment variable changes.
+    logstate=getcontext().logstate
+    envdir=getenv('BREWFUNCT_LOG_DIR')
+    if envdir!=logstate['envdir']:
+        logstate['envdir']=envdir
+        logstate['logdir']=''
+        if envdir is not None:
+            BREWFUNCT_LOG_DIR=checkpathformat(envdir)
+            if BREWFUNCT_LOG_DIR!="": #if a path was given
+                if os.path.exists(BREWFUNCT_LOG_DIR): #if the path exist
+                    logstate['logdir']=BREWFUNCT_LOG_DIR
+                else:
+                    getstdout().write("[ERROR] [Cannot write into Brw_functions log file, BREWFUNCT_LOG_DIR does not exist: "+str(BREWFUNCT_LOG_DIR)+".]"+newline)
+    return logstate['logdir']
+
+def getlogmaxsize():
+    #Get the maximum size of the log file of the day from the BREWFUNCT_LOG_MAXSIZE environment variable (bytes, 0 if
+    #not defined or not valid). It is only checked again if the environment variable changes.
+    logstate=getcontext().logstate
+    envmaxsize=getenv('BREWFUNCT_LOG_MAXSIZE')
+    if envmaxsize!=logstate['envmaxsize']:
+        logstate['envmaxsize']=envmaxsize
+        logstate['maxsize']=0
+        if envmaxsize is not None and envmaxsize.strip()!='':
+            try:
+                logstate['maxsize']=max(0,int(envmaxsize))
+            except ValueError:
+                add2log("Brw_functions.py, BREWFUNCT_LOG_MAXSIZE is not a number of bytes: "+envmaxsize+", the log file is not rotated.",level="WARNING")
+    return logstate['maxsize']
+
+def flushlog():
+    '''
+    Write the buffered lines into the Brw_functions log file of the day (Brw_functions_log_YYYYMMDD.txt).
+    The log file is kept open, and all the lines are written with a single write in append mode (O_APPEND),
+    so the lines of different SHELL calls running at the same time are never mixed.
+    If BREWFUNCT_LOG_MAXSIZE (bytes) is defined as an environment variable, the log file of the day is rotated
+    when it reaches that size. The rotated log files and the log files of the previous days are compressed with gzip.
+    '''
+    logstate=getcontext().logstate
+    maxsize=getlogmaxsize()
+    lines=logstate['lines']
+    logstate['lines']=[]
+    while len(lines)>0:
+        day=lines[0][0]
+        data=''.join([l for d,l in lines if d==day])
+        lines=[(d,l) for d,l in lines if d!=day]
+        if not isinstance(data,bytes): #python 3
+            data=data.encode('utf-8','replace')
+        try:
+            fd=openlog(day)
+            if maxsize>0:
+                size=os.fstat(fd).st_size
+                if size>0 and size+len(data)>maxsize:
+                    rotatelog()
+                    fd=openlog(day)
+            os.write(fd,data)
+        except Exception as e:
+            getstdout().write("[ERROR] [Cannot write into Brw_functions log file, exception happened: "+str(e)+".]"+newline)
+
+LOG_LOCK_TIMEOUT=600. #Seconds after which the lock file of a log file being compressed is considered stale (see compresslog)
+
+def openlog(day):
+    #Return the file descriptor of the Brw_functions log file of <day> ('YYYYMMDD'), opening it if needed.
+    logstate=getcontext().logstate
+    path=os.path.join(logstate['logdir'],"Brw_functions_log_"+day+".txt")
+    if logstate['fd'] is not None:
+        try:
+            #Re-use the open file, if it was not rotated meanwhile by another process.
+            if path==logstate['path'] and os.stat(path).st_ino==os.fstat(logstate['fd']).st_ino:
+                return logstate['fd']
+        except OSError:
+            pass
+        closelog()
+    newday=not os.path.exists(path)
+    logstate['fd']=os.open(path,os.O_WRONLY|os.O_APPEND|os.O_CREAT,int('644',8))
+    logstate['path']=path
+    logstate['day']=day
+    if newday: #Compress the log files of the previous days
+        for fname in os.listdir(logstate['logdir']):
+            if fname.startswith("Brw_functions_log_") and fname.endswith(".txt") and fname[18:26]<day:
+                compresslog(os.path.join(logstate['logdir'],fname))
+    return logstate['fd']
+
+def closelog():
+    logstate=getcontext().logstate
+    if logstate['fd'] is not None:
+        os.close(logstate['fd'])
+        logstate['fd']=None
+        logstate['path']=''
+
+def rotatelog():
+    #Rename the current log file as Brw_functions_log_YYYYMMDD_N.txt, and compress it.
+    path=getcontext().logstate['path']
+    closelog()
+    n=1
+    while os.path.exists(path[:-4]+"_"+str(n)+".txt") or os.path.exists(path[:-4]+"_"+str(n)+".txt.gz"):
+        n+=1
+    os.rename(path,path[:-4]+"_"+str(n)+".txt")
+    compresslog(path[:-4]+"_"+str(n)+".txt")
+
+def compresslog(path):
+    #Compress the log file <path> into <path>.gz. Several SHELL calls can try it at the same time (the first call of
+    #a new day compresses the log files of the previous days), so only the one that takes the lock <path>.lock
+    #compresses it, and the others skip it. If it has already been compressed by another process, nothing is done.
+    import gzip
+    import shutil
+    lockpath=path+'.lock'
+    try:
+        if not lockfile(lockpath,timeout=0.,stale=LOG_LOCK_TIMEOUT):
+            return #Being compressed by another process
+    except OSError as e:
+        getstdout().write("[ERROR] [Cannot compress the Brw_functions log file "+str(path)+", exception happened: "+str(e)+".]"+newline)
+        return
+    try:
+        with open(path,'rb') as fi:
+            with AtomicFile(path+'.gz',checkcase=False) as af:
+                with gzip.GzipFile(filename=os.path.basename(path),mode='wb',fileobj=af.file) as fo:
+                    shutil.copyfileobj(fi,fo)
+        os.remove(path)
+    except Exception as e:
+        if os.path.exists(path): #(else, it was already compressed by another process)
+            getstdout().write("[ERROR] [Cannot compress the Brw_functions log file "+str(path)+", exception happened: "+str(e)+".]"+newline)
+    finally:
+        unlockfile(lockpath)
+
+def lockfile(lockpath,timeout=0.,stale=600.):
+    '''
+    locked = lockfile(lockpath,timeout=0.,stale=600.)
+
+    Take the lock <lockpath>, shared by all the processes and threads: the lock file is created with O_EXCL, so only one
+    of them can create it. It waits up to <timeout> seconds for the lock. A lock file older than <stale> seconds was
+    left by a process that died, so it is removed.
+    <locked> True if the lock has been taken (it must be released with unlockfile), False if the timeout has passed.
+    '''
+    import errno
+    t0=time.time()
+    while True:
+        try:
+            os.close(os.open(lockpath,os.O_WRONLY|os.O_CREAT|os.O_EXCL,int('644',8)))
+            return True
+        except OSError as e:
+            if e.errno!=errno.EEXIST:
+                raise
+        try:
+            if time.time()-os.stat(lockpath).st_mtime>stale:
+                os.remove(lockpath)
+                continue
+        except OSError: #Released meanwhile
+            continue
+        if time.time()-t0>=timeout:
+            return False
+        time.sleep(0.005)
+
+def unlockfile(lockpath):
+    #Release the lock <lockpath> (see lockfile)
+    try:
+        os.remove(lockpath)
+    except OSError:
+        pass
+
+atexit.register(flushlog)
+
+#Metrics of the command being processed (getcontext().metrics): wall time, bytes read and written, files touched, and
+#number of directory scans done by exists2. If BREWFUNCT_METRICS_DIR is defined as an environment variable, they are
+#saved by savemetrics().
+PROM_LOCK_TIMEOUT=2. #Seconds to wait for the lock of the Prometheus textfile, before skipping its update (see savemetrics)
+clock=getattr(time,'perf_counter',time.time) #time.perf_counter does not exist in python 2
+
+def resetmetrics(command):
+    getcontext().metrics.update({'command':command,'t0':clock(),'bytes_read':0,'bytes_written':0,'files':set(),'dirscans':0})
+
+def open2(path,mode='r'):
+    #open(path,mode), counting the file as touched by the current command.
+    getcontext().metrics['files'].add(path)
+    return open(path,mode)
+
+def savemetrics(status):
+    '''
+    Save the metrics of the current command, if BREWFUNCT_METRICS_DIR is defined as an environment variable:
+    -A line is appended to Brw_functions_metrics.csv, with a single write in append mode (O_APPEND):
+     'timestamp,command,status,seconds,bytes_read,bytes_written,files_touched,dirscans'
+    -The counters of the Prometheus textfile Brw_functions.prom (for the textfile collector of node_exporter) are
+     updated. The path of the .prom file can be changed with the BREWFUNCT_METRICS_PROM environment variable.
+     It is shared by all the SHELL calls (and the instruments using the same metrics folder), so it is updated
+     with the lock <promfile>.lock taken (see lockfile). It is never synced to disk, whatever the BREWFUNCT_FSYNC policy.
+    '''
+    metrics=getcontext().metrics
+    seconds=clock()-metrics['t0']
+    if getenv('BREWFUNCT_METRICS_DIR') is None:
+        return
+    metricsdir=checkpathformat(getenv('BREWFUNCT_METRICS_DIR'))
+    if metricsdir=='' or not os.path.isdir(metricsdir):
+        return
+    import datetime
+    values={'seconds':seconds,'bytes_read':metrics['bytes_read'],'bytes_written':metrics['bytes_written'],
+            'files_touched':len(metrics['files']),'dirscans':metrics['dirscans']}
+    try:
+        line=','.join([datetime.datetime.now().strftime("%Y%m%dT%H%M%S.%f")[:-4],metrics['command'],str(status),
+                       '%.6f' % seconds]+[str(values[k]) for k in ['bytes_read','bytes_written','files_touched','dirscans']])+'\n'
+        fd=os.open(os.path.join(metricsdir,'Brw_functions_metrics.csv'),os.O_WRONLY|os.O_APPEND|os.O_CREAT,int('644',8))
+        try:
+            os.write(fd,line.encode('ascii'))
+        finally:
+            os.close(fd)
+        promfile=checkpathformat(getenv('BREWFUNCT_METRICS_PROM','')) or os.path.join(metricsdir,'Brw_functions.prom')
+        if lockfile(promfile+'.lock',timeout=PROM_LOCK_TIMEOUT,stale=10*PROM_LOCK_TIMEOUT):
+            try:
+                updateprom(promfile,metrics['command'],status,values)
+            finally:
+                unlockfile(promfile+'.lock')
+        else:
+            add2log("Brw_functions.py, savemetrics, "+promfile+" is locked by another SHELL call, its counters are not updated.",level="WARNING")
+    except Exception as e:
+        add2log("Brw_functions.py, savemetrics, cannot save the metrics, exception happened: "+str(e),level="WARNING")
+
+def updateprom(promfile,command,status,values):
+    #Add the <values> of a <command> to the counters of the Prometheus textfile <promfile>, and rewrite it atomically.
+    counters={}
+    if os.path.exists(promfile):
+        with open(promfile,'r') as f:
+            for line in f:
+                if line.startswith('brewfunct_'):
+                    key,value=line.rsplit(' ',1)
+                    counters[key]=float(value)
+    label='{command="'+command+'"}'
+    if getenv('BREWFUNCT_INSTRUMENT','')!='':
+        label='{command="'+command+'",instrument="'+getenv('BREWFUNCT_INSTRUMENT')+'"}'
+    for key,value in [('brewfunct_commands_total',1),('brewfunct_command_errors_total',1 if status!=0 else 0),
+                      ('brewfunct_command_seconds_sum',values['seconds']),('brewfunct_command_seconds_count',1),
+                      ('brewfunct_bytes_read_total',values['bytes_read']),('brewfunct_bytes_written_total',values['bytes_written']),
+                      ('brewfunct_files_touched_total',values['files_touched']),('brewfunct_dirscans_total',values['dirscans'])]:
+        counters[key+label]=counters.get(key+label,0)+value
+    counters['brewfunct_command_last_seconds'+label]=values['seconds']
+    counters['brewfunct_command_last_timestamp_seconds'+label]=time.time()
+    lines=[]
+    for name,mtype,help in [('brewfunct_commands_total','counter','Number of processed SHELL commands.'),
+                            ('brewfunct_command_errors_total','counter','Number of SHELL commands finished with an exception.'),
+                            ('brewfunct_command_seconds','summary','Wall time of the SHELL commands.'),
+                            ('brewfunct_command_last_seconds','gauge','Wall time of the last SHELL command.'),
+                            ('brewfunct_command_last_timestamp_seconds','gauge','Time of the last SHELL command.'),
+                            ('brewfunct_bytes_read_total','counter','Bytes read by the SHELL commands.'),
+                            ('brewfunct_bytes_written_total','counter','Bytes written by the SHELL commands.'),
+                            ('brewfunct_files_touched_total','counter','Files opened by the SHELL commands.'),
+                            ('brewfunct_dirscans_total','counter','Directory scans done by exists2.')]:
+        lines+=['# HELP '+name+' '+help,'# TYPE '+name+' '+mtype]
+        lines+=[key+' '+repr(counters[key]) for key in sorted(counters) if key.split('{')[0] in [name,name+'_sum',name+'_count']]
+    with AtomicFile(promfile,'w',checkcase=False,fsync=False) as af:
+        af.file.write('\n'.join(lines)+'\n')
+
+#Trace recorder:
+#If BREWFUNCT_TRACE_DIR is defined as an environment variable, every SHELL call is recorded into the file
+#Brw_functions_trace_YYYYMMDD.jsonl of that folder (one JSON object per line), to be replayed by Brw_replay.py:
+#{"t": start time (seconds since the epoch), "args": arguments, "cwd": current directory, "env": {TRACED_ENV variables},
+# "inputs": [[filepath, size, crc32], ...] of the existing files given in the arguments (before running the command),
+# "status": exit status, "seconds": duration}
+#Computing the crc32 of the inputs reads them completely, so it should only be enabled while collecting traces.
+TRACED_ENV=['PROGRAM_PATH','MOUNT_C','MOUNT_D','BREWFUNCT_INSTRUMENT']
+
+def starttrace(ini_arguments,arguments):
+    #Return the trace record of the command (without its status and duration), or None if the recorder is disabled.
+    if getenv('BREWFUNCT_TRACE_DIR','')=='':
+        return None
+    import zlib
+    trace={'t':time.time(),'args':list(ini_arguments),'cwd':getcwd(),
+           'env':dict((k,getenv(k)) for k in TRACED_ENV if getenv(k) is not None),'inputs':[]}
+    try:
+        for path in sorted(getcommandpaths(arguments,lowercase=False) or []):
+            head,tail=os.path.split(path)
+            if not os.path.isfile(path) and os.name!='nt' and os.path.isdir(head):
+                path=os.path.join(head,getdirindex(head).get(tail.lower(),tail)) #With its real capitalization
+            if os.path.isfile(path):
+                crc=0
+                with open(path,'rb') as f:
+                    for block in iter(lambda: f.read(BLOCKSIZE),b''):
+                        crc=zlib.crc32(block,crc)
+                trace['inputs'].append([path,os.path.getsize(path),crc & 0xffffffff])
+    except Exception as e:
+        add2log("Brw_functions.py, starttrace, cannot check the input files, exception happened: "+str(e),level="WARNING")
+    return trace
+
+def savetrace(trace,status):
+    #Complete the <trace> record with the <status> and duration of the command, and append it to the trace file of the day.
+    if trace is None:
+        return
+    import json
+    trace['status']=status
+    trace['seconds']=round(time.time()-trace['t'],6)
+    tracedir=checkpathformat(getenv('BREWFUNCT_TRACE_DIR'))
+    try:
+        line=json.dumps(trace,sort_keys=True)+'\n'
+        fd=os.open(os.path.join(tracedir,'Brw_functions_trace_'+time.strftime('%Y%m%d',time.localtime(trace['t']))+'.jsonl'),
+                   os.O_WRONLY|os.O_APPEND|os.O_CREAT,int('644',8))
+        try:
+            os.write(fd,line.encode('utf-8','surrogateescape') if not isinstance(line,bytes) else line)
+        finally:
+            os.close(fd)
+    except Exception as e:
+        add2log("Brw_functions.py, savetrace, cannot save the trace, exception happened: "+str(e),level="WARNING")
 
 def checkpathformat(path):
     '''
@@ -98,6 +479,391 @@ def checkpathformat(path):
     path=path.replace('//','/') #Replace double forward slash by forward slash
     return path
 
+BLOCKSIZE=1024*1024 #Size of the blocks used to read and write files (1MB)
+MMAP_MINSIZE=64*1024 #Smaller files are read at once, since mapping them costs more than reading them (64KB)
+COPY_THREADS=8 #Number of threads used to copy the files of a wildcard copy (see copy_wildcard)
+
+def copy_nosub(fi,fo):
+    '''
+    nbytes = copy_nosub(fi,fo)
+
+    Copy the contents of the binary file object <fi> (from its current position) into the binary file object <fo>,
+    without the SUB characters (0x1A, the EOF char of DOS).
+    The source file is mapped into memory (mmap), and searched for SUB characters:
+    -If it has none (the most common case), it is copied by the kernel, without passing through python (see copyrange).
+    -If it has SUB characters, the slices between them are written directly from the mapped file (memoryview),
+     without copying them in memory.
+    If <fi> or <fo> are not real files, they cannot be mapped, or the file is smaller than MMAP_MINSIZE bytes, the file
+    is read in blocks of BLOCKSIZE bytes, and the SUB characters are removed from every block at once.
+    <nbytes> number of bytes written into <fo>.
+    '''
+    try:
+        fdin=fi.fileno()
+        fdout=fo.fileno()
+        start=fi.tell()
+        size=os.fstat(fdin).st_size-start
+    except (AttributeError,EnvironmentError,ValueError): #Not a real file
+        size=-1
+    if size==0:
+        return 0
+    if size>=MMAP_MINSIZE:
+        try:
+            import mmap
+            m=mmap.mmap(fdin,0,access=mmap.ACCESS_READ)
+        except (EnvironmentError,ValueError):
+            m=None
+        if m is not None:
+            try:
+                pos=m.find(b'\x1a',start)
+                if pos<0:
+                    #No SUB characters: kernel copy
+                    fo.flush()
+                    outpos=fo.tell()
+                    os.lseek(fdout,outpos,0)
+                    nbytes=copyrange(fdin,fdout,start,size)
+                    fo.seek(outpos+nbytes)
+                else:
+                    nbytes=write_nosub(m,fo,start,start+size,pos)
+            finally:
+                m.close()
+            fi.seek(start+size)
+            getcontext().metrics['bytes_read']+=size
+            getcontext().metrics['bytes_written']+=nbytes
+            return nbytes
+    nbytes=0
+    while True:
+        block=fi.read(BLOCKSIZE)
+        if not block: break
+        getcontext().metrics['bytes_read']+=len(block)
+        block=block.replace(b'\x1a',b'') #Do not copy SUB characters
+        fo.write(block)
+        nbytes+=len(block)
+    getcontext().metrics['bytes_written']+=nbytes
+    return nbytes
+
+def write_nosub(m,fo,start,end,pos):
+    #Write into <fo> the slices between the SUB characters of the mapped file <m>, from <start> to <end>.
+    #<pos> position of the first SUB character.
+    try:
+        mv=memoryview(m)
+    except TypeError: #python 2: mmap objects do not support memoryview, use slices
+        mv=m
+    try:
+        nbytes=0
+        while pos>=0:
+            if pos>start:
+                fo.write(mv[start:pos])
+                nbytes+=pos-start
+            start=pos+1
+            pos=m.find(b'\x1a',start,end)
+        if start<end:
+            fo.write(mv[start:end])
+            nbytes+=end-start
+        return nbytes
+    finally:
+        if mv is not m:
+            mv.release() #The mmap cannot be closed while there are memoryviews of it
+
+def copyrange(fdin,fdout,offset,count):
+    '''
+    nbytes = copyrange(fdin,fdout,offset,count)
+
+    Copy <count> bytes of the file descriptor <fdin>, starting at <offset>, into the current position of the file
+    descriptor <fdout>, kernel to kernel: with os.copy_file_range (python >= 3.8, Linux), or os.sendfile (Linux).
+    If they are not available, or the filesystem does not support them, it is copied in blocks of BLOCKSIZE bytes.
+    <nbytes> number of bytes copied.
+    '''
+    nbytes=0
+    if hasattr(os,'copy_file_range'):
+        try:
+            while nbytes<count:
+                n=os.copy_file_range(fdin,fdout,count-nbytes,offset+nbytes)
+                if n==0: break
+                nbytes+=n
+        except OSError:
+            pass
+    if nbytes<count and hasattr(os,'sendfile') and sys.platform.startswith('linux'):
+        try:
+            while nbytes<count:
+                n=os.sendfile(fdout,fdin,offset+nbytes,count-nbytes)
+                if n==0: break
+                nbytes+=n
+        except OSError:
+            pass
+    if nbytes<count:
+        os.lseek(fdin,offset+nbytes,0)
+        while nbytes<count:
+            block=os.read(fdin,min(BLOCKSIZE,count-nbytes))
+            if not block: break
+            nbytes+=len(block)
+            while block:
+                block=block[os.write(fdout,block):]
+    return nbytes
+
+def append_nosub(fi,dest):
+    '''
+    nbytes = append_nosub(fi,dest)
+
+    Append the contents of the binary file object <fi> at the end of the file <dest>, without the SUB characters.
+    If <dest> ends with SUB characters (like the EOF char written by GWBASIC when closing a file), they are removed
+    before appending, otherwise the appended contents would be hidden behind an EOF char.
+    Only the tail of <dest> is read, so the cost is proportional to the size of <fi>, and not to the size of <dest>.
+    <dest> is modified in place (it is not rewritten through AtomicFile), but it is synced following the fsync policy.
+    <nbytes> number of bytes appended to <dest>.
+    '''
+    with open2(dest,'r+b') as fo: #Not opened in append mode, since the kernel copy does not support it
+        fo.seek(0,2)
+        size=fo.tell()
+        fo.seek(max(0,size-512))
+        tail=fo.read()
+        getcontext().metrics['bytes_read']+=len(tail)
+        ntrailing=len(tail)-len(tail.rstrip(b'\x1a')) #Number of SUB characters at the end of dest
+        if ntrailing>0:
+            fo.truncate(size-ntrailing)
+        fo.seek(size-ntrailing)
+        nbytes=copy_nosub(fi,fo)
+        if getfsyncpolicy()!='none':
+            fo.flush()
+            os.fsync(fo.fileno())
+        return nbytes
+
+def replacefile(src,dst):
+    '''
+    Rename the file <src> as <dst>, replacing <dst> if it already exist.
+    '''
+    try:
+        os.replace(src,dst) #python 3
+    except AttributeError: #python 2
+        if os.name == 'nt' and os.path.exists(dst): #In windows, os.rename fails if dst exist
+            os.remove(dst)
+        os.rename(src,dst)
+
+FSYNC_POLICIES=['none','file','file+dir']
+
+def getfsyncpolicy():
+    '''
+    Get the fsync policy of the written files, from the BREWFUNCT_FSYNC environment variable:
+    -'none': the files are not synced (the fastest, and the least writes into SD cards, but a power cut can leave
+     an empty or partially written file).
+    -'file': the contents of every written file are synced to disk before renaming it to its final name (default).
+    -'file+dir': also the directory is synced after renaming the file, so the rename itself survives a power cut.
+    '''
+    policy=getenv('BREWFUNCT_FSYNC','').strip().lower()
+    if policy=='':
+        return 'file'
+    if policy not in FSYNC_POLICIES:
+        add2log("Brw_functions.py, getfsyncpolicy, unknown BREWFUNCT_FSYNC policy '"+policy+"', using 'file'. Valid policies: "+', '.join(FSYNC_POLICIES),level="WARNING")
+        return 'file'
+    return policy
+
+def fsyncdir(path):
+    #Sync the directory <path>, so the files created or renamed in it are not lost in a power cut (not possible in Windows)
+    if os.name == 'nt':
+        return
+    fd=os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError: #Some filesystems do not support syncing directories
+        pass
+    finally:
+        os.close(fd)
+
+class AtomicFile(object):
+    '''
+    Write the file <path> atomically: the contents are written into a temporary file in the same directory
+    (.<filename>.tmp, hidden, so it is not listed by dir), which is synced (see getfsyncpolicy) and renamed as <path>
+    when the writing finishes. If anything fails while writing, <path> is not
+    modified, and the temporary file is removed. So <path> is never left partially written, even after a power cut.
+    Example:
+        with AtomicFile(path) as af:
+            af.file.write(data)
+            if nothing_to_write:
+                af.discard() #<path> is not created
+    <mode> mode of the temporary file: 'wb' (binary) or 'w' (text).
+    <backup> if given, filepath where to keep the previous contents of <path>. It is done with a hard link to the
+     previous file, or, if the filesystem does not support hard links (like FAT), by renaming the previous file.
+    <checkcase> if True, an existing temporary file with a different capitalization is re-used (see exists2).
+    <fsync> if False, the file is never synced, whatever the fsync policy (for files that can be lost, like the metrics).
+    '''
+    def __init__(self,path,mode='wb',backup='',checkcase=True,fsync=True):
+        self.path=path
+        self.fsync=fsync
+        self.backup=backup
+        self.discarded=False
+        head,tail=os.path.split(path)
+        self.tmppath=os.path.join(head,'.'+tail+'.tmp')
+        if checkcase:
+            #Check if the temporary file already exist with a different capitalization:
+            [exist], [realfilepath], [realfilename] = exists2([self.tmppath],warn=False)
+            if exist:
+                self.tmppath=realfilepath
+        self.file=open2(self.tmppath,mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None and not self.discarded:
+            self.commit()
+        else:
+            self.file.close()
+            try:
+                os.remove(self.tmppath)
+            except OSError as e:
+                add2log("Brw_functions.py, AtomicFile, could not delete "+str(self.tmppath)+", exception happened: "+str(e),level="WARNING")
+        return False
+
+    def discard(self):
+        #Do not create (or modify) the file.
+        self.discarded=True
+
+    def commit(self):
+        policy=getfsyncpolicy() if self.fsync else 'none'
+        self.file.flush()
+        if policy!='none':
+            os.fsync(self.file.fileno())
+        self.file.close()
+        if self.backup!='' and os.path.exists(self.path):
+            backupfile(self.path,self.backup)
+        replacefile(self.tmppath,self.path)
+        if policy=='file+dir':
+            fsyncdir(os.path.dirname(abspath2(self.path)))
+
+def backupfile(path,backup):
+    #Keep the current contents of <path> as <backup>, without copying them: with a hard link, or renaming <path>.
+    try:
+        if os.path.exists(backup+'.tmp'):
+            os.remove(backup+'.tmp')
+        os.link(path,backup+'.tmp')
+        replacefile(backup+'.tmp',backup)
+    except (AttributeError,OSError): #os.link does not exist in python 2 for Windows, or the filesystem does not support it.
+        replacefile(path,backup)
+    getcontext().metrics['files'].add(backup)
+
+class DirEntry2(object):
+    #Replacement of os.DirEntry for python versions without os.scandir
+    def __init__(self,dirpath,name):
+        self.name=name
+        self.path=os.path.join(dirpath,name)
+        self._stat=None
+    def stat(self):
+        if self._stat is None:
+            self._stat=os.stat(self.path)
+        return self._stat
+    def is_dir(self):
+        return os.path.isdir(self.path)
+    def is_file(self):
+        return os.path.isfile(self.path)
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+def scandir2(dirpath):
+    #os.scandir(dirpath), or its replacement for old python versions
+    if hasattr(os,'scandir'):
+        return os.scandir(dirpath)
+    return [DirEntry2(dirpath,name) for name in os.listdir(dirpath)]
+
+RACY_TIME=2.0 #Seconds. Resolution of the modification time of the directories in FAT filesystems (SD cards).
+
+def getdirindexfile():
+    #Filepath of the persisted directories index, if BREWFUNCT_CACHE_DIR is defined as an environment variable.
+    #Every instrument (BREWFUNCT_INSTRUMENT) has its own index file.
+    if getenv('BREWFUNCT_CACHE_DIR') is not None:
+        BREWFUNCT_CACHE_DIR=checkpathformat(getenv('BREWFUNCT_CACHE_DIR'))
+        if BREWFUNCT_CACHE_DIR!="" and os.path.isdir(BREWFUNCT_CACHE_DIR):
+            instrument=getenv('BREWFUNCT_INSTRUMENT','')
+            return os.path.join(BREWFUNCT_CACHE_DIR,"Brw_functions_dirindex"+("_"+instrument if instrument!='' else "")+".json")
+    return ''
+
+def getcache():
+    #Return the cache of the current context (see newcache), loading it from the directories index file the first time.
+    cache=getcontext().cache
+    if not cache['loaded']:
+        cache['loaded']=True
+        indexfile=getdirindexfile()
+        if indexfile!='' and os.path.exists(indexfile):
+            import json
+            try:
+                with open(indexfile,'r') as f:
+                    data=json.load(f)
+                if 'dirindex' in data:
+                    cache['dirindex'].update(data['dirindex'])
+                    cache['dirlistings'].update(data.get('dirlistings',{}))
+                else: #Old format, only the directories index
+                    cache['dirindex'].update(data)
+            except Exception as e:
+                add2log("Brw_functions.py, getcache, cannot load the directories index file "+indexfile+", exception happened: "+str(e),level="WARNING")
+    return cache
+
+def getdirindex(path,rescan=False):
+    '''
+    index = getdirindex(path,rescan=False)
+
+    Return a dictionary <index> {lowercase filename: real filename} with the files of the directory <path>
+    (if there are several files with the same lowercase name, like DIR.TMP and dir.tmp, the first listed one is used).
+    The index of every directory is kept in memory, and it is re-used while the modification time of the directory
+    does not change, so the directory is scanned only once, and the case insensitive searches take O(1).
+    An index is not re-used if the directory was modified less than RACY_TIME seconds before scanning it, since
+    a file created in the same second would not change the directory modification time in some filesystems.
+    If BREWFUNCT_CACHE_DIR is defined as an environment variable, the indexes are also saved into a file in that
+    directory (see savedirindex), so the next SHELL calls can re-use them.
+    If the watcher is running (see startwatcher), the index of the watched directories is taken from it.
+    <rescan> if True, the directory is always scanned again.
+    '''
+    cache=getcache()
+    if cache['watcher'] is not None and not rescan:
+        index=cache['watcher'].getindex(path)
+        if index is not None:
+            return index
+    dirindex=cache['dirindex']
+    mtime=os.stat(path).st_mtime
+    if not rescan and path in dirindex:
+        [imtime, iscantime, index] = dirindex[path]
+        if imtime==mtime and iscantime-imtime>RACY_TIME:
+            return index
+    scantime=time.time()
+    index={}
+    for filename in os.listdir(path):
+        index.setdefault(filename.lower(),filename)
+    getcontext().metrics['dirscans']+=1
+    dirindex[path]=[mtime, scantime, index]
+    cache['changed']=True
+    return index
+
+def startwatcher():
+    '''
+    Start the live index of the PROGRAM_PATH and bdata trees (see Brw_watcher.py), if it is enabled with the
+    BREWFUNCT_WATCH environment variable ('inotify', or 'poll' to check the directories periodically instead of using
+    inotify), and it is not running yet. Only for the long-running modes (--batch and --daemon).
+    '''
+    cache=getcache()
+    mode=getenv('BREWFUNCT_WATCH','').strip().lower()
+    if cache['watcher'] is not None or mode in ['','0','no','off'] or getenv('PROGRAM_PATH') is None:
+        return
+    try:
+        import Brw_watcher
+        from Brw_look4duplicates import getbdatadir
+        cache['watcher']=Brw_watcher.DirWatcher([checkpathformat(getenv('PROGRAM_PATH')),getbdatadir()],mode)
+    except Exception as e:
+        add2log("Brw_functions.py, startwatcher, cannot start the watcher, exception happened: "+str(e),level="WARNING")
+
+def savedirindex():
+    '''
+    Save the directories indexes (and the dir outputs fingerprints) into the file Brw_functions_dirindex.json of
+    BREWFUNCT_CACHE_DIR (if defined), when they have changed.
+    '''
+    cache=getcontext().cache
+    indexfile=getdirindexfile()
+    if indexfile!='' and cache['changed']:
+        import json
+        try:
+            with AtomicFile(indexfile,'w',checkcase=False) as af:
+                #(copies, since other threads of the instrument can modify them)
+                json.dump({'dirindex':dict(cache['dirindex']),'dirlistings':dict(cache['dirlistings'])},af.file)
+            cache['changed']=False
+        except Exception as e:
+            add2log("Brw_functions.py, savedirindex, cannot save the directories index file "+indexfile+", exception happened: "+str(e),level="WARNING")
+
 def exists2(pathlist,verbose=True,warn=True):
     '''
     exists, realfilepaths, realfilenames = exists2(pathlist)
@@ -134,102 +900,73 @@ def exists2(pathlist,verbose=True,warn=True):
         know the real filenames as they are written in the operative system, (with its uppercases and lowercases).
         <exists> a os.path.listdir() will be done to check if there is any file coincident, in lowercases, with the one we are looking for.
          (not that if there is more than one, only the first detected one will be used).
+        The list of files of every directory is taken from its index (see getdirindex), so the directory is
+        only scanned again when its contents change.
 
     '''
     exists=[False for i in pathlist]
     realfilepaths=['' for i in pathlist]
     realfilenames=['' for i in pathlist]
-    lastpath=''
     for i in range(len(pathlist)):
         path, filename = os.path.split(pathlist[i])
         if path=='': #if only filename specified:
-            path=os.getcwd()
+            path=getcwd()
         else:
-            path=os.path.realpath(path)
+            path=os.path.realpath(abspath2(path))
         if os.path.exists(os.path.join(path,filename)): #If the filepath exist:
             exists[i]=True
             realfilepaths[i]=os.path.join(path,filename)
-            realfilenames[i]=deepcopy(filename)
+            realfilenames[i]=filename
             add2log("Brw_functions.py, exist2, filename '"+filename+"' exist as: "+realfilepaths[i])
         else: #If the filepath does not exist:
             if not os.name == 'nt': #Only for linux OS:
-                #Check if an alternative is found (uppercases or lowercases)
-                if path!=lastpath: #Get list of files in path (It may be slow, so do it only if it was not done before)
-                    filelist=os.listdir(path)
-                    lastpath=deepcopy(path)
-                for j in range(len(filelist)):
-                    if filelist[j].lower()==filename.lower():
-                        exists[i]=True
-                        realfilepaths[i]=os.path.join(path,filelist[j])
-                        realfilenames[i]=deepcopy(filelist[j])
-                        if verbose:
-                            add2log("Brw_functions.py, exist2, filename '"+filename+"' exist but different case matching: "+realfilepaths[i])
-                        break
+                #Check if an alternative is found (uppercases or lowercases), in the index of the directory
+                realname=getdirindex(path).get(filename.lower())
+                if realname is not None and not os.path.exists(os.path.join(path,realname)):
+                    #The index is out of date (the file has been deleted or renamed meanwhile), re-scan the directory
+                    realname=getdirindex(path,rescan=True).get(filename.lower())
+                if realname is not None:
+                    exists[i]=True
+                    realfilepaths[i]=os.path.join(path,realname)
+                    realfilenames[i]=realname
+                    if verbose:
+                        add2log("Brw_functions.py, exist2, filename '"+filename+"' exist but different case matching: "+realfilepaths[i])
 
         if not exists[i] and warn: #Finally
             add2log("Brw_functions.py, exist2, filepath '"+pathlist[i]+"' not found. ",level="WARNING")
 
     return exists,realfilepaths,realfilenames
 
-def replacedrive(path):
+def replacedrive(path,verbose=True):
+    #Replace the 'C:' and 'D:' drives of <path> by the values of the MOUNT_C and MOUNT_D environment variables.
+    #<verbose> if False, the replacements are not logged.
 
     if 'c:' in path.lower():
-        if 'MOUNT_C' in os.environ:
-            MOUNT_C=checkpathformat(os.environ['MOUNT_C']) #check MOUNT_C path format
+        if getenv('MOUNT_C') is not None:
+            MOUNT_C=checkpathformat(getenv('MOUNT_C')) #check MOUNT_C path format
             cindx=path.lower().find('c:') #index of the 'c' character position in path string
             path=path.replace(path[cindx:cindx+2],MOUNT_C) #Replace 'c:' or 'C:' by the value of MOUNT_C
             path=checkpathformat(path) #Check path format
-            add2log("Brw_functions.py, replacedrive, replaced 'C:' by the value of MOUNT_C: " +str(path))
-        else:
+            if verbose:
+                add2log("Brw_functions.py, replacedrive, replaced 'C:' by the value of MOUNT_C: " +str(path))
+        elif verbose:
             add2log("Brw_functions.py, replacedrive, 'C:' found in path but MOUNT_C was not found as an environment variable.",level="WARNING")
 
     if 'd:' in path.lower():
-        if 'MOUNT_D' in os.environ:
-            MOUNT_D=checkpathformat(os.environ['MOUNT_D']) #check MOUNT_C path format
+        if getenv('MOUNT_D') is not None:
+            MOUNT_D=checkpathformat(getenv('MOUNT_D')) #check MOUNT_C path format
             dindx=path.lower().find('d:') #index of the 'd' character position in the path string
             path=path.replace(path[dindx:dindx+2],MOUNT_D) #Replace 'd:' or 'D:' by the value of MOUNT_D
             path=checkpathformat(path) #Check path format
-            add2log("Brw_functions.py, replacedrive, replaced 'D:' by the value of MOUNT_D: " +str(path))
-        else:
+            if verbose:
+                add2log("Brw_functions.py, replacedrive, replaced 'D:' by the value of MOUNT_D: " +str(path))
+        elif verbose:
             add2log("Brw_functions.py, replacedrive, 'D:' found in path but MOUNT_D was not found as an environment variable.",level="WARNING")
 
+    if getcontext().cwd is not None and path!='':
+        path=abspath2(path) #Relative paths are relative to the current directory of the request (daemon mode)
     return path
 
-def look4duplicates(path):
-    '''
-    look for duplicated files in the specified path (Same file names but with different capitalization) (Only for linux OS)
-    When using linux, it is recommended to run this function before starting the brewer software,
-    just to check that there are not duplicated files with same name but with different capitalization in the working folders.
-    If this function detects duplicated files, an ERROR message will be written in the Brw_functions log file.
-    The user must research why these files are being duplicated.
-    Known cases:
-    -DIR.TMP and dir.tmp
-    -tmp.tmp and TMP.TMP
-    In these known cases, you could fix it by simply deleting both files. (they will be re-generated by the brewer software)
-    '''
-    if path=='':
-        path=os.getcwd()
-    ls1=os.listdir(path)
-    ls2=[i.lower() for i in ls1] #convert everything to lowercase to compare
-    duplicates=[]
-    for i in range(len(ls2)):
-        if ls2.count(ls2[i]) > 1:
-            duplicates.append(ls1[i])
-
-    if len(duplicates)>0:
-        add2log("Brw_functions.py, look4duplicates, !!!! found duplicated files in "+str(path)+": "+str(duplicates),level="ERROR")
-    else:
-        add2log("Brw_functions.py, look4duplicates, none duplicated file found in "+str(path),level="INFO")
-
-
-
-
-
-
-
-
-
-
 #--------------Emulating functions-------------
 def shell_copy(orig, dest):
     #Emulate the custom COMMAND.COM behavior of the gwbasic shell copy function:
@@ -256,15 +993,27 @@ def shell_copy(orig, dest):
     #Note: if full paths are not given, the operations are done in the current selected directory.
     #(In the pcbasic launchers, the current working directory is set to the brewer program directory, ie: brw#072/prog410/).
 
+    #Wildcards (copy *.rtn C:\backup\): every matching file is copied into the destination directory (see copy_wildcard),
+    #or, if the destination is not a directory, all of them are appended into the destination file, as in case 6.
+
     add2log("Brw_functions.py, shell_copy, emulating command: copy " + str(orig) + " "+ str(dest))
+    wantdir = dest.strip().endswith(('\\','/')) #The destination is a directory (checked before replacedrive, which can remove the separator)
     orig = replacedrive(orig.strip())
     dest = replacedrive(dest.strip())
-    dest_temp = dest + ".tmp"
 
-    #Check if dest_temp already exist with a different capitalization:
-    [exist], [realfilepath], [realfilename] = exists2([dest_temp],warn=False)
-    if exist:
-        dest_temp=deepcopy(realfilepath)
+    if "+" not in orig and ('*' in os.path.basename(orig) or '?' in os.path.basename(orig)):
+        matches=findwildcard(orig)
+        if len(matches)==0:
+            add2log("Brw_functions.py, shell_copy, cannot copy "+orig+" because no file matches it.",level="WARNING")
+            return
+        destdir=realdir(dest)
+        if destdir!='':
+            copy_wildcard(matches,destdir)
+            return
+        elif wantdir:
+            add2log("Brw_functions.py, shell_copy, cannot copy "+orig+" because the destination directory "+dest+" does not exist.",level="WARNING")
+            return
+        orig='+'.join(matches) #Destination file: concatenation of all the matching files
 
     if "+" in orig: #Case of copy with append
         # Example: 'copy file1+file2 destination'
@@ -272,74 +1021,133 @@ def shell_copy(orig, dest):
         files_to_append = orig.split("+")
         files_to_append = [i.strip() for i in files_to_append] #Remove possible spaces between the filenames
 
-        #Create a temporary destination file where to append everything.
-        with open(dest_temp, "wb") as ft:
+        #Append everything into a temporary destination file (see AtomicFile).
+        nbytes=0
+        with AtomicFile(dest) as af:
             for path_i in files_to_append:
                 [exist], [realfilepath], [realfilename] = exists2([path_i])
                 if exist: #This will skip not existing files.
-                    path_i=deepcopy(realfilepath)
+                    path_i=realfilepath
                     add2log("Brw_functions.py, shell_copy (with append), found file "+path_i)
-                    with open(path_i, "rb") as fi: #This will fill the temporary destination file without EOF chars.
-                        while True:
-                            char = fi.read(1)
-                            if not char: break
-                            if char == b'\x1a': continue #Do not copy SUB character
-                            ft.write(char)
+                    with open2(path_i, "rb") as fi: #This will fill the temporary destination file without EOF chars.
+                        nbytes+=copy_nosub(fi,af.file)
                 else:
                     add2log("Brw_functions.py, shell_copy (with append), skipping file " + path_i + ", because it doesn't exist." ,level="WARNING")
 
-        #The final destination file will be created only if temporal destination file is not empty.
-        with open(dest_temp, "rb") as ft:
-            contents=ft.read()
-            if len(contents)>0:
-                with open(dest,"wb") as fd:
-                    fd.write(contents)
-                add2log("Brw_functions.py, shell_copy (with append), file saved at: " + dest)
-            else:
-                add2log("Brw_functions.py, shell_copy (with append), not generating destination file because the concatenation gave an empty file as result.",level="INFO")
-        #Finally, delete the temporal destination file.
-        try:
-            os.remove(dest_temp)
-        except Exception as e:
-            add2log("Brw_functions.py, shell_copy (with append), could not delete dest_temp, exception happened: "+str(e),level="WARNING")
+            #The final destination file will be created only if temporal destination file is not empty.
+            if nbytes==0:
+                af.discard()
+        if nbytes>0:
+            add2log("Brw_functions.py, shell_copy (with append), file saved at: " + dest)
+        else:
+            add2log("Brw_functions.py, shell_copy (with append), not generating destination file because the concatenation gave an empty file as result.",level="INFO")
 
 
     else: #Case of copy without append
         # Example: 'copy file1 destination':
         [exist], [realfilepath], [realfilename] = exists2([orig])
         if exist: #if file1 exist.
-            orig=deepcopy(realfilepath)
+            orig=realfilepath
             add2log("Brw_functions.py, shell_copy, found file " + orig)
-            with open(dest_temp, "wb") as ft: # This will create a new temporal destination file, without eof chars.
-                with open(orig, "rb") as fi:
-                    while True:
-                        char=fi.read(1)
-                        if not char: break
-                        if char == b'\x1a': continue #Do not copy SUB character
-                        ft.write(char)
-
-            # The final destination file will be created only if temporal destination file is not empty.
-            with open(dest_temp, "rb") as ft:
-                contents = ft.read() #read the whole file
-                if len(contents) > 0:
-                    with open(dest, "wb") as fd:
-                        fd.write(contents)
-                    add2log("Brw_functions.py, shell_copy, file saved at: " + dest)
+            if wantdir or os.path.isdir(dest): #copy file1 C:\backup\
+                destdir=realdir(dest)
+                if destdir!='':
+                    copy_wildcard([orig],destdir)
                 else:
-                    add2log("Brw_functions.py, shell_copy, not generating destination file because orig file is empty.",level="INFO")
-            # Finally, delete the temporal destination file.
-            try:
-                os.remove(dest_temp)
-            except Exception as e:
-                add2log("Brw_functions.py, shell_copy, could not delete dest_temp, exception happened: "+str(e),level="WARNING")
+                    add2log("Brw_functions.py, shell_copy, cannot copy "+orig+" because the destination directory "+dest+" does not exist.",level="WARNING")
+                return
+            with AtomicFile(dest) as af: # This will create a new temporal destination file, without eof chars.
+                with open2(orig, "rb") as fi:
+                    nbytes=copy_nosub(fi,af.file)
+                # The final destination file will be created only if temporal destination file is not empty.
+                if nbytes==0:
+                    af.discard()
+            if nbytes > 0:
+                add2log("Brw_functions.py, shell_copy, file saved at: " + dest)
+            else:
+                add2log("Brw_functions.py, shell_copy, not generating destination file because orig file is empty.",level="INFO")
         else:
             add2log("Brw_functions.py, shell_copy, cannot copy the orig file because it doesn't exist.",level="WARNING")
 
+def realdir(dirpath):
+    '''
+    realdirpath = realdir(dirpath)
+
+    Real path of the directory <dirpath>, checking the capitalization of every directory of the path, not only of the
+    last one (like exists2), or '' if it does not exist. Example: '/home/brewer/bdata/backup' -> '/home/brewer/BData/Backup'
+    '''
+    dirpath=abspath2(dirpath)
+    if os.path.isdir(dirpath):
+        return dirpath
+    head,tail=os.path.split(dirpath)
+    if tail=='':
+        return ''
+    head=realdir(head)
+    if head=='':
+        return ''
+    [exist], [realfilepath], [realfilename] = exists2([os.path.join(head,tail)],verbose=False,warn=False)
+    return realfilepath if exist and os.path.isdir(realfilepath) else ''
+
+def findwildcard(pattern):
+    '''
+    filepaths = findwildcard(pattern)
+
+    Sorted list of the real filepaths of the files matching the DOS wildcard <pattern> (like 'C:/brw#072/bdata072/*.rtn'),
+    case insensitive, both in the directory (see realdir) and in the filenames (see compile_wildcard in Brw_dir.py).
+    If a path is not given, the files are searched in the current directory.
+    '''
+    from Brw_dir import compile_wildcard
+    dirpath,pattern=os.path.split(pattern)
+    dirpath=realdir(dirpath or getcwd())
+    if dirpath=='':
+        return []
+    match=compile_wildcard(pattern or '*')
+    getcontext().metrics['dirscans']+=1
+    return sorted([entry.path for entry in scandir2(dirpath) if entry.name[:1]!='.' and match(entry.name) and entry.is_file()])
+
+def copy_wildcard(filepaths,destdir):
+    '''
+    Copy the files <filepaths> into the directory <destdir>, with the same filenames, in parallel (COPY_THREADS threads),
+    without the SUB characters (see copy_nosub). As in case 3.2 of shell_copy, the empty files are not copied.
+    The result of every file is written into the log.
+    '''
+    #The existing files of <destdir> are overwritten, even if they have a different capitalization. The index of <destdir>
+    #is taken once, before copying (since it changes with every copied file, see getdirindex).
+    index=dict(getdirindex(destdir,rescan=True)) if not os.name=='nt' else {}
+    def copyfile(path):
+        try:
+            filename=os.path.basename(path)
+            dest=os.path.join(destdir,index.get(filename.lower(),filename))
+            with AtomicFile(dest,checkcase=False) as af:
+                with open2(path, "rb") as fi:
+                    nbytes=copy_nosub(fi,af.file)
+                if nbytes==0:
+                    af.discard()
+            if nbytes>0:
+                add2log("Brw_functions.py, shell_copy, file "+path+" saved at: "+dest)
+            else:
+                add2log("Brw_functions.py, shell_copy, not copying "+path+" because it is empty.",level="INFO")
+            return nbytes>0
+        except Exception as e:
+            add2log("Brw_functions.py, shell_copy, cannot copy "+path+" into "+destdir+", exception happened: "+str(e),level="ERROR")
+            return False
+
+    if len(filepaths)==1:
+        results=[copyfile(filepaths[0])]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool=ThreadPool(min(COPY_THREADS,len(filepaths)))
+        try:
+            results=pool.map(incontext(copyfile),filepaths)
+        finally:
+            pool.close()
+    add2log("Brw_functions.py, shell_copy, "+str(sum(results))+" of "+str(len(filepaths))+" files copied into "+destdir+".")
+
 def shell_mkdir(dir):
     #Create a directory:
     add2log("Brw_functions.py, shell_mkdir, emulating command: mk " + str(dir))
     dir=replacedrive(dir)
-    os.makedirs(dir)
+    os.makedirs(abspath2(dir))
 
 def shell_setdate():
     #This function changes the date in the bdata\###\OP_ST.### file.
@@ -347,16 +1155,17 @@ def shell_setdate():
     add2log("Brw_functions.py, shell_setdate, emulating command: setdate")
 
     #Read bdata path and instrument info from OP_ST.FIL:
-    if 'PROGRAM_PATH' in os.environ:
-        PROGRAM_PATH=checkpathformat(os.environ['PROGRAM_PATH']) #Check path format
+    if getenv('PROGRAM_PATH') is not None:
+        PROGRAM_PATH=checkpathformat(getenv('PROGRAM_PATH')) #Check path format
         opstfil_dir = os.path.join(PROGRAM_PATH, 'OP_ST.FIL')
         #Check if OP_ST.FIL file exist in PROGRAM_PATH with different capitalization:
         [exist], [realfilepath], [realfilename] = exists2([opstfil_dir])
         if exist:
             #If OP_ST.FIL is found, read its contents:
-            opstfil_dir=deepcopy(realfilepath)
-            with open(opstfil_dir,'r') as f:
+            opstfil_dir=realfilepath
+            with open2(opstfil_dir,'r') as f:
                 opstfil_content=f.read()
+            getcontext().metrics['bytes_read']+=len(opstfil_content)
             opstfil_content=opstfil_content.split()
             instr_number = opstfil_content[0] #First element = instrument number
             bdata_dir=opstfil_content[1] #Second row = bdata dir
@@ -368,17 +1177,15 @@ def shell_setdate():
             #Check if bdata/NNN/OP_ST.NNN file exist:
             [exist], [realfilepath], [realfilename] = exists2([opstinstr_dir])
             if exist:
-                opstinstr_dir=deepcopy(realfilepath)
+                opstinstr_dir=realfilepath
                 path, filename = os.path.split(opstinstr_dir)
                 filename,ext=filename.split(".")
                 opstinstr_bak_dir = os.path.join(path,filename+'_bak.'+ext)
 
-                #Create a backup of the OP_ST.### first. (OP_ST_bak.###)
-                shell_copy(opstinstr_dir,opstinstr_bak_dir)
-
                 #Open OP_ST.###
-                with open(opstinstr_dir,'r') as f:
+                with open2(opstinstr_dir,'r') as f:
                     c0 = f.read() #read Contents.
+                getcontext().metrics['bytes_read']+=len(c0)
 
                 #Detect carriage return type
                 if "\r\n" in c0:
@@ -390,14 +1197,18 @@ def shell_setdate():
                 cs = c0.rsplit(cr)
                 if len(cs)>0:
                     #Modify content: Update the date
+                    import datetime
                     date=datetime.datetime.now()
                     cs[6]=str(date.day).zfill(2) #Set Day 'DD'
                     cs[7]=str(date.month).zfill(2)#Set Month 'MM'
                     cs[8]=str(date.year)[-2:] #Set Year 'YY'
                     cs[23]=' 1' #Set A\D Board to '1'.
                     c1=cr.join(cs)
-                    with open(opstinstr_dir, 'w') as f:
-                        f.write(c1) #Re-Build the modified file
+                    #Re-Build the modified file, keeping the previous one as a backup (OP_ST_bak.###)
+                    with AtomicFile(opstinstr_dir,'w',backup=opstinstr_bak_dir) as af:
+                        af.file.write(c1)
+                    getcontext().metrics['bytes_written']+=len(c1)
+                    add2log("Brw_functions.py, shell_setdate, backup saved at: " +str(opstinstr_bak_dir))
                     add2log("Brw_functions.py, shell_setdate, date set in file: " +str(opstinstr_dir))
                 else:
                     add2log("Brw_functions.py, shell_setdate, cannot parse elements of: "+str(opstinstr_dir)+", cr="+str(cr)+", cs="+str(c0),level="WARNING")
@@ -416,27 +1227,23 @@ def shell_noeof(file):
     # This function is used in several routines, such as UV.
     add2log("Brw_functions.py, shell_noeof, emulating command: noeof " + str(file))
 
-    if 'PROGRAM_PATH' in os.environ:
-        PROGRAM_PATH=checkpathformat(os.environ['PROGRAM_PATH']) #Check path format
+    if getenv('PROGRAM_PATH') is not None:
+        PROGRAM_PATH=checkpathformat(getenv('PROGRAM_PATH')) #Check path format
         #fin_dir: Input file path
         fin_dir=replacedrive(file.strip())
         #check if fin_dir exist:
         [exist], [realfilepath], [realfilename] = exists2([fin_dir])
         if exist:
-            fin_dir=deepcopy(realfilepath)
+            fin_dir=realfilepath
             #fout_dir: Output file path
             fout_dir=os.path.join(PROGRAM_PATH,"tmp.tmp") #temporal file will be saved into program dir.
             #check if fout_dir already exist with a different capitalization: (i.e: TMP.TMP instead of tmp.tmp)
             [exist], [realfilepath], [realfilename] = exists2([fout_dir],warn=False)
             if exist:
-                fout_dir=deepcopy(realfilepath)
-            with open(fin_dir,'rb') as fi: #Binary open for being able to detect the EOF char
-                with open(fout_dir,'wb') as fo:
-                    while True:
-                        char=fi.read(1)
-                        if not char: break
-                        if char == b'\x1a': continue #Do not copy SUB character
-                        fo.write(char)
+                fout_dir=realfilepath
+            with open2(fin_dir,'rb') as fi: #Binary open for being able to detect the EOF char
+                with AtomicFile(fout_dir) as af:
+                    copy_nosub(fi,af.file)
             add2log("Brw_functions.py, shell_noeof, file saved at: " + str(fout_dir))
         else:
             add2log("Brw_functions.py, shell_noeof, input file not found: "+str(fin_dir),level="WARNING")
@@ -448,113 +1255,39 @@ def shell_noeof(file):
 
 def shell_append(file1,file2):
     #Append files: 'append file1 file2' -> file1 will be appended at the end of the file2.
+    #Only the contents of file1 (without EOF chars) are written at the end of file2, so file2 is not rewritten.
+    #If file2 does not exist, file1 is copied into file2, with the same behavior as shell_copy (i.e: if file1 is empty, file2 is not created).
     add2log("Brw_functions.py, shell_append, emulating command: append "+str(file1)+" "+str(file2))
     file1=replacedrive(file1)
     file2=replacedrive(file2)
-    if 'PROGRAM_PATH' in os.environ:
-        PROGRAM_PATH=checkpathformat(os.environ['PROGRAM_PATH']) #Check path format
-        copytemp=os.path.join(PROGRAM_PATH,"copy.tmp")
-        tmptmp=os.path.join(PROGRAM_PATH,"tmp.tmp")
-
-        [exist], [realfilepath], [realfilename] = exists2([tmptmp],warn=False)
-        if exist: #if there is already a tmp.tmp file with a different capitalization, (ie TMP.TMP) use it.
-            tmptmp=deepcopy(realfilepath)
 
-        [exist], [realfilepath], [realfilename] = exists2([file2])
+    [exist], [realfilepath], [realfilename] = exists2([file2])
+    if exist:
+        file2=realfilepath
+        [exist], [realfilepath], [realfilename] = exists2([file1])
         if exist:
-            file2=deepcopy(realfilepath)
-            shell_copy(file2+'+'+file1,copytemp)
-            shell_noeof(copytemp) #This will copy copytemp into tmptmp without any eof char.
-            shell_copy(tmptmp, file2) # The resultant file will be on file2
-            os.remove(copytemp)
-            os.remove(tmptmp)
-            add2log("Brw_functions.py, shell_append, files appended into " +str(file2)+".")
+            file1=realfilepath
+            with open2(file1,'rb') as fi:
+                nbytes=append_nosub(fi,file2)
+            add2log("Brw_functions.py, shell_append, files appended into " +str(file2)+" ("+str(nbytes)+" bytes).")
         else:
-            add2log("Brw_functions.py, shell_append, file " +str(file2)+" does not exist. Copying "+str(file1)+" on it.")
-            shell_copy(file1, file2)
+            add2log("Brw_functions.py, shell_append, file " +str(file1)+" does not exist. Nothing appended into "+str(file2)+".",level="WARNING")
     else:
-        add2log("Brw_functions.py, shell_append, PROGRAM_PATH not found as an enviroment variable.",level="WARNING")
-
-def shell_dir(arguments):
-    # Example1: ['dir','*.rtn', '/l', '/o:n', '/b', '>dir.tmp'] current path, with wildcard filter
-    # Example2: ['dir','C:\brw#072\bdata\', '/l', '/o:n', '/b', '>dir.tmp'] full path case
-    # Example3: ['dir','>dir.tmp'] current path
-    if 'PROGRAM_PATH' in os.environ:
-        PROGRAM_PATH=checkpathformat(os.environ['PROGRAM_PATH']) #Check path format
-        path=os.path.abspath(PROGRAM_PATH)
-        if len(arguments)>1:
-            if '/' not in arguments[1]:
-                if '>' not in arguments[1]:
-                    arguments[1]=replacedrive(arguments[1])
-                    head,tail=os.path.split(arguments[1]) #analyze arguments[1]
-                    #Examples:
-                    # Case of full path: 'C:/brw#072/bdata/*.rtn' -> head="C:/brw#072/bdata/", tail="*.rtn"
-                    # Case of no head: '*.rtn' -> head="", tail="*.rtn"
-                    if head=="": #if no head
-                        path=os.path.join(path,arguments[1]) #add the current path as head
-                    else:
-                        path=deepcopy(arguments[1])
-        arguments[1]=path #replace arguments[1] with the abspath
-        add2log("Brw_functions.py, shell_dir, emulating " + ' '.join(arguments)+".")
-
-        #dir_output=os.listdir(path) #It does not work recursively
-        dir_output=glob.glob(path) #find files recursively
-
-        if '/l' in [i.lower() for i in arguments]:
-            #Convert output to lowercase
-            dir_output = [i.lower() for i in dir_output]
-
-        if '/o:n' in [i.lower() for i in arguments]:
-            #Sort the output alphabetically
-            dir_output = sorted(dir_output)
-
-        if '/o:-n' in [i.lower() for i in arguments]:
-            #Sort the output alphabetically reversed
-            dir_output = sorted(dir_output, reverse=True)
-
-        if '/o:d' in [i.lower() for i in arguments]:
-            # Sort the output by date (older to newer)
-            dir_output =sorted(dir_output, key=lambda x: os.stat(os.path.join(path, x)).st_mtime)
-
-        if '/o:-d' in [i.lower() for i in arguments]:
-            # Sort the output by date (newer to older)
-            dir_output =sorted(dir_output, key=lambda x: os.stat(os.path.join(path, x)).st_mtime, reverse=True)
-
-        #/b Displays a bare list of directories and files, with no additional information. (just 1 column)
-
-        #Save into file >
-        for ix in range(len(arguments)):
-            i=arguments[ix]
-            if '>' in i:
-                dir_understood = True
-                if len(i)>1:
-                    #case [...,">dir.tmp"]
-                    tmpfile=replacedrive(i[1:])
-                    head,tail=os.path.split(tmpfile)
-                    if head=="":
-                        tmpfile = os.path.join(PROGRAM_PATH, tmpfile) #if no head given, add current path
-                else:
-                    #case [..., ">", "dir.tmp"]
-                    try:
-                        tmpfile=replacedrive(arguments[ix+1])
-                        head,tail=os.path.split(tmpfile)
-                        if head=="":
-                            tmpfile = os.path.join(PROGRAM_PATH, tmpfile) #no head given, add current path
-                    except:
-                        dir_understood=False
-
-                if dir_understood:
-                    [exist], [realfilepath], [realfilename] = exists2([tmpfile],warn=False)
-                    if exist: #if dir.tmp already exist with a different capitalization, ie DIR.TMP instead of dir.tmp
-                        tmpfile=deepcopy(realfilepath)
-                    with open(tmpfile,'w') as fo:
-                        for l in dir_output:
-                            fo.write(l+'\n')
-                    add2log("Brw_functions.py, shell_dir, DIR output saved at " + tmpfile + ".")
-                else:
-                    add2log("Brw_functions.py, shell_dir, cannot understand the DIR command",level="WARNING")
+        add2log("Brw_functions.py, shell_append, file " +str(file2)+" does not exist. Copying "+str(file1)+" on it.")
+        shell_copy(file1, file2)
+
+def shell_wait(arguments):
+    #'wait [path]': in async mode, the daemon waits for the queued commands before executing it (see execute_request).
+    waited=getcontext().waited
+    target=" for "+' '.join(arguments[1:]) if len(arguments)>1 else ""
+    if waited is None or waited[0]==0:
+        add2log("Brw_functions.py, shell_wait, no queued commands pending (async mode)"+target+".")
     else:
-        add2log("Brw_functions.py, shell_dir, cannot emulate DIR since PROGRAM_PATH is not found as enviroment variable. ",level="WARNING")
+        add2log("Brw_functions.py, shell_wait, waited for "+str(waited[0])+" queued commands (async mode)"+target+", "+('%.3f' % waited[1])+" seconds.")
+
+def shell_cmd(arguments):
+    #Case of 'cmd /C' (or only 'cmd' after parsing it)
+    add2log("Brw_functions.py, None action required.")
 
 
 
@@ -564,45 +1297,468 @@ def shell_dir(arguments):
 
 
 #---------------------------------------------
-#Evaluate the contents of arguments of the SHELL call:
-add2log("Brw_functions.py, received arguments: "+str(ini_arguments)+ ", parsed arguments: "+str(arguments)+", command: '"+command+"'.")
-try:
-    if arguments[0].lower()=="copy": #Example 'copy file1+file2 destination' or 'copy file1 destination'
-        shell_copy(arguments[1],arguments[2])
+#Registry of the emulated commands: {command: (module, function, number of arguments)}
+#The module of a command is only imported when the command is dispatched, so the commands that need other modules
+#(like re, json or multiprocessing) do not add import time to every SHELL call.
+#The function is called with the given number of arguments (the ones following the command name: function(arg1, arg2)),
+#or, if it is None, with the full list of arguments (function(['dir', '*.rtn', '/o:n', '>dir.tmp'])).
+#To add a new emulated command, add its entry here, and its function to this file or to a new Brw_xxx.py module.
+COMMANDS={'copy':('Brw_functions','shell_copy',2), #Example 'copy file1+file2 destination' or 'copy file1 destination'
+          'md':('Brw_functions','shell_mkdir',1), #Example 'md C:\Temporal\Newfolder'
+          'setdate':('Brw_functions','shell_setdate',0), #Example 'setdate.exe'
+          'noeof':('Brw_functions','shell_noeof',1), #Example 'noeof filename'
+          'append':('Brw_functions','shell_append',2), #Example 'append file1 file2'
+          'dir':('Brw_dir','shell_dir',None), #Example 'dir *.rtn /l /o:n /b >dir.tmp'
+          'look4duplicates':('Brw_look4duplicates','shell_look4duplicates',None), #Example 'look4duplicates [path] [/s] [--json=report.json] [--resolve]'
+          'wait':('Brw_functions','shell_wait',None), #Example 'wait C:\brw#072\bdata072\B07217.072' (see Async mode)
+          'cmd':('Brw_functions','shell_cmd',None)} #Case of 'cmd /C' (or only 'cmd' after parsing it)
+COMMAND_ALIASES={'setdate.exe':'setdate','noeof.exe':'noeof'}
+
+def getcommand(name):
+    '''
+    function = getcommand(name)
 
-    elif arguments[0].lower()=="md": #Example 'md C:\Temporal\Newfolder'
-        shell_mkdir(arguments[1])
+    Return the emulating function of the command <name> (see COMMANDS), importing its module if needed.
+    '''
+    module,function,nargs=COMMANDS[name]
+    if module not in sys.modules:
+        __import__(module)
+    return getattr(sys.modules[module],function)
 
-    elif arguments[0].lower() in ["setdate","setdate.exe"]: #Example 'setdate.exe'
-        shell_setdate()
+def parse_arguments(ini_arguments):
+    '''
+    arguments, command = parse_arguments(ini_arguments)
 
-    elif arguments[0].lower() in ["noeof","noeof.exe"]: #Example 'noeof filename'
-        shell_noeof(arguments[1])
+    Parse the arguments of the SHELL call.
+    <ini_arguments> list of strings, as received in sys.argv[1:]. Example ['/C', 'copy re-sb.rtn re.rtn']
+    <arguments> list of strings, with the /C argument removed, and split by spaces. Example ['copy', 're-sb.rtn', 're.rtn']
+    <command> command line string, built with the parsed arguments. Example 'copy re-sb.rtn re.rtn'
+    '''
+    arguments=[]
+    if len(ini_arguments)>0:
+        for i in ini_arguments:
+            if i=="/C":
+                pass #ignore the /C command (it is to close the cmd console)
+            else:
+                arguments=arguments+i.split(" ") #Example ['copy', 're-sb.rtn', 're.rtn']
+    else:
+        arguments=['']
 
-    elif arguments[0].lower()=="append":  #Example 'append file1 file2'
-        shell_append(arguments[1], arguments[2])
+    command = ' '.join(arguments) #Build a command line string
+    command = str(command.replace('\r', '\\r').replace('\n', '\\n'))
+    return arguments, command
 
-    elif arguments[0].lower()=="dir": #Example 'dir *.rtn /l /o:n /b >dir.tmp'
-        shell_dir(arguments)
+def run_command(ini_arguments):
+    '''
+    status = run_command(ini_arguments)
 
-    elif arguments[0].lower()=="look4duplicates":
-        if len(arguments)>1 and arguments[1]!='':
-            look4duplicates(arguments[1]) #Check for duplicates in given path
+    Evaluate the contents of the arguments of the SHELL call, and execute the respective emulating function.
+    <ini_arguments> list of strings, as received in sys.argv[1:]
+    <status> exit status: 0 if the command was processed, or 1 if an exception happened while processing it.
+    '''
+    arguments, command = parse_arguments(ini_arguments)
+    status=0
+    name=COMMAND_ALIASES.get(arguments[0].lower(),arguments[0].lower())
+    resetmetrics(name if name in COMMANDS else 'unrecognized')
+    add2log("Brw_functions.py, received arguments: "+str(ini_arguments)+ ", parsed arguments: "+str(arguments)+", command: '"+command+"'.")
+    trace=starttrace(ini_arguments,arguments)
+    try:
+        if name in COMMANDS:
+            module,function,nargs=COMMANDS[name]
+            handler=getcommand(name)
+            if nargs is None:
+                handler(arguments)
+            else:
+                handler(*arguments[1:1+nargs])
         else:
-            look4duplicates('') #Check for duplicates in current path
+            add2log("Brw_functions.py, Ignored unrecognized shell command: "+ command+ ", arguments="+str(arguments)+".")
 
-    elif arguments[0].lower()=="cmd": #Case of 'cmd /C' (or only 'cmd' after parsing it)
-        add2log("Brw_functions.py, None action required.")
+    except Exception as e:
+        add2log("Exception happened in Brw_functions: "+str(e),level="WARNING")
+        status=1
 
+    savedirindex()
+    savemetrics(status)
+    savetrace(trace,status)
+    add2log("-----------")
+    flushlog()
+    return status
 
 
-    else:
-        add2log("Brw_functions.py, Ignored unrecognized shell command: "+ command+ ", arguments="+str(arguments)+".")
 
+#-----------------Batch mode-----------------
+def run_batch(f):
+    '''
+    status = run_batch(f)
 
-except Exception as e:
-    add2log("Exception happened in Brw_functions: "+str(e),level="WARNING")
+    Run the commands read from the file object <f>, one per line, with the same syntax as the SHELL calls
+    (for example 'copy file1+file2 destination'), sequentially in this same python process.
+    Empty lines, and lines starting with '#' are ignored.
+    <status> 0 if all the commands were processed, or 1 if an exception happened while processing any of them.
+    '''
+    status=0
+    ncommand=0
+    startwatcher()
+    for line in f:
+        line=line.strip()
+        if line=='' or line.startswith('#'):
+            continue
+        ncommand+=1
+        status_i=run_command([line])
+        add2log("Brw_functions.py, run_batch, command "+str(ncommand)+" '"+line+"' finished with status "+str(status_i)+".",level="INFO" if status_i==0 else "WARNING")
+        flushlog()
+        status=max(status,status_i)
+    return status
+
+
+
+#-----------------Daemon mode-----------------
+#Multi-instrument mode:
+#A single daemon can serve the SHELL calls of several PCBASIC sessions (one per instrument), identified by the
+#BREWFUNCT_INSTRUMENT environment variable of their launchers (forwarded by Brw_functions_client.py).
+#-Every instrument has its own directories index (and index file, see getdirindexfile), its own Brw_functions log
+# state, and its own environment variables (PROGRAM_PATH, MOUNT_C, MOUNT_D...) and current directory, given by its requests.
+#-The requests of every instrument are executed by its own thread, one by one, in the same order they were received,
+# so a slow command of one instrument does not delay the commands of the others.
+#-The threads of the instruments without requests are blocked waiting for them, so they do not use CPU.
+#If BREWFUNCT_INSTRUMENT is not defined, all the requests are executed by the same default instrument.
+instruments={} #{instrument identifier: Instrument}
+
+class Instrument(object):
+    '''
+    State of an instrument served by the daemon (see Multi-instrument mode).
+    <name> instrument identifier (the BREWFUNCT_INSTRUMENT of its requests, '' if not defined)
+    <cache> directories index of the instrument (see getdirindex)
+    <logstates> Brw_functions log states of the thread of the requests ('sync') and of the async worker ('async')
+    <requests>, <jobs> queues of the requests and of the async jobs (see queue_request), executed by their threads
+    '''
+    def __init__(self,name):
+        try:
+            import Queue as queue #python 2
+        except ImportError:
+            import queue #python 3
+        self.name=name
+        self.cache=newcache()
+        self.logstates={'sync':newlogstate(),'async':newlogstate()}
+        self.requests=queue.Queue()
+        self.jobs=queue.Queue()
+        self.threads={}
+
+    def start(self,role):
+        #Start the thread of the requests ('sync') or of the async worker ('async'), if it is not running.
+        import threading
+        if role not in self.threads:
+            target=request_worker if role=='sync' else async_worker
+            self.threads[role]=threading.Thread(target=target,args=(self,),name='Brw_functions_'+role+'_'+(self.name or 'default'))
+            self.threads[role].daemon=True
+            self.threads[role].start()
+
+def getinstrument(name):
+    #Return the Instrument <name>, creating it (and starting its thread) with its first request.
+    #The lines of the daemon itself are flushed at once, before the thread of the instrument logs its own lines.
+    if name not in instruments:
+        instruments[name]=Instrument(name)
+        add2log("Brw_functions.py, serve, serving the instrument '"+name+"'.")
+        flushlog()
+        instruments[name].start('sync')
+    return instruments[name]
+
+def stopinstrument(instrument):
+    #Finish the requests received and the queued commands of an <instrument>, and stop its thread.
+    instrument.requests.put(None)
+    instrument.threads['sync'].join()
+    wait_pending(None,instrument)
+    add2log("Brw_functions.py, serve, stopped serving the instrument '"+instrument.name+"'.")
+    flushlog()
+
+class RequestContext(object):
+    '''
+    with RequestContext(request,instrument,role='sync') as output:
+        ...
+
+    Execute the commands of the current thread in the context of the <request> (see execute_request): with its forwarded
+    environment variables and current working directory, and the state of the <instrument> (directories index and
+    Brw_functions log state of the given <role>, see Instrument). Everything written by add2log is captured into
+    <output> (StringIO). The process environment, current directory and sys.stdout are not modified, so several
+    requests can be executed at the same time by different threads.
+    '''
+    def __init__(self,request,instrument=None,role='sync'):
+        self.request=request
+        self.instrument=instrument
+        self.role=role
+
+    def __enter__(self):
+        import Brw_functions_client
+        try:
+            from StringIO import StringIO #python 2
+        except ImportError:
+            from io import StringIO #python 3
+        env=dict((k,v) for k,v in os.environ.items() if not Brw_functions_client.forwarded(k))
+        env.update(self.request['env'])
+        self.output=StringIO()
+        if self.instrument is None:
+            context=Context(env,self.request['cwd'] or None,self.output)
+        else:
+            context=Context(env,self.request['cwd'] or None,self.output,
+                            self.instrument.logstates[self.role],self.instrument.cache)
+        self.ident=get_ident()
+        contexts[self.ident]=context
+        return self.output
 
-add2log("-----------")
+    def __exit__(self,exc_type,exc_value,traceback):
+        del contexts[self.ident]
+        return False
 
+def execute_request(request,instrument=None):
+    '''
+    status, output = execute_request(request,instrument=None)
+
+    Execute a SHELL call forwarded by Brw_functions_client.py, as if it had been executed by a new python process:
+    the forwarded environment variables and current working directory are used while the command is executed,
+    and everything written into the stdout is captured and returned as <output> (see RequestContext).
+    If the command matches one of the BREWFUNCT_ASYNC patterns, it is queued to the background worker of the
+    <instrument>, and it returns immediately (see queue_request). Otherwise, it waits first for the queued commands
+    touching the same paths.
+    <request> dictionary with the keys 'cwd' (string), 'env' (dictionary) and 'args' (list of strings, sys.argv[1:])
+    '''
+    with RequestContext(request,instrument) as output:
+        arguments, command = parse_arguments(request['args'])
+        paths=getcommandpaths(arguments)
+        if instrument is not None and arguments[0].lower()!='wait' and matchasync(command):
+            return queue_request(request,paths,instrument)
+        getcontext().waited=wait_pending(paths,instrument)
+        startwatcher()
+        status=run_command(request['args'])
+    return status, output.getvalue()
+
+def request_worker(instrument):
+    #Thread of the requests of an <instrument>: execute them one by one, and send back their responses.
+    import Brw_functions_client
+    while True:
+        item=instrument.requests.get()
+        if item is None: #Shutdown
+            break
+        conn,request=item
+        try:
+            status,output=execute_request(request,instrument)
+            conn.send_bytes(Brw_functions_client.encode_response(status,output))
+        except Exception as e:
+            add2log("Brw_functions.py, serve, cannot process request of the instrument '"+instrument.name+"', exception happened: "+str(e),level="ERROR")
+        finally:
+            conn.close()
+
+
+
+#-----------------Async mode-----------------
+#Async mode (only in daemon mode):
+#The commands matching any of the patterns of the BREWFUNCT_ASYNC environment variable (DOS wildcards, separated
+#by ';', matched with the full command line, for example 'append *;copy *+* *') are not executed while PCBASIC waits:
+#they are queued to a background worker, and the SHELL call returns immediately.
+#-The queued commands are executed one by one, in the same order they were received, by the worker of the instrument.
+#-A later command that touches the same paths (files or directories) waits until the queued ones have finished.
+# The commands whose paths cannot be known (like setdate or look4duplicates) wait for all the queued commands of
+# their instrument.
+#-While there are queued commands of an instrument, the marker file .ASYNC.PND exists in its PROGRAM_PATH (hidden,
+# so it is not listed by the dir command, see Brw_dir.py).
+#-The command 'wait [path]' waits until the queued commands touching path (or all of them) have finished.
+#If the daemon is not running, the commands are always executed synchronously.
+asyncstate={'pending':[],'markers':{},'lock':None}
+
+def matchasync(command):
+    #True if the command line matches one of the BREWFUNCT_ASYNC patterns (only in daemon mode)
+    patterns=[i.strip() for i in getenv('BREWFUNCT_ASYNC','').split(';') if i.strip()!='']
+    if len(patterns)==0:
+        return False
+    import fnmatch
+    return len([i for i in patterns if fnmatch.fnmatch(command.lower(),i.lower())])>0
+
+def getcommandpaths(arguments,lowercase=True):
+    '''
+    paths = getcommandpaths(arguments,lowercase=True)
 
+    Absolute lowercase paths of the files and directories read or written by the command <arguments>,
+    or None if they cannot be known. <lowercase> if False, the paths keep the capitalization given in the arguments.
+    '''
+    name=COMMAND_ALIASES.get(arguments[0].lower(),arguments[0].lower())
+    if name in ['copy','append','noeof','md','wait']:
+        paths=sum([i.split('+') for i in arguments[1:]],[])
+        if name=='copy':
+            paths=[os.path.dirname(i) or '.' if '*' in i or '?' in i else i for i in paths]
+        if name=='noeof':
+            paths.append(os.path.join(checkpathformat(getenv('PROGRAM_PATH','')),'tmp.tmp'))
+        if name=='wait' and len([i for i in paths if i!=''])==0:
+            return None #wait for all
+    elif name=='dir':
+        paths=[]
+        for i in arguments[1:]:
+            if i.startswith('/'):
+                continue
+            i=i.lstrip('>')
+            if '*' in i or '?' in i:
+                i=os.path.dirname(i) or '.'
+            paths.append(i)
+    elif name=='cmd' or name not in COMMANDS:
+        return set()
+    else:
+        return None
+    paths=set([abspath2(replacedrive(checkpathformat(i),verbose=False)) for i in paths if i!=''])
+    return set([i.lower() for i in paths]) if lowercase else paths
+
+def pathsoverlap(paths1,paths2):
+    #True if any path of <paths1> is the same, or is inside, or contains any path of <paths2> (None means all paths)
+    if paths1 is None or paths2 is None:
+        return True
+    for i in paths1:
+        for j in paths2:
+            if i==j or i.startswith(os.path.join(j,'')) or j.startswith(os.path.join(i,'')):
+                return True
+    return False
+
+def queue_request(request,paths,instrument):
+    '''
+    status, output = queue_request(request,paths,instrument)
+
+    Queue the <request> to the background worker of the <instrument> (started with its first queued request), which
+    will execute it after the previously queued ones. <paths> paths touched by the command (see getcommandpaths).
+    '''
+    import threading
+    marker=os.path.join(request['env'].get('PROGRAM_PATH') or request['cwd'],'.ASYNC.PND')
+    job={'request':request,'paths':paths,'done':threading.Event(),'marker':marker,'instrument':instrument}
+    with asyncstate['lock']:
+        asyncstate['pending'].append(job)
+        asyncstate['markers'][marker]=asyncstate['markers'].get(marker,0)+1
+        if asyncstate['markers'][marker]==1:
+            try:
+                open(marker,'w').close()
+            except EnvironmentError:
+                pass
+    instrument.start('async')
+    instrument.jobs.put(job)
+    line="[INFO] [Brw_functions.py, queued command (async mode): '"+' '.join(request['args'])+"'.]"+newline
+    return 0, line
+
+def async_worker(instrument):
+    #Background worker of the async mode of an <instrument>: execute its queued requests, one by one.
+    while True:
+        job=instrument.jobs.get()
+        try:
+            with RequestContext(job['request'],instrument,'async') as output:
+                run_command(job['request']['args'])
+        except Exception as e:
+            add2log("Brw_functions.py, async_worker, cannot execute the queued command, exception happened: "+str(e),level="ERROR")
+        finally:
+            with asyncstate['lock']:
+                asyncstate['pending'].remove(job)
+                asyncstate['markers'][job['marker']]-=1
+                if asyncstate['markers'][job['marker']]==0:
+                    del asyncstate['markers'][job['marker']]
+                    try:
+                        os.remove(job['marker'])
+                    except EnvironmentError:
+                        pass
+            job['done'].set()
+
+def wait_pending(paths=None,instrument=None):
+    '''
+    njobs, seconds = wait_pending(paths=None,instrument=None)
+
+    Wait until the queued commands that touch any of the <paths> have finished (None means all of them).
+    If an <instrument> is given, the queued commands of other instruments are only waited if they touch the same
+    known paths, so a command of an instrument never waits for all the commands of the others.
+    <njobs> number of queued commands waited, <seconds> time waited.
+    '''
+    if asyncstate['lock'] is None:
+        return 0, 0.
+    t0=clock()
+    with asyncstate['lock']:
+        jobs=[job for job in asyncstate['pending'] if pathsoverlap(job['paths'],paths) and
+              (instrument is None or job['instrument'] is instrument or (job['paths'] is not None and paths is not None))]
+    for job in jobs:
+        job['done'].wait()
+    return len(jobs), clock()-t0
+
+def serve(address):
+    '''
+    Run Brw_functions as a long-lived daemon, listening on <address>: a Unix socket filepath in Linux,
+    or a named pipe in Windows (for example \\\\.\\pipe\\Brw_functions).
+    Every request sent by Brw_functions_client.py is passed to the thread of its instrument (see Multi-instrument
+    mode), which executes the requests of that instrument one by one, in the same order they are received
+    (except the ones queued to the background worker, in async mode).
+    The daemon finishes when a shutdown request is received (python Brw_functions_client.py --shutdown). If it is sent
+    by an instrument (with BREWFUNCT_INSTRUMENT defined) while other instruments are being served, only that
+    instrument is stopped.
+    '''
+    from multiprocessing.connection import Listener
+    import threading
+    import Brw_functions_client
+
+    if os.name != 'nt' and os.path.exists(address):
+        #Check if there is already a daemon listening on the same address, otherwise remove the stale socket file.
+        if Brw_functions_client.send_request(address,Brw_functions_client.encode_request(['--ping'])) is not None:
+            add2log("Brw_functions.py, serve, there is already a daemon listening on "+str(address),level="ERROR")
+            return 1
+        os.remove(address)
+
+    asyncstate['lock']=threading.Lock()
+    listener=Listener(address,backlog=16)
+    add2log("Brw_functions.py, serve, daemon listening on "+str(address))
+    flushlog()
+    try:
+        while True:
+            conn=listener.accept()
+            try:
+                request=Brw_functions_client.decode_request(conn.recv_bytes())
+            except Exception as e:
+                add2log("Brw_functions.py, serve, cannot process request, exception happened: "+str(e),level="ERROR")
+                flushlog()
+                conn.close()
+                continue
+            if request['args'] in [['--shutdown'],['--ping']]:
+                stop=False
+                if request['args']==['--shutdown']:
+                    #The shutdown of an instrument only stops the daemon if no other instrument is being served
+                    name=request['env'].get('BREWFUNCT_INSTRUMENT','')
+                    stop=name=='' or len([i for i in instruments if i!=name])==0
+                    for i in (list(instruments) if stop else [name] if name in instruments else []):
+                        stopinstrument(instruments.pop(i))
+                    if stop:
+                        wait_pending()
+                try:
+                    conn.send_bytes(Brw_functions_client.encode_response(0,''))
+                except Exception as e:
+                    add2log("Brw_functions.py, serve, cannot process request, exception happened: "+str(e),level="ERROR")
+                    flushlog()
+                finally:
+                    conn.close()
+                if stop:
+                    break
+                continue
+            getinstrument(request['env'].get('BREWFUNCT_INSTRUMENT','')).requests.put((conn,request))
+    finally:
+        listener.close()
+    add2log("Brw_functions.py, serve, daemon stopped.")
+    flushlog()
+    return 0
+
+def main(ini_arguments):
+    if len(ini_arguments)>0 and ini_arguments[0]=="--batch": #Example 'python Brw_functions.py --batch commands.txt'
+        if len(ini_arguments)>1 and ini_arguments[1]!='-':
+            with open(ini_arguments[1],'r') as f:
+                return run_batch(f)
+        return run_batch(sys.stdin) #Example 'printf "setdate\nlook4duplicates\n" | python Brw_functions.py --batch'
+    if len(ini_arguments)>0 and ini_arguments[0]=="--daemon": #Example 'python Brw_functions.py --daemon'
+        if len(ini_arguments)>1:
+            address=ini_arguments[1]
+        else:
+            address=os.environ.get('BREWFUNCT_SOCKET','')
+        if address=='':
+            add2log("Brw_functions.py, cannot start the daemon, BREWFUNCT_SOCKET not found as an environment variable.",level="ERROR")
+            return 1
+        return serve(address)
+    #SHELL call: the exit status is always 0, as the PCBASIC SHELL callers expect (the failures are only reported in
+    #the log file and the metrics, see run_command)
+    run_command(ini_arguments)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
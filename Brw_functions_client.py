@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+#Thin client shim of the Brw_functions daemon.
+
+#It forwards the arguments of a SHELL call, the environment variables needed by Brw_functions (PROGRAM_PATH, MOUNT_C,
+#MOUNT_D, BREWFUNCT_LOG_DIR, BREWFUNCT_INSTRUMENT...) and the current working directory to the Brw_functions daemon, listening
+#in the address given by the BREWFUNCT_SOCKET environment variable, and writes back the daemon output into sys.stdout.
+#If BREWFUNCT_SOCKET is not defined, or the daemon is not running (or it does not answer in TIMEOUT seconds), the command
+#is executed by this same process (as if the PCBASIC launcher were pointing directly to Brw_functions.py).
+
+#To redirect the PCBASIC shell calls through this script, the PCBASIC launcher must have the option
+#--shell="python C:\...\Brw_functions_client.py", and the daemon must have been started before PCBASIC with:
+#python C:\...\Brw_functions.py --daemon
+
+#Only the modules needed to talk with the daemon are imported, to keep the startup of this script as fast as possible.
+
+import sys
+import os
+
+TIMEOUT=120. #Seconds to wait for the answer of the daemon, before executing the command in this same process
+
+#Environment variables forwarded to the daemon: these ones, and all the ones starting with FORWARDED_PREFIX
+FORWARDED_ENV=['PROGRAM_PATH','MOUNT_C','MOUNT_D']
+FORWARDED_PREFIX='BREWFUNCT_'
+
+def forwarded(key):
+    #True if the environment variable <key> is forwarded to the daemon
+    return key in FORWARDED_ENV or key.startswith(FORWARDED_PREFIX)
+
+
+#-----------------Protocol---------------
+#Every message is sent as a 4 bytes big-endian length, followed by the message itself (the same framing used by
+#multiprocessing.connection, which is used by the daemon). The messages are a list of 'key=value' records,
+#separated by null characters.
+def _encode(s):
+    if isinstance(s,bytes):
+        return s #python 2 str
+    return s.encode('utf-8','surrogateescape')
+
+def _decode(b):
+    if isinstance(b,str):
+        return b #python 2 str
+    return b.decode('utf-8','surrogateescape')
+
+def encode_request(args,cwd='',env=None):
+    records=['cwd='+cwd]
+    if env is not None:
+        records+=['env='+k+'='+env[k] for k in sorted(env) if forwarded(k)]
+    records+=['arg='+i for i in args]
+    return b'\x00'.join([_encode(i) for i in records])
+
+def decode_request(message):
+    request={'cwd':'','env':{},'args':[]}
+    for record in _decode(message).split('\x00'):
+        key,value=record.split('=',1)
+        if key=='cwd':
+            request['cwd']=value
+        elif key=='env':
+            k,v=value.split('=',1)
+            request['env'][k]=v
+        elif key=='arg':
+            request['args'].append(value)
+    return request
+
+def encode_response(status,output):
+    return _encode('status='+str(status)+'\x00'+'output='+output)
+
+def decode_response(message):
+    status,output=_decode(message).split('\x00',1)
+    return int(status.split('=',1)[1]),output.split('=',1)[1]
+
+def _recvall(s,n):
+    data=b''
+    while len(data)<n:
+        chunk=s.recv(n-len(data))
+        if not chunk:
+            raise EOFError("connection closed by the daemon")
+        data+=chunk
+    return data
+
+def send_request(address,message):
+    '''
+    response = send_request(address,message)
+
+    Send the encoded <message> to the daemon listening on <address>, and return the encoded response.
+    If it is not possible to connect to the daemon, or it closes the connection or does not answer in <TIMEOUT>
+    seconds, None is returned.
+    '''
+    import struct
+    if os.name=='nt': #Named pipe
+        try:
+            from multiprocessing.connection import Client
+            conn=Client(address)
+        except Exception:
+            return None
+        try:
+            conn.send_bytes(message)
+            if not conn.poll(TIMEOUT):
+                return None
+            return conn.recv_bytes()
+        except (EOFError,OSError,IOError):
+            return None
+        finally:
+            conn.close()
+    else: #Unix socket (the _socket module is used instead of socket, because it is much faster to import)
+        import _socket
+        s=_socket.socket(_socket.AF_UNIX,_socket.SOCK_STREAM)
+        try:
+            s.settimeout(TIMEOUT)
+            s.connect(address)
+            s.sendall(struct.pack('!i',len(message))+message)
+            n,=struct.unpack('!i',_recvall(s,4))
+            return _recvall(s,n)
+        except (EOFError,OSError,IOError,_socket.error,_socket.timeout): #(socket.error is not an OSError in python 2)
+            return None
+        finally:
+            s.close()
+
+
+#-----------------Main---------------
+def run_inprocess(args):
+    #Fallback: execute the command in this same process
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import Brw_functions
+    return Brw_functions.main(args)
+
+def main(args):
+    address=os.environ.get('BREWFUNCT_SOCKET','')
+    if address=='':
+        return run_inprocess(args)
+    if args in [['--shutdown'],['--ping']]: #Example 'python Brw_functions_client.py --shutdown'
+        response=send_request(address,encode_request(args,'',os.environ)) #BREWFUNCT_INSTRUMENT is needed by --shutdown
+        if response is None:
+            sys.stdout.write("Brw_functions daemon is not running at "+address+"\n")
+            return 1
+        return 0
+    response=send_request(address,encode_request(args,os.getcwd(),os.environ))
+    if response is None: #The daemon is down, or it has not answered
+        return run_inprocess(args)
+    status,output=decode_response(response)
+    sys.stdout.write(output)
+    return 0 #As Brw_functions.py, the SHELL calls always exit with 0 (the failures are in the log file and the metrics)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
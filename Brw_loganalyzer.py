@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+#Analyzer of the Brw_functions log files (Brw_functions_log_YYYYMMDD.txt, and the rotated .gz ones) and of the
+#PCBASIC session log files written with --debug=True (pcbasic_brewer_log_III_YYYYMMDDTHHMMSSZ.txt)
+
+#The log files are read line by line, through a chain of generators, so they are never loaded into memory:
+# read_lines (lines of a file, also .gz) -> parse_lines ((timestamp, level, message) of every add2log line)
+# -> pair_commands (every 'received arguments' line paired with its following '-----------' line).
+#For every instrument and day, it counts the SHELL commands, their durations (when the lines have timestamps), and the
+#WARNING and ERROR lines, classified in categories (see CATEGORIES), in total and by command.
+#The log files are analyzed in parallel by a pool of processes (one file per task), and the results are merged at the end.
+
+#The instrument of a log file is taken from the PCBASIC log filenames, or from the name of the folder of the
+#Brw_functions log files, or of its parent folder if it is called 'logs' (it can be given with --instrument).
+
+#Example of use:
+#   python Brw_loganalyzer.py /home/brewer/logs/*/ --json=summary.json --csv=summary.csv
+
+
+import sys
+import os
+import re
+import json
+import gzip
+import argparse
+
+#Categories of the log lines: (category, substring of the message)
+CATEGORIES=[('not_found',"not found"),
+            ('case_mismatch',"different case matching"),
+            ('duplicates',"found duplicated files"),
+            ('exception',"xception happened"),
+            ('unrecognized',"Ignored unrecognized shell command")]
+
+LINE=re.compile(r"(?:\[(\d{8})T(\d{6}\.\d+)Z?\] )?\[(INFO|WARNING|ERROR)\] \[(.*)\]\s*$")
+RECEIVED=re.compile(r"received arguments: .*, command: '(.*)'\.$")
+LOGDAY=re.compile(r"_(\d{8})(?:T\d{6}Z?)?(?:_\d+)?\.txt(?:\.gz)?$")
+PCBASICLOG=re.compile(r"pcbasic_brewer_log_(\w+?)_\d{8}")
+
+
+#-----------------Generators---------------
+def read_lines(path):
+    #Lines of the log file <path> (compressed or not), one by one.
+    if path.endswith('.gz'):
+        f=gzip.open(path,'rb')
+    else:
+        f=open(path,'rb')
+    try:
+        for line in f:
+            yield line.decode('utf-8','replace')
+    finally:
+        f.close()
+
+def parse_lines(lines,day=''):
+    '''
+    Generator of the (day, time, level, message) of the add2log lines of <lines>.
+    <day> 'YYYYMMDD' used for the lines without timestamp (like the ones of the PCBASIC log files).
+    <time> 'HHMMSS.ff' or '' if the line has no timestamp.
+    '''
+    for line in lines:
+        m=LINE.search(line)
+        if m:
+            yield (m.group(1) or day,m.group(2) or '',m.group(3),m.group(4))
+
+def seconds(t):
+    #Seconds of the day of a 'HHMMSS.ff' time
+    return int(t[:2])*3600+int(t[2:4])*60+float(t[4:])
+
+def pair_commands(events):
+    '''
+    Generator of the SHELL commands of the parsed log lines <events> (see parse_lines), pairing every
+    'received arguments' line with its following '-----------' line. The lines outside of a command are
+    yielded as commands with name None.
+    Every command is a dictionary {'day','command','name','paired','seconds','levels':{level: n},'categories':{category: n}}
+    <paired> False if its '-----------' line was not found (the log was cut, or another command started before).
+    <seconds> duration of the command, or None if it is not paired or the lines have no timestamps.
+    '''
+    current=None
+    for day,t,level,message in events:
+        received=RECEIVED.search(message)
+        if received or message=='-----------':
+            if current is not None and current['name'] is not None:
+                if message=='-----------':
+                    current['paired']=True
+                    if current['t']!='' and t!='':
+                        current['seconds']=(seconds(t)-seconds(current['t']))%86400
+                yield current
+            elif current is not None:
+                yield current
+            current=None
+            if received:
+                command=received.group(1)
+                current={'day':day,'t':t,'command':command,'name':(command.split(' ')[0].lower() if command.strip()!='' else ''),
+                         'paired':False,'seconds':None,'levels':{},'categories':{}}
+            continue
+        if current is None:
+            current={'day':day,'t':t,'command':None,'name':None,'paired':False,'seconds':None,'levels':{},'categories':{}}
+        current['levels'][level]=current['levels'].get(level,0)+1
+        for category,substring in CATEGORIES:
+            if substring in message:
+                current['categories'][category]=current['categories'].get(category,0)+1
+    if current is not None:
+        yield current
+
+
+#-----------------Summary---------------
+def newstats():
+    return {'calls':0,'unpaired':0,'durations':[],'levels':{},'categories':{}}
+
+def addstats(stats,command):
+    if command['name'] is not None:
+        stats['calls']+=1
+        if not command['paired']:
+            stats['unpaired']+=1
+        if command['seconds'] is not None:
+            stats['durations'].append(command['seconds'])
+    for key in ['levels','categories']:
+        for k,v in command[key].items():
+            stats[key][k]=stats[key].get(k,0)+v
+
+def mergestats(stats,other):
+    stats['calls']+=other['calls']
+    stats['unpaired']+=other['unpaired']
+    stats['durations']+=other['durations']
+    for key in ['levels','categories']:
+        for k,v in other[key].items():
+            stats[key][k]=stats[key].get(k,0)+v
+
+def getinstrument(path):
+    #Instrument of a log file: from the PCBASIC log filename, or the name of its folder
+    m=PCBASICLOG.search(os.path.basename(path))
+    if m:
+        return m.group(1)
+    dirpath=os.path.dirname(os.path.abspath(path))
+    if os.path.basename(dirpath).lower() in ['log','logs']: #like <instrument>/logs/
+        dirpath=os.path.dirname(dirpath)
+    return os.path.basename(dirpath)
+
+def analyze(job):
+    '''
+    summary = analyze((path,instrument))
+
+    Analyze the log file <path>. <instrument> if '', it is taken from the path (see getinstrument).
+    <summary> dictionary {instrument: {day: {command name ('' for all): stats}}}, where stats is a dictionary
+     {'calls','unpaired','durations':[seconds],'levels':{level: n},'categories':{category: n}}
+    '''
+    path,instrument=job
+    instrument=instrument or getinstrument(path)
+    m=LOGDAY.search(os.path.basename(path))
+    days={}
+    for command in pair_commands(parse_lines(read_lines(path),m.group(1) if m else '')):
+        names=days.setdefault(command['day'],{})
+        addstats(names.setdefault('',newstats()),command)
+        if command['name'] is not None:
+            addstats(names.setdefault(command['name'],newstats()),command)
+    return {instrument:days}
+
+def merge(summaries):
+    #Merge the summaries of several log files (see analyze)
+    total={}
+    for summary in summaries:
+        for instrument,days in summary.items():
+            for day,names in days.items():
+                for name,stats in names.items():
+                    mergestats(total.setdefault(instrument,{}).setdefault(day,{}).setdefault(name,newstats()),stats)
+    return total
+
+def percentile(values,p):
+    #Nearest-rank percentile <p> (0-100) of the sorted <values>
+    return values[max(0,min(len(values)-1,int(round(p/100.*len(values)+0.5))-1))]
+
+def finish(stats):
+    #Replace the list of durations of <stats> by their statistics
+    durations=sorted(stats.pop('durations'))
+    stats['seconds']={'total':sum(durations),'mean':sum(durations)/len(durations),'p50':percentile(durations,50),
+                      'p95':percentile(durations,95),'max':durations[-1]} if len(durations)>0 else None
+    return stats
+
+def findlogs(paths):
+    #Log files of the given files and folders
+    logs=[]
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath,dirnames,filenames in os.walk(path):
+                logs+=[os.path.join(dirpath,i) for i in sorted(filenames) if LOGDAY.search(i) and
+                       (i.startswith('Brw_functions_log_') or i.startswith('pcbasic_brewer_log_'))]
+        else:
+            logs.append(path)
+    return logs
+
+def writecsv(path,summary):
+    #One row for every instrument, day and command ('' for all the commands of the day)
+    columns=['instrument','day','command','calls','unpaired','seconds_total','seconds_mean','seconds_p50','seconds_p95',
+             'seconds_max','info','warnings','errors']+[i[0] for i in CATEGORIES]
+    with open(path,'w') as f:
+        f.write(','.join(columns)+'\n')
+        for instrument in sorted(summary):
+            for day in sorted(summary[instrument]):
+                for name in sorted(summary[instrument][day]):
+                    stats=summary[instrument][day][name]
+                    s=stats['seconds'] or {}
+                    row=[instrument,day,name,stats['calls'],stats['unpaired']]
+                    row+=[('%.6f' % s[k]) if k in s else '' for k in ['total','mean','p50','p95','max']]
+                    row+=[stats['levels'].get(k,0) for k in ['INFO','WARNING','ERROR']]
+                    row+=[stats['categories'].get(i[0],0) for i in CATEGORIES]
+                    f.write(','.join(['"'+str(i).replace('"','""')+'"' if ',' in str(i) else str(i) for i in row])+'\n')
+
+
+#-----------------Main---------------
+def main(ini_arguments):
+    parser=argparse.ArgumentParser(description="Analyzer of the Brw_functions and PCBASIC session log files")
+    parser.add_argument('paths',nargs='+',help="log files, or folders with log files")
+    parser.add_argument('--instrument',default='',help="instrument of all the log files (default: from the filename or folder)")
+    parser.add_argument('--processes',type=int,default=0,help="number of processes (default: number of CPUs)")
+    parser.add_argument('--json',default='',help="JSON file where to save the summary")
+    parser.add_argument('--csv',default='',help="CSV file where to save the summary")
+    args=parser.parse_args(ini_arguments)
+
+    logs=findlogs(args.paths)
+    jobs=[(i,args.instrument) for i in logs]
+    if len(jobs)>1 and args.processes!=1:
+        from multiprocessing import Pool
+        pool=Pool(args.processes or None)
+        try:
+            summary=merge(pool.imap_unordered(analyze,jobs))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        summary=merge([analyze(i) for i in jobs])
+    for instrument in summary:
+        for day in summary[instrument]:
+            for name in summary[instrument][day]:
+                finish(summary[instrument][day][name])
+
+    for instrument in sorted(summary):
+        for day in sorted(summary[instrument]):
+            stats=summary[instrument][day]['']
+            sys.stdout.write(instrument+" "+day+": "+str(stats['calls'])+" commands"+
+                             (", p95 "+('%.1f' % (1000*stats['seconds']['p95']))+" ms" if stats['seconds'] else "")+", "+
+                             str(stats['levels'].get('WARNING',0))+" warnings, "+str(stats['levels'].get('ERROR',0))+" errors"+
+                             ''.join([", "+str(v)+" "+k for k,v in sorted(stats['categories'].items())])+"\n")
+    if args.json!='':
+        with open(args.json,'w') as f:
+            json.dump(summary,f,indent=1,sort_keys=True)
+        sys.stdout.write("Summary saved at "+args.json+"\n")
+    if args.csv!='':
+        writecsv(args.csv,summary)
+        sys.stdout.write("Summary saved at "+args.csv+"\n")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
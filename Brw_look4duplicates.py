@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+#look4duplicates command of Brw_functions.py: look for files with the same name but different capitalization.
+#Example of use: python Brw_functions.py look4duplicates [path] [/s] [--json=report.json] [--resolve]
+
+#This module is only imported by Brw_functions.py when the look4duplicates command is dispatched (see COMMANDS).
+
+import os
+import json
+from Brw_functions import add2log, checkpathformat, replacedrive, exists2, scandir2, open2, AtomicFile, getcontext, getenv, getcwd, abspath2, incontext
+
+
+def shell_look4duplicates(arguments):
+    #Example ['look4duplicates', 'C:\\brw#072', '/s', '--json=report.json', '--resolve']
+    options=[i for i in arguments[1:] if i.startswith('--') or i.lower()=='/s']
+    paths=[i for i in arguments[1:] if i!='' and i not in options]
+    report=[i[7:] for i in options if i.lower().startswith('--json=')]
+    return look4duplicates(replacedrive(paths[0]) if len(paths)>0 else '', #Check for duplicates in given path, or in current path
+                           recursive=len([i for i in options if i.lower() in ['/s','--recursive']])>0,
+                           report=replacedrive(report[0]) if len(report)>0 else '',
+                           resolve='--resolve' in [i.lower() for i in options])
+
+def look4duplicates(path,recursive=False,report='',resolve=False):
+    '''
+    look for duplicated files in the specified path (Same file names but with different capitalization) (Only for linux OS)
+    When using linux, it is recommended to run this function before starting the brewer software,
+    just to check that there are not duplicated files with same name but with different capitalization in the working folders.
+    If this function detects duplicated files, an ERROR message will be written in the Brw_functions log file.
+    The user must research why these files are being duplicated.
+    Known cases:
+    -DIR.TMP and dir.tmp
+    -tmp.tmp and TMP.TMP
+    In these known cases, you could fix it by simply deleting both files. (they will be re-generated by the brewer software)
+
+    <recursive> if True, the subdirectories are also checked. If no path is given, the PROGRAM_PATH and the
+     bdata folder (from OP_ST.FIL) trees are checked. The subtrees are scanned in parallel by a pool of threads.
+    <report> if given, filepath of a JSON file where to write the found groups of duplicated files, with the size
+     and modification time of every file: [{"dir": path, "files": [{"name":..., "size":..., "mtime":...}, ...]}, ...]
+    <resolve> if True, only the newest file of every group of duplicated files is kept, the others are deleted.
+    '''
+    if path=='':
+        if recursive and getenv('PROGRAM_PATH') is not None:
+            roots=[checkpathformat(getenv('PROGRAM_PATH')),getbdatadir()]
+        else:
+            roots=[getcwd()]
+    else:
+        roots=[path]
+    #Remove the roots already included in other roots
+    roots=[os.path.realpath(abspath2(i)) for i in roots if i!='']
+    roots=[i for i in roots if len([j for j in roots if i!=j and i.startswith(os.path.join(j,''))])==0]
+    roots=sorted(set(roots))
+
+    if not recursive:
+        groups=[]
+        for root in roots:
+            groups+=findduplicates(root)
+    else:
+        #Each subtree is scanned by a different thread
+        from multiprocessing.pool import ThreadPool
+        jobs=[]
+        for root in roots:
+            jobs.append((root,False))
+            for entry in scandir2(root):
+                if entry.is_dir() and not entry.is_symlink():
+                    jobs.append((entry.path,True))
+        pool=ThreadPool(min(8,max(1,len(jobs))))
+        try:
+            groups=sum(pool.map(incontext(lambda job: findduplicates(job[0],job[1])),jobs),[])
+        finally:
+            pool.close()
+
+    for group in groups:
+        add2log("Brw_functions.py, look4duplicates, !!!! found duplicated files in "+str(group['dir'])+": "+str([i['name'] for i in group['files']]),level="ERROR")
+        if resolve:
+            newest=max(group['files'],key=lambda x: x['mtime'])
+            for i in group['files']:
+                if i is not newest:
+                    try:
+                        os.remove(os.path.join(group['dir'],i['name']))
+                        getcontext().metrics['files'].add(os.path.join(group['dir'],i['name']))
+                        i['removed']=True
+                        add2log("Brw_functions.py, look4duplicates, removed "+os.path.join(group['dir'],i['name'])+", keeping the newest file "+newest['name'],level="WARNING")
+                    except Exception as e:
+                        add2log("Brw_functions.py, look4duplicates, cannot remove "+os.path.join(group['dir'],i['name'])+", exception happened: "+str(e),level="ERROR")
+    if len(groups)==0:
+        add2log("Brw_functions.py, look4duplicates, none duplicated file found in "+', '.join(roots)+(" (recursive)" if recursive else ""),level="INFO")
+
+    if report!='':
+        with AtomicFile(report,'w') as af:
+            json.dump(groups,af.file,indent=1)
+        add2log("Brw_functions.py, look4duplicates, report saved at "+report)
+    return groups
+
+def findduplicates(path,recursive=False):
+    '''
+    groups = findduplicates(path,recursive=False)
+
+    Find the groups of files with the same name but different capitalization in the directory <path>
+    (and in its subdirectories, if <recursive> is True), in a single pass by directory.
+    <groups> list of dictionaries {"dir": path, "files": [{"name":..., "size":..., "mtime":...}, ...]}
+    '''
+    groups=[]
+    dirs=[path]
+    while len(dirs)>0:
+        dirpath=dirs.pop()
+        names={} #{lowercase name: [entries]}
+        try:
+            entries=list(scandir2(dirpath))
+        except OSError as e:
+            add2log("Brw_functions.py, look4duplicates, cannot list "+str(dirpath)+", exception happened: "+str(e),level="WARNING")
+            continue
+        for entry in entries:
+            names.setdefault(entry.name.lower(),[]).append(entry)
+            if recursive and entry.is_dir() and not entry.is_symlink():
+                dirs.append(entry.path)
+        for key in names:
+            if len(names[key])>1:
+                files=[]
+                for entry in names[key]:
+                    st=entry.stat()
+                    files.append({"name":entry.name,"size":st.st_size,"mtime":st.st_mtime})
+                groups.append({"dir":dirpath,"files":files})
+    return groups
+
+def getbdatadir():
+    #Get the bdata folder from the second line of PROGRAM_PATH/OP_ST.FIL ('' if not found)
+    if getenv('PROGRAM_PATH') is not None:
+        [exist], [realfilepath], [realfilename] = exists2([os.path.join(checkpathformat(getenv('PROGRAM_PATH')),'OP_ST.FIL')],warn=False)
+        if exist:
+            with open2(realfilepath,'r') as f:
+                opstfil_content=f.read().split()
+            if len(opstfil_content)>1:
+                return replacedrive(opstfil_content[1])
+    return ''
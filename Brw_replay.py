@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+#Replay of real SHELL call workloads against Brw_functions.py
+
+#The SHELL calls are taken from the traces recorded by Brw_functions.py (BREWFUNCT_TRACE_DIR environment variable,
+#files Brw_functions_trace_YYYYMMDD.jsonl), or extracted from the Brw_functions log files
+#(Brw_functions_log_YYYYMMDD.txt) and the PCBASIC session log files written with --debug=True (extract command).
+
+#The replay command copies the folder tree used by the SHELL calls into a sandbox (one for every Brw_functions version
+#to compare), and runs the calls on it in the same order they were recorded, as PCBASIC does (a new python interpreter
+#for every SHELL call): back to back (--speed=max, default), or keeping the recorded intervals between the calls,
+#divided by the --speed factor. The paths of the calls (arguments, current directory, PROGRAM_PATH, MOUNT_C, MOUNT_D)
+#are moved from the recorded --root folder into the sandbox.
+#It reports the throughput and latency percentiles of every version, the calls whose input files did not match the
+#recorded ones, and the calls whose exit status or written files differ from the first version.
+
+#Examples of use:
+#   python Brw_replay.py extract C:\Temp\Brw_functions_log_20201012.txt --program-path=C:\brw#072\Prog410 --mount-c=C:\ --output=trace.jsonl
+#   python Brw_replay.py replay trace.jsonl --root=/home/brewer --tree=/home/brewer_copy --versions=/opt/PCBREWER_old,/opt/PCBREWER --output=replay.json
+
+
+import sys
+import os
+import re
+import time
+import json
+import zlib
+import shutil
+import tempfile
+import argparse
+import datetime
+import subprocess
+
+BRWFUNCT_DIR=os.path.dirname(os.path.abspath(__file__))
+
+
+#-----------------Traces---------------
+def read_traces(paths):
+    '''
+    records = read_traces(paths)
+
+    Read the SHELL calls of the trace files <paths> (.jsonl, see the trace recorder of Brw_functions.py), sorted by time.
+    '''
+    records=[]
+    for path in paths:
+        with open(path,'r') as f:
+            for line in f:
+                if line.strip()!='':
+                    records.append(json.loads(line))
+    records.sort(key=lambda x: x['t'])
+    return records
+
+RECEIVED=re.compile(r"Brw_functions\.py, received arguments: .*, command: '(.*)'\.\]")
+TIMESTAMP=re.compile(r"\[(\d{8}T\d{6}\.\d+)Z?\]")
+
+def extract(paths,env,cwd):
+    '''
+    records = extract(paths,env,cwd)
+
+    Extract the SHELL calls from the Brw_functions log files or PCBASIC session log files <paths>, as trace records
+    (see the trace recorder of Brw_functions.py). The logs do not have the environment variables, current directory
+    and input files of the calls, so the given <env> (dictionary) and <cwd> are used for all of them.
+    The log files can be compressed (.gz, see the log rotation of Brw_functions.py), and are read as Brw_loganalyzer.py
+    does.
+    The duration of a call is the time until its '-----------' line, if the lines have timestamps.
+    '''
+    sys.path.insert(0,BRWFUNCT_DIR)
+    import Brw_loganalyzer
+    records=[]
+    for path in paths:
+        last=None
+        for line in Brw_loganalyzer.read_lines(path):
+            ts=TIMESTAMP.search(line)
+            t=None
+            if ts:
+                dt=datetime.datetime.strptime(ts.group(1),'%Y%m%dT%H%M%S.%f')
+                t=time.mktime(dt.timetuple())+dt.microsecond/1e6
+            received=RECEIVED.search(line)
+            if received:
+                last={'t':t if t is not None else float(len(records)),'args':[received.group(1).replace('\\r','\r').replace('\\n','\n')],
+                      'cwd':cwd,'env':dict(env),'inputs':[]}
+                records.append(last)
+            elif '[-----------]' in line and last is not None:
+                if t is not None:
+                    last['seconds']=round(t-last['t'],6)
+                last=None
+    records.sort(key=lambda x: x['t'])
+    return records
+
+
+#-----------------Replay---------------
+def crc32(path):
+    crc=0
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1024*1024),b''):
+            crc=zlib.crc32(block,crc)
+    return crc & 0xffffffff
+
+def snapshot(root,previous=None):
+    '''
+    files = snapshot(root,previous=None)
+
+    Dictionary {relative filepath: [size, mtime, crc32]} of the files of the <root> tree. The crc32 of the files
+    that have not changed since the <previous> snapshot are not computed again.
+    '''
+    files={}
+    for dirpath,dirnames,filenames in os.walk(root):
+        for name in filenames:
+            path=os.path.join(dirpath,name)
+            try:
+                st=os.stat(path)
+            except OSError:
+                continue
+            key=os.path.relpath(path,root)
+            if previous is not None and key in previous and previous[key][:2]==[st.st_size,st.st_mtime]:
+                files[key]=previous[key]
+            else:
+                files[key]=[st.st_size,st.st_mtime,crc32(path)]
+    return files
+
+def changes(before,after):
+    #Sorted list of the [filepath, size, crc32] of the files whose contents changed between two snapshots
+    #([filepath, None, None] if deleted). The files rewritten with the same contents are not included.
+    changed=[[k,after[k][0],after[k][2]] for k in after if k not in before or before[k][0::2]!=after[k][0::2]]
+    changed+=[[k,None,None] for k in before if k not in after]
+    return sorted(changed)
+
+def replay(records,version,root,tree,sandboxroot,python=sys.executable,speed=None,check=True):
+    '''
+    result = replay(records,version,root,tree,sandboxroot,python=sys.executable,speed=None,check=True)
+
+    Run the SHELL calls <records> with the Brw_functions.py of the folder <version>, in a sandbox copy of <tree>
+    into <sandboxroot> (which must not exist). The same <sandboxroot> must be used for all the versions to compare,
+    since the written files can contain its path (like the dir outputs).
+    <root> recorded folder that corresponds to the sandbox (its paths in the calls are replaced by the sandbox ones).
+    <speed> None to run the calls back to back, or factor to divide the recorded intervals between the calls.
+    <check> if True, the files written by every call are checked (not counted in its latency).
+    <result> dictionary {'latencies': [seconds], 'statuses': [status], 'changes': [[[filepath, size, crc32], ...]],
+     'input_mismatches': [index of the calls whose input files differ from the recorded ones],
+     'elapsed': seconds (without the time spent checking the files)}
+    '''
+    shutil.copytree(tree,sandboxroot,symlinks=True)
+    root=os.path.join(os.path.normpath(root),'')
+    def move(s):
+        return s.replace(root,os.path.join(sandboxroot,'')).replace(root[:-1],sandboxroot)
+    result={'latencies':[],'statuses':[],'changes':[],'input_mismatches':[],'elapsed':0.}
+    files=snapshot(sandboxroot) if check else None
+    checktime=0.
+    t0=time.time()
+    for i,record in enumerate(records):
+        if speed is not None:
+            delay=t0+(record['t']-records[0]['t'])/speed-time.time()
+            if delay>0:
+                time.sleep(delay)
+        t=time.time()
+        for path,size,crc in record.get('inputs',[]):
+            path=move(path)
+            if not os.path.isfile(path) or os.path.getsize(path)!=size or crc32(path)!=crc:
+                result['input_mismatches'].append(i)
+                break
+        checktime+=time.time()-t
+        env=dict((k,v) for k,v in os.environ.items() if not k.startswith('BREWFUNCT_'))
+        env.update(dict((k,move(v)) for k,v in record.get('env',{}).items()))
+        cwd=move(record['cwd'] or record.get('env',{}).get('PROGRAM_PATH',root))
+        t=time.time()
+        with open(os.devnull,'w') as devnull:
+            status=subprocess.call([python,os.path.join(version,'Brw_functions.py')]+[move(a) for a in record['args']],
+                                   cwd=cwd if os.path.isdir(cwd) else sandboxroot,env=env,stdout=devnull)
+        result['latencies'].append(time.time()-t)
+        result['statuses'].append(status)
+        if check:
+            t=time.time()
+            after=snapshot(sandboxroot,files)
+            result['changes'].append(changes(files,after))
+            files=after
+            checktime+=time.time()-t
+    result['elapsed']=time.time()-t0-checktime
+    return result
+
+def commandname(args):
+    #Name of the command of the SHELL call arguments <args>. Example ['/C', 'copy a b'] -> 'copy'
+    words=[w for a in args for w in a.split(' ') if w not in ['','/C']]
+    return words[0].lower() if len(words)>0 else ''
+
+def percentile(values,p):
+    #Nearest-rank percentile <p> (0-100) of <values>
+    values=sorted(values)
+    return values[max(0,min(len(values)-1,int(round(p/100.*len(values)+0.5))-1))]
+
+def summary(records,result):
+    '''
+    Throughput and latency percentiles (seconds) of a replay <result>, in total and for every command.
+    '''
+    def stats(latencies):
+        return {'n':len(latencies),'p50':percentile(latencies,50),'p90':percentile(latencies,90),
+                'p99':percentile(latencies,99),'max':max(latencies)}
+    commands={}
+    for record,latency in zip(records,result['latencies']):
+        commands.setdefault(commandname(record['args']),[]).append(latency)
+    return {'throughput':len(result['latencies'])/result['elapsed'] if result['elapsed']>0 else 0.,
+            'busy_throughput':len(result['latencies'])/sum(result['latencies']) if sum(result['latencies'])>0 else 0.,
+            'total':stats(result['latencies']),
+            'commands':dict((k,stats(v)) for k,v in commands.items()),
+            'input_mismatches':len(result['input_mismatches']),
+            'errors':len([i for i in result['statuses'] if i!=0])}
+
+def differences(records,reference,result):
+    #Calls whose exit status or written files differ between two replay results.
+    diffs=[]
+    for i,record in enumerate(records):
+        if reference['statuses'][i]!=result['statuses'][i]:
+            diffs.append({'index':i,'args':record['args'],'status':[reference['statuses'][i],result['statuses'][i]]})
+        elif len(reference['changes'])>i and reference['changes'][i]!=result['changes'][i]:
+            diffs.append({'index':i,'args':record['args'],'changes':[reference['changes'][i],result['changes'][i]]})
+    return diffs
+
+
+#-----------------Main---------------
+def main(ini_arguments):
+    parser=argparse.ArgumentParser(description="Replay of real SHELL call workloads against Brw_functions.py")
+    subparsers=parser.add_subparsers(dest='action')
+    p=subparsers.add_parser('extract',help="extract the SHELL calls from Brw_functions or PCBASIC log files, into a trace file")
+    p.add_argument('logs',nargs='+',help="log files")
+    p.add_argument('--program-path',default=os.environ.get('PROGRAM_PATH',''),help="PROGRAM_PATH of the calls (also used as their current directory)")
+    p.add_argument('--mount-c',default=os.environ.get('MOUNT_C',''),help="MOUNT_C of the calls")
+    p.add_argument('--mount-d',default=os.environ.get('MOUNT_D',''),help="MOUNT_D of the calls")
+    p.add_argument('--output',required=True,help="trace file (.jsonl) where to save the calls")
+    p=subparsers.add_parser('replay',help="replay the SHELL calls of trace files")
+    p.add_argument('traces',nargs='+',help="trace files (.jsonl)")
+    p.add_argument('--root',default='',help="recorded folder to replace by the sandbox (default: MOUNT_C, or PROGRAM_PATH, of the first call)")
+    p.add_argument('--tree',default='',help="folder to copy into the sandbox (default: --root)")
+    p.add_argument('--versions',default=BRWFUNCT_DIR,help="comma separated list of folders with the Brw_functions.py versions to compare")
+    p.add_argument('--speed',default='max',help="'max' to run the calls back to back, or factor to divide the recorded intervals between them")
+    p.add_argument('--python',default=sys.executable,help="python executable")
+    p.add_argument('--no-check',action='store_true',help="do not check the files written by every call")
+    p.add_argument('--output',default='',help="JSON file where to save the results")
+    p.add_argument('--keep',action='store_true',help="do not delete the sandboxes at the end")
+    args=parser.parse_args(ini_arguments)
+
+    if args.action=='extract':
+        env=dict((k,v) for k,v in [('PROGRAM_PATH',args.program_path),('MOUNT_C',args.mount_c),('MOUNT_D',args.mount_d)] if v!='')
+        records=extract(args.logs,env,args.program_path)
+        with open(args.output,'w') as f:
+            for record in records:
+                f.write(json.dumps(record,sort_keys=True)+'\n')
+        sys.stdout.write(str(len(records))+" SHELL calls saved at "+args.output+"\n")
+        return 0
+    if args.action!='replay':
+        parser.print_help()
+        return 1
+
+    records=read_traces(args.traces)
+    if len(records)==0:
+        sys.stdout.write("No SHELL calls found in "+', '.join(args.traces)+"\n")
+        return 1
+    root=args.root or records[0].get('env',{}).get('MOUNT_C') or records[0].get('env',{}).get('PROGRAM_PATH') or records[0]['cwd']
+    speed=None if args.speed=='max' else float(args.speed)
+    versions=[os.path.abspath(i) for i in args.versions.split(',') if i!='']
+    results={}
+    report={'date':datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),'calls':len(records),'root':root,
+            'speed':args.speed,'versions':{}}
+    sandbox=tempfile.mkdtemp(prefix='Brw_replay_')
+    for n,version in enumerate(versions):
+        sys.stdout.write("Replaying "+str(len(records))+" SHELL calls with "+version+"\n")
+        try:
+            results[version]=replay(records,version,root,args.tree or root,os.path.join(sandbox,'root'),python=args.python,
+                                    speed=speed,check=not args.no_check)
+        finally:
+            if args.keep:
+                os.rename(os.path.join(sandbox,'root'),os.path.join(sandbox,'root'+str(n)))
+                sys.stdout.write("  sandbox kept at "+os.path.join(sandbox,'root'+str(n))+"\n")
+            else:
+                shutil.rmtree(os.path.join(sandbox,'root'),ignore_errors=True)
+        s=summary(records,results[version])
+        report['versions'][version]=s
+        sys.stdout.write("  throughput "+('%.1f' % s['throughput'])+" calls/s ("+('%.1f' % s['busy_throughput'])+" calls/s busy),"+
+                         " latency p50 "+('%.2f' % (1000*s['total']['p50']))+" ms, p90 "+('%.2f' % (1000*s['total']['p90']))+" ms,"+
+                         " p99 "+('%.2f' % (1000*s['total']['p99']))+" ms, max "+('%.2f' % (1000*s['total']['max']))+" ms\n")
+        for name in sorted(s['commands']):
+            c=s['commands'][name]
+            sys.stdout.write("    "+name.ljust(16)+str(c['n']).rjust(6)+" calls, p50 "+('%.2f' % (1000*c['p50'])).rjust(8)+" ms, p99 "+('%.2f' % (1000*c['p99'])).rjust(8)+" ms\n")
+        if s['input_mismatches']>0:
+            sys.stdout.write("  !!! "+str(s['input_mismatches'])+" calls found input files different from the recorded ones\n")
+        if version!=versions[0]:
+            diffs=differences(records,results[versions[0]],results[version])
+            report['versions'][version]['differences']=diffs
+            sys.stdout.write("  "+("!!! " if len(diffs)>0 else "")+str(len(diffs))+" calls with different status or written files than "+versions[0]+"\n")
+            for diff in diffs[:10]:
+                sys.stdout.write("    #"+str(diff['index'])+" "+' '.join(diff['args'])+"\n")
+
+    if not args.keep:
+        shutil.rmtree(sandbox,ignore_errors=True)
+    if args.output!='':
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=1)
+        sys.stdout.write("Results saved at "+args.output+"\n")
+    return 0 if all([len(report['versions'][v].get('differences',[]))==0 for v in versions]) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
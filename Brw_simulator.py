@@ -34,6 +34,21 @@
 #   2 - Run this script. the easiest way to run this program is creating a .bat file, with the following content:
 #    "python Brw_simulator.py"
 #    and then run directly it by double click on it.
+#   To check that the answers of the simulator have not changed after modifying it, run:
+#    "python Brw_simulator.py --transcript=Brw_simulator_transcript.jsonl"
+#    It answers the commands saved in the golden transcript file, and compares the answers with the saved ones.
+#    (If the changes in the answers are intended, save the new answers with --record)
+#   To measure the time to answer the commands of the transcript (without the serial port), run:
+#    "python Brw_simulator.py --benchmark=1000"
+#   The model, spr and IOS_board of the simulated Brewer can be given after the com port:
+#    "python Brw_simulator.py /dev/tnt1,model=mkiii,spr=14600,ios_board=1"
+#   To simulate several Brewers in the same process (each one with its own com port, model and state), add one
+#    "--instrument=com_port[,model=mkiii][,spr=N][,ios_board=1][,logfile=path]" argument for every extra instrument:
+#    "python Brw_simulator.py /dev/tnt1,model=mkiii --instrument=/dev/tnt3 --instrument=/dev/tnt5,model=mkiii,spr=14600"
+#    Their answers are delayed independently (an instrument waiting for an answer does not delay the others).
+#   To run a day of schedules in minutes, the simulated time can be accelerated with "--speed=20" (the answers are sent
+#    20 times faster, and the simulated time of the log messages runs 20 times faster), or with "--speed=max" (the answers
+#    are sent without waiting, and the simulated time jumps forward by their delays).
 
 
 #Tested routines:
@@ -73,20 +88,45 @@ import sys
 #import io
 import numpy as np
 from copy import deepcopy
+from collections import namedtuple
 from random import random as rand
 import platform
 import datetime
 import os
+import re
+import errno
+import select
+import threading
+from collections import deque
+try:
+    from queue import Queue, Empty
+except ImportError: #python 2
+    from Queue import Queue, Empty
 
 try:
     python_version=[int(i) for i in platform.python_version_tuple()] #For example [2,8,17]
 except:
     raise("No python detected")
 
+clock=getattr(time,'monotonic',time.time) #(python 2 has no monotonic clock)
+
+#Frame of an answer: <payload> (bytes) written at once into the serial port, after waiting <delay> seconds.
+#The answers of check_line are tuples of frames. They are immutable, so the same answer can be sent several times.
+Frame=namedtuple('Frame',['delay','payload'])
+
+def tobytes(s):
+    #Text of an answer as bytes (latin1)
+    if python_version[0]>2:
+        return s.encode("latin1")
+    return s
+
 
 class Brewer_simulator:
 
-    def __init__(self):
+    def __init__(self,options=None):
+        #<options> parameters of an instrument given with --instrument (see getargs). If None, they are taken from the
+        #command line arguments.
+
         # Parameters:
         isodate=datetime.datetime.now().strftime("%Y%m%dT%H%M%SZ")
 
@@ -102,13 +142,15 @@ class Brewer_simulator:
         self.IOS_board = False # Set this to true if Q16%==2. You can see this in bdata\NNN\OP_ST.NNN, line 28, or through IC routine (ctrl+end to quit)
         self.spr = 14664 #number of steps per azimuth tracker revolution
         #if IOS_board is False, the communication with the tracker while doing a re.rtn is done temporarily a 300bps.
+        self.getargs(options) #Replace parameters by arguments (if given)
 
         #initial update of commands
         self.BC={} #brewer common answers dictionary
         self.update_cmds()
+        self.init_dispatcher()
 
         #Misc variables
-        self.lastanswer=deepcopy(self.BC['brewer_none']) #To store the last non empty answer, to be used for the "T" command
+        self.lastanswer=self.none(0) #To store the last non empty answer, to be used for the "T" command
         #Motors
         #id=id of the motor
         #steps_fromled = current steps position, from the led detector
@@ -230,27 +272,109 @@ class Brewer_simulator:
 
 
         #--------------------------------------------------------
-        self.getargs() #Replace parameters by arguments (if given)
         self.Init_logger()
         self.logger.info('Simulating brewer model: '+str(self.bmodel))
+        if self.name!='':
+            self.logger.info('Instrument '+self.name+': com port '+str(self.com_port)+', spr '+str(self.spr)+', IOS_board '+str(self.IOS_board))
+        if self.clock.speed!=1:
+            self.logger.info('Simulated time '+('without waiting' if self.clock.speed is None else str(self.clock.speed)+' times faster than the real time'))
 
 
 
 
     #------------------
 
-    def getargs(self):
-        ini_arguments=sys.argv[1:]
-        if len(ini_arguments)>0: #first argument define the com port to be used
-            self.com_port=ini_arguments[0]
-        if len(ini_arguments)>1: #second argument define the filepath of the log file
-            self.logfile=ini_arguments[1]
+    def getargs(self,options=None):
+        #Set the parameters of the instrument from the command line arguments (see parse_arguments), or from the
+        #<options> of another instrument of the same process (see run).
+        if options is None:
+            options=self.parse_arguments()
+        else:
+            self.transcript=''
+            self.record=False
+            self.benchmark=0
+            self.instruments=[]
+        self.name=options['name'] #Name of the logger (see Init_logger)
+        self.com_port=options['com_port']
+        self.logfile=options['logfile']
+        self.bmodel=options.get('model',self.bmodel)
+        self.spr=options.get('spr',self.spr)
+        self.IOS_board=options.get('ios_board',self.IOS_board)
+        self.clock=VirtualClock(options['speed'])
+
+    def parse_arguments(self):
+        #Usage: python Brw_simulator.py [com_port[,model=mkiii][,spr=N][,ios_board=1][,logfile=path]] [logfile]
+        #                               [--instrument=com_port[,model=mkiii][,spr=N][,ios_board=1][,logfile=path]]...
+        #                               [--speed=N|max] [--transcript=file [--record]] [--benchmark=N]
+        #Returns the options of this instrument {'name','com_port','logfile','speed', and optionally 'model','spr','ios_board'}.
+        #The options of the other instruments, given with --instrument, are saved in self.instruments.
+        import argparse
+        parser=argparse.ArgumentParser(description="Brewer instrument simulator")
+        parser.add_argument('com_port',nargs='?',default=self.com_port,help="com port to be used, optionally followed by the model (mkii or mkiii), spr and ios_board (0 or 1) of the instrument, like /dev/tnt1,model=mkiii,spr=14600,ios_board=1")
+        parser.add_argument('logfile',nargs='?',default=self.logfile,help="filepath of the log file")
+        parser.add_argument('--transcript',default='',help="check the answers of the commands of a transcript file (see check_transcript)")
+        parser.add_argument('--record',action='store_true',help="with --transcript, save the current answers into the transcript file")
+        parser.add_argument('--benchmark',type=int,default=0,help="measure the time to answer the commands of the transcript, repeated N times")
+        parser.add_argument('--instrument',action='append',default=[],help="simulate another Brewer in the same process, with the same options as com_port, and optionally its log file (by default, the log file name with the name of the com port), like /dev/tnt3,model=mkiii,logfile=/tmp/tnt3.txt. It can be repeated.")
+        parser.add_argument('--speed',default='1',help="speed of the simulated time: N times faster than the real time, or 'max' to answer without waiting (see VirtualClock)")
+        args=parser.parse_args(sys.argv[1:])
+        try:
+            speed=None if args.speed.lower()=='max' else float(args.speed)
+        except ValueError:
+            speed=0.
+        if speed is not None and speed<=0:
+            parser.error("--speed must be a positive number, or 'max'")
+        self.transcript=args.transcript
+        self.record=args.record
+        self.benchmark=args.benchmark
+        if self.benchmark>0 and self.transcript=='':
+            self.transcript=TRANSCRIPT
+        #Instruments: the one of com_port, and the ones given with --instrument
+        instruments=[]
+        for spec in [args.com_port]+args.instrument:
+            fields=spec.split(',')
+            options={'com_port':fields[0],'name':os.path.basename(fields[0]),'speed':speed}
+            for field in fields[1:]:
+                key,sep,value=field.partition('=')
+                key=key.strip().lower()
+                if key=='model' and value in ['mkii','mkiii']:
+                    options['model']=value
+                elif key=='spr' and value.isdigit():
+                    options['spr']=int(value)
+                elif key=='ios_board' and value in ['0','1']:
+                    options['ios_board']=value=='1'
+                elif key=='logfile' and value!='':
+                    options['logfile']=value
+                else:
+                    parser.error("cannot understand '"+field+"' in "+spec)
+            if options['com_port']=='' or options['name'] in [i['name'] for i in instruments]:
+                parser.error(spec+": the com ports must be different")
+            if 'logfile' not in options:
+                if len(instruments)==0:
+                    options['logfile']=args.logfile
+                else:
+                    root,ext=os.path.splitext(instruments[0]['logfile'])
+                    options['logfile']=root+'_'+options['name']+ext
+            instruments.append(options)
+        self.instruments=instruments[1:]
+        if len(self.instruments)==0:
+            instruments[0]['name']='' #A single instrument: it uses the root logger
+        return instruments[0]
 
     def Init_logger(self):
         # ----Initialize the logger---
         # create logger
-        self.logger = logging.getLogger()  # This will be the root logger.
+        if self.name=='':
+            self.logger = logging.getLogger()  # This will be the root logger.
+        else:
+            #Several instruments: every one has its own logger, with its own log file (see getargs)
+            self.logger = logging.getLogger('Brw_simulator.'+self.name)
+            self.logger.propagate=False
         self.logger.setLevel(logging.DEBUG)
+        if self.transcript!='':
+            #Checking a transcript, or benchmarking: nothing is logged
+            self.logger.disabled=True
+            return
 
         # create file handler which logs even debug messages
         self.fh_info =logging.FileHandler(self.logfile)
@@ -262,13 +386,23 @@ class Brewer_simulator:
 
         #Create formatter
         self.formatter = logging.Formatter('[%(asctime)s.%(msecs)03d] [%(levelname)s] [%(message)s]',"%a %d %b %Y, %H:%M:%S")
+        if self.name=='':
+            self.ch_formatter = self.formatter
+        else: #The console is shared by all the instruments
+            self.ch_formatter = logging.Formatter('[%(asctime)s.%(msecs)03d] ['+self.name.replace('%','%%')+'] [%(levelname)s] [%(message)s]',"%a %d %b %Y, %H:%M:%S")
 
         #Set the timezone of the formatter
         self.formatter.converter = time.gmtime
+        self.ch_formatter.converter = time.gmtime
+
+        #Accelerated time: the messages are logged with the simulated time
+        if self.clock.speed!=1:
+            self.fh_info.addFilter(self.clock)
+            self.ch.addFilter(self.clock)
 
         #Set the formatter to the file handlers, and stream handler.
         self.fh_info.setFormatter(self.formatter)
-        self.ch.setFormatter(self.formatter)
+        self.ch.setFormatter(self.ch_formatter)
 
         #Add the handlers to the logger
         self.logger.addHandler(self.fh_info)
@@ -291,10 +425,26 @@ class Brewer_simulator:
     def update_cmds(self):
 
         #Brewer answers
-        self.BC['brewer_none'] = ['\r','\n', '\x00', '\x00', '\x00', '\x00', '\x00', '\x00', '->', '\x20', 'flush']
-
-        self.BC['brewer_something'] = ['\r','\n', '\x00', '\x00', '\x00', '\x00', '\x00', '\x00', '\r','\n', '\x00', '\x00', '\x00', '\x00', '\x00', '\x00', '->', '\x20', 'flush']
-        self.bsl=len(self.BC['brewer_something']) #Brewer something length
+        #(bytes, built once: the answers are sent as they are, see Frame)
+        #Every line sent by the Brewer starts with the fill characters (6 ascii nulls, see cmd_F), and the answers end with the prompt.
+        fill=b'\r\n'+b'\x00'*6
+        self.BC['brewer_none'] = fill+b'-> '
+
+        self.BC['brewer_something'] = fill+fill+b'-> '
+        self.none_answers={} #Answers without data, by delay (see none)
+
+    def none(self,delay,text=''):
+        #Answer of the commands that do not return data: the prompt (after <text>), sent after <delay> seconds.
+        if text!='':
+            return (Frame(delay,tobytes(text)+self.BC['brewer_none']),)
+        answer=self.none_answers.get(delay)
+        if answer is None:
+            answer=self.none_answers[delay]=(Frame(delay,self.BC['brewer_none']),)
+        return answer
+
+    def something(self,delay,text):
+        #Answer of the commands that return data: the <text>, followed by the prompt, sent after <delay> seconds.
+        return (Frame(delay,tobytes(text)+self.BC['brewer_something']),)
 
     def gaussian(self,x, mu, sig):
         return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
@@ -329,9 +479,97 @@ class Brewer_simulator:
 
 
 
-    #Function to assign an answer to each com port question
-    def check_line(self,fullline):
-        gotkey=False
+    #------------------
+    #Dispatch of the commands: every received line is split into commands (by ':'), and every command is parsed once
+    #(see parse_command) into its handler and its typed arguments, by looking it up in these tables:
+    # COMMANDS {(verb, number of arguments): (handler, argument types)}. The verb is the text before the first ',',
+    #  for example 'M,10,489' -> ('M',2). The commands without arguments are looked up by the full command ('O' -> ('O',0)).
+    # QUERIES {name: (handler, index type)}, for the queries like '?MOTOR.POS[2]' (see QUERY).
+    # SEARCHES [(keyword, handler)], for the commands that are only recognized by a keyword (tried in that order).
+    #Every handler returns (gotkey, answer) (see check_line).
+    COMMANDS={('\n',0):('cmd_newline',()),
+              ('\r',0):('cmd_return',()),
+              ('\x00',0):('cmd_null',()), #null character, as the re.rtn does with non IOS board (mkii)
+              ('NULL',0):('cmd_null',()),
+              ('O',0):('cmd_O',()),
+              ('Z',0):('cmd_Z',()),
+              ('T',0):('cmd_T',()),
+              ('R',0):('cmd_R_repeat',()),
+              ('?RH.SLOPE',0):('cmd_RH_SLOPE',()),
+              ('?RH.ORIGIN',0):('cmd_RH_ORIGIN',()),
+              ('B',1):('cmd_B',(int,)),
+              ('G',1):('cmd_G',(int,)),
+              ('I',1):('cmd_I',(int,)),
+              ('E',1):('cmd_E',(int,)),
+              ('M',2):('cmd_M',(int,int)),
+              ('F',2):('cmd_F',(str,str)),
+              ('V',2):('cmd_V',(int,str)),
+              ('L',2):('cmd_L',(int,)*2),
+              ('L',4):('cmd_L',(int,)*4),
+              ('L',8):('cmd_L',(int,)*8),
+              ('L',10):('cmd_L',(int,)*10),
+              ('D',2):('cmd_D',(int,int)),
+              ('R',3):('cmd_R',(int,int,int)),
+              ('!TIME',5):('cmd_TIME',(str,)*5)}
+    PREFIX_VERBS=['!TIME'] #Verbs followed by their first argument, without ',' (like '!TIME2020,1,2,3,4' once the spaces are removed)
+    QUERY=re.compile(r'^\?([A-Z][A-Z.]*)\[([^\]]*)\]$')
+    QUERIES={'MOTOR.CLASS':('cmd_MOTOR_CLASS',int),
+             'MOTOR.POS':('cmd_MOTOR_POS',int), #used in AZ.rtn
+             'MOTOR.ZERO.POS':('cmd_MOTOR_ZERO_POS',int), #used in AZ.rtn
+             'MOTOR.ORIGIN':('cmd_MOTOR_ORIGIN',int), #used in AZ.rtn
+             'MOTOR.SLOPE':('cmd_MOTOR_SLOPE',int), #used in AZ.rtn
+             'MOTOR.DISCREPANCY':('cmd_MOTOR_DISCREPANCY',int), #used in AZ.rtn
+             'TEMP':('cmd_TEMP',str),
+             'ANALOG.NOW':('cmd_ANALOG_NOW',int)} #used in AP.rtn
+    SEARCHES=[('STEPS','cmd_STEPS'), #used in sr.rtn
+              ('LOGENTRY','cmd_LOGENTRY')] #used in ED.rtn
+
+    def init_dispatcher(self):
+        #Bind the handlers of the dispatch tables to this instance
+        self.commands=dict((key,(getattr(self,name),types)) for key,(name,types) in self.COMMANDS.items())
+        self.queries=dict((key,(getattr(self,name),itype)) for key,(name,itype) in self.QUERIES.items())
+        self.searches=[(keyword,getattr(self,name)) for keyword,name in self.SEARCHES]
+
+    def parse_command(self,line):
+        '''
+        handler, args = self.parse_command(line)
+
+        Find the <handler> of the command <line> (see COMMANDS), and convert its arguments to their types.
+        Returns (None, None) if the command is unknown, or if its arguments have not the expected type (as B,x).
+        '''
+        command=self.commands.get((line,0))
+        if command is not None:
+            return command[0],()
+        if ',' in line:
+            args=line.split(',')
+            verb=args.pop(0)
+            for prefix in self.PREFIX_VERBS:
+                if verb.startswith(prefix):
+                    args.insert(0,verb[len(prefix):])
+                    verb=prefix
+                    break
+            command=self.commands.get((verb,len(args)))
+            if command is not None:
+                handler,types=command
+                try:
+                    return handler,[t(a) for t,a in zip(types,args)]
+                except ValueError:
+                    pass
+            return None,None
+        m=self.QUERY.match(line)
+        if m and m.group(1) in self.queries:
+            handler,itype=self.queries[m.group(1)]
+            try:
+                return handler,[itype(m.group(2))]
+            except ValueError:
+                return None,None
+        for keyword,handler in self.searches:
+            if keyword in line:
+                return handler,()
+        return None,None
+
+    def split_line(self,fullline):
+        #Split a received line into its commands.
         fullline=fullline.replace(" ","") #remove spaces
         fullline=fullline.replace("&",":")
         fullline=fullline.replace(";",":")
@@ -344,604 +582,493 @@ class Brewer_simulator:
                 fullline=fullline.replace("\r","") #remove the carriage return
         #Count the number of commands sent in the same line.
         # For example: 'M,10,489:R,2,2,4:O\r' are 3 commands, move motor, measure, and get light intensity.
-        ncommands=fullline.count(":")+1
-        answers=[] #to store the answer of each command.
-        if ncommands>1:
-            lines=fullline.split(":")
-        else:
-            lines=[fullline]
-
-        for linei in range(len(lines)): #line index [0,1,...]
-
-            line=lines[linei]
-            answer=[]
-
-            if line=="R": #Command R: repeat last R,p1,p2,p3 measurement
-                line="R,"+str(self.Rp1)+","+str(self.Rp2)+","+str(self.Rp3)
-                self.logger.info('Got keyword: "R", replaced by the last R command: "' +str(line)+'"')
-
-            ncommas=line.count(',')
-
-
-            if ncommas==0:
-
-                if line=='\n':
-                    self.logger.info('Got keyword: "\\n"')
-                    answer=["wait0.1"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                elif line=='\r':
-                    self.logger.info('Got keyword: "\\r"')
-                    answer=deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                # elif line=='\x00':
-                #     self.logger.info('Got keyworkd: "Null"')
-                #     answer = deepcopy(self.BC['brewer_none'])
-                #     gotkey = True
-
-                elif ((line=='\x00') or (line=='NULL')): #null character, as the re.rtn does with non IOS board (mkii)
-                    #Note, depending of the sw used to create the com port bridge,
-                    # a null character might not be received when the brewer software
-                    # changes the baudrate from 1200 to 300bps.
-                    # In this case, we could force the brewer software to write a signal to know when is it happening:
-                    # in re-mb, add the line:
-                    # 13091 IF Q16%=0 THEN O1$="NULL":GOSUB 9450
-                    self.logger.info('Got keyworkd: "Null"')
-                    if not self.onre:
-                        self.onre=True #first time passing here: start of re.rtn
-                        if not self.IOS_board:
-                            self.curr_baudrate=300 #change baudrate to 300
-                    else:
-                        self.onre=False #second time passing here: end of re.rtn
-                        if not self.IOS_board:
-                            self.curr_baudrate=deepcopy(self.com_baudrate) #change baudrate back to its original value
-                    answer=["wait5"]+['\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00BREWER OZONE SPECTROPHOTOMETER\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00         #072\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00     ']+["flush"]
-                    answer+=["wait2"]+['AES  SCI-TEC\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00        CANADA\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00  VERSION 39.5 NOV 22, 1982\r\n\x00\x00\x00\x00\x00\x00\x00\x00']+["flush"]
-                    answer+=["wait0.8"]+['\x00\x00\x00\x00\r\n\x00\x00\x00\x00\x00\x00-> ']+["flush"]
-                    gotkey = True
-
-
-                elif line=='O': #Return the measured signals of the last R,p1,p2,p3 command.
-                    self.logger.info('Got keyworkd: "O" -> Get last measurement data ')
-                    signals=[]
-                    for wvp in self.lastwvpmeasured:
-                        try:
-                            signals.append(str(self.lastwvpsignal[wvp]).rjust(9))
-                        except:
-                            self.logger.error("Cannot concatenate signal, self.lastwvpsignal[wvp]="+str(self.lastwvpsignal[wvp]))
-                    answer = ["wait1.0"]+[",".join(signals)]+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif line=="Z": #get last read sensor value
-                    ss='Got keyworkd: "Z", get sensor reading: '
-                    if len(self.lastL)==2: #for example L,19414,120
-                        if self.lastL==[19414,120]:
-                            ss+="move az to AZC, value: none"
-                            self.logger.info(ss)
-                            answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                        if self.lastL==[19414,255]:
-                            ss+="move ze to ZEC, value: none"
-                            self.logger.info(ss)
-                            answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                    elif len(self.lastL)==4: ##for example L,20248,0,20249,255:Z
-                        if [self.lastL[0],self.lastL[2],self.lastL[3]]==[20248,20249,255]: # for example: [20248,x,20249,255]:
-                            x=self.lastL[1] #sensor index
-                            v=self.AnalogSensors[x]["value_"+self.bmodel] #get value for respective sensor and respective model
-                            n=self.AnalogSensors[x]["name"]
-                            ss+=n + ", value: "+str(v)
-                            self.logger.info(ss)
-                            answer=['wait0.2']+[str(v).rjust(4)]+deepcopy(self.BC['brewer_something'])
-                            gotkey = True
-                    elif len(self.lastL)==8: #for example L,16811,5,16812,79,16813,3,16814,255
-                        if self.lastL==[16811,5,16812,79,16813,3,16814,255]: #AP.rtn, communication test with AD board
-                            ss+="Communication test with AD board, value: 49"
-                            self.logger.info(ss)
-                            answer = ['wait0.2']+["49".rjust(4)]+deepcopy(self.BC['brewer_something'])
-                    elif len(self.lastL)==10: #for example L,16905,90,18041,14,16953,110,18057,64,16977,90
-                        if self.lastL==[16905,90,18041,14,16953,110,18057,64,16977,90]: #Change tracker baudrate
-                            ss+="Change tracker baudrate, value: none"
-                            self.logger.info(ss)
-                            answer = ['wait0.2']+deepcopy(self.BC['brewer_none'])
-
-
-                elif line=='T': #Re-transmit the output of the most recent non-null response
-                    self.logger.info('Got keyworkd: "T"')
-                    answer=deepcopy(self.lastanswer)
-                    gotkey=True
-
-                elif '?MOTOR.CLASS[' in line:
-                    self.logger.info('Got keyword: "?MOTOR.CLASS[x]"')
-                    x=self.find_between(line,"[","]")
-                    if int(x)==2:
-                        answer = ['wait0.1']+['TRACKERMOTOR']+deepcopy(self.BC['brewer_something'])
-                        gotkey = True
-
-                elif '?MOTOR.POS[' in line: #used in AZ.rtn
-                    self.logger.info('Got keyword: ?MOTOR.POS[x]') #Get current position (not sure if from zero, or fromled)
-                    x=self.find_between(line,"[","]")
-                    answer = ['wait0.1']+[str(self.Motors[int(x)]["steps_fromzero"]).rjust(9)]+deepcopy(self.BC['brewer_something']) #is needed to check that the rjust is correct
-                    gotkey = True
-
-                elif '?MOTOR.ZERO.POS[' in line: #used in AZ.rtn
-                    self.logger.info('Got keyword: ?MOTOR.ZERO.POS[x]')
-                    x=self.find_between(line,"[","]")
-                    answer = ['wait0.1']+[str(self.Motors[int(x)]["zerostep_now"]).rjust(9)]+deepcopy(self.BC['brewer_something']) #is needed to check that the rjust is correct
-                    gotkey = True
-
-                elif '?MOTOR.ORIGIN[' in line: #used in AZ.rtn
-                    self.logger.info('Got keyword: ?MOTOR.ORIGIN[x]')
-                    x=self.find_between(line,"[","]")
-                    answer = ['wait0.1']+[str(self.Motors[int(x)]["zerostep_ini"]).rjust(9)]+deepcopy(self.BC['brewer_something']) #is needed to check that the rjust is correct
-                    gotkey = True
-
-                elif '?MOTOR.SLOPE[' in line: #used in AZ.rtn
-                    self.logger.info('Got keyword: ?MOTOR.SLOPE[x]')
-                    x=self.find_between(line,"[","]")
-                    answer = ['wait0.1']+[str(self.Motors[int(x)]["spd"]).rjust(9)]+deepcopy(self.BC['brewer_something'])
-                    #Not tested, I think it is to get the steps/degree
-                    #The azimuth steps per turn can be taken from the OP_ST.xxx, row 17; Azimuth steps per revolution
-                    #is needed to check that the rjust is correct
-                    gotkey = True
-
-                elif '?MOTOR.DISCREPANCY[' in line: #used in AZ.rtn
-                    self.logger.info('Got keyword: ?MOTOR.DISCREPANCY[x]')
-                    x=self.find_between(line,"[","]")
-                    answer = ['wait0.1']+[str(0).rjust(9)]+deepcopy(self.BC['brewer_something']) #is needed to check that the rjust is correct
-                    gotkey = True
-
-                elif 'STEPS' in line: #used in sr.rtn
-                    #The number of steps ina complete revolution of the azimuth tracker
-                    self.logger.info('Got keyword: STEPS')
-                    answer = ['wait0.1']+[str(self.spr).rjust(9)]+deepcopy(self.BC['brewer_something']) #is needed to check that the rjust is correct
-                    gotkey = True
-
-
-                elif '?TEMP[PMT]' in line:
-                    self.logger.info('Got keyworkd: "?TEMP[PMT]"')
-                    answer=['wait0.2']+['19.158888']+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif '?TEMP[FAN]' in line:
-                    self.logger.info('Got keyworkd: "?TEMP[FAN]"')
-                    answer=['wait0.2']+['19.633333']+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif '?TEMP[BASE]' in line:
-                    self.logger.info('Got keyworkd: "?TEMP[BASE]"')
-                    answer=['wait0.2']+['17.637777']+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif '?TEMP[EXTERNAL]' in line:
-                    self.logger.info('Got keyworkd: "?TEMP[EXTERNAL]"')
-                    answer=['wait0.2']+['-37.777777']+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif '?RH.SLOPE' in line:
-                    self.logger.info('Got keyworkd: "?RH.SLOPE"')
-                    answer=['wait0.2']+['0.031088']+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif '?RH.ORIGIN' in line:
-                    self.logger.info('Got keyworkd: "?RH.ORIGIN"')
-                    answer=['wait0.2']+['0.863000']+deepcopy(self.BC['brewer_something'])
-                    gotkey = True
-
-                elif '?ANALOG.NOW[' in line: #used in AP.rtn
-                    x=self.find_between(line,"[","]")
-                    answer = ['wait0.1']+[str(self.AnalogSensors[int(x)]["value_"+self.bmodel]).rjust(9)]+deepcopy(self.BC['brewer_something']) #is needed to check that the rjust is correct
-                    self.logger.info('Got keyworkd: "?ANALOG.NOW[x]" -> Get sensor reading of: '+self.AnalogSensors[int(x)]["name"])
-                    gotkey = True
-
-                elif 'LOGENTRY' in line: #used in ED.rtn
-                    self.logger.info('Got keyworkd: "LOGENTRY"')
-                    answer=['wait0.2']+["All log items reported."]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-
-
-
-            elif ncommas==1:
-                #Turn off all lamps
-                if 'B,' in line:
-                    self.AnalogSensors=deepcopy(self.AnalogSensors_ini)
-                    _,l=line.split(",")
-                    if l=="0":
-                        self.logger.info('Got keyword: "B,0" -> Turn off all Lamps')
-                        answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                        gotkey = True
-                        self.FEL_lamp=False
-                        self.HG_lamp=False
-                    elif l=="1":
-                        self.logger.info('Got keyword: "B,1" -> Turn on the Mercury Lamp')
-                        answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                        gotkey = True
-                        self.FEL_lamp=False
-                        self.HG_lamp=True
-                        self.AnalogSensors[16]['value_mkiii']=755
-                        self.AnalogSensors[17]['value_mkiii']=679
-                        self.AnalogSensors[18]['value_mkiii']=256
-                        self.AnalogSensors[19]['value_mkiii']=99
-                        self.AnalogSensors[21]['value_mkiii']=20.58
-                        self.AnalogSensors[22]['value_mkiii']=8
-                        self.AnalogSensors[23]['value_mkiii']=17
-
-                        self.AnalogSensors[16]['value_mkii']=755
-                        self.AnalogSensors[17]['value_mkii']=679
-                        self.AnalogSensors[18]['value_mkii']=256
-                        self.AnalogSensors[19]['value_mkii']=99
-                        self.AnalogSensors[21]['value_mkii']=20.58
-                        self.AnalogSensors[22]['value_mkii']=8
-                        self.AnalogSensors[23]['value_mkii']=17
-
-                    elif l=="2":
-                        self.logger.info('Got keyword: "B,2" -> Turn on the Quartz Halogen Lamp (FEL)')
-                        answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                        gotkey = True
-                        self.FEL_lamp=True
-                        self.HG_lamp=False
-                        self.AnalogSensors[8]['value_mkiii']=305
-                        self.AnalogSensors[14]['value_mkiii']=776
-                        self.AnalogSensors[15]['value_mkiii']=886
-
-                        self.AnalogSensors[8]['value_mkii']=6
-                        self.AnalogSensors[14]['value_mkii']=156
-                        self.AnalogSensors[15]['value_mkii']=239
-
-                    elif l=="3":
-                        self.logger.info('Got keyword: "B,3" -> Turn on Quartz and Mercury Lamp')
-                        answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                        gotkey = True
-                        self.FEL_lamp=True
-                        self.HG_lamp=True
-                        self.AnalogSensors[8]['value_mkii']=305
-                        self.AnalogSensors[8]['value_mkiii']=305
-
-                elif "G," in line: #G,544
-                    #Get command, Transmit to the terminal the byte values located at the COSMAC Input Output addresses, p1, p2, ..., pX
-                    #For example, G,544 read end stop status of motor 10. It returns a value in the range 0-255 for each byte queried.
-                    #544= Status of slit mask & micromter motors
-                    #800=Status of Zen-prism & Az-tracker motors
-                    #1056=Status of Iris & Filterwheel motors
-                    #20244-20257=A/D table (not implemented here)
-                    #16440-61447=Real-Time Clock (not implemented here)
-                    #63488-65535=Battery-backed-up Ram (not implemented here)
-                    self.logger.info('Got keyword: "G" Get data from COSMAC I/O.')
-                    Glist=line.split(",")
-                    Glist=Glist[1:]
-                    Glistansw=[]
-                    allok=True
-                    for p in Glist:
-                        if int(p)==544:
-                            self.logger.info('Address 544: Get status of Slit Mask and Micrometer motors.')
-                            res,stid=self.getGstatus(int(p))
-                            self.logger.info('Address 544 status= '+str(res))
-                            for i in stid:
-                                self.logger.info("Status enabled: "+str(i))
-                            Glistansw+=[str(res).rjust(4)+","]
-                        elif int(p)==800:
-                            self.logger.info('Address 800: Get status of Zen-prism and Az tracker motors.')
-                            res,stid=self.getGstatus(int(p))
-                            self.logger.info('Address 800 status= '+str(res))
-                            for i in stid:
-                                self.logger.info("Status enabled: "+str(i))
-                            Glistansw+=[str(res).rjust(4)+","]
-                        elif int(p)==1056:
-                            self.logger.info('Address 1056: Get status of Iris and Filterwheel motors.')
-                            res,stid=self.getGstatus(int(p))
-                            self.logger.info('Address 1056 status= '+str(res))
-                            for i in stid:
-                                self.logger.info("Status enabled: "+str(i))
-                            Glistansw+=[str(res).rjust(4)+","]
-                        else:
-                            self.logger.warning("Unknown G address, p="+str(p))
-                            allok=False
-                            break
-                    if allok:
-                        gotkey=True
-                        answer=["wait0.5"]+Glistansw+deepcopy(self.BC['brewer_something'])
-
-
-
-                elif "I," in line: #Initialize the specified motor to its zero position and set the corresponding step up accumulator to 0
-                    _,m=line.split(",")
-                    self.Motors[int(m)]['steps_fromled']=deepcopy(self.Motors[int(m)]['zerostep_now'])
-                    self.update_motor_pos(int(m))
-                    self.logger.info('Got keyword: "I,m" -> Initialize motor ('+str(m)+'), to its zero position (zerostep_now='+str(self.Motors[int(m)]['zerostep_now'])+')')
-                    answer=["wait0.5"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                elif "E," in line: #
-                    _,x=line.split(",")
-                    if int(x)==1:
-                        gotkey = True
-                        self.logger.info('Got keyword: "E,1" -> unknown (related to zenith motor zeroing)')
-                        answer=["wait0.5"]+["-   61"]+deepcopy(self.BC['brewer_something'])
-                    elif int(x)==2:
-                        gotkey = True
-                        self.logger.info('Got keyword: "E,2" -> unknown (related to azimuth motor zeroing)')
-                        answer=["wait0.5"]+["- 6503"]+deepcopy(self.BC['brewer_something'])
-
-
-            elif ncommas==2:
-                # for example M,m,p: Move the m motor, to the x position
-                if "M," in line:
-                    _,m,p=line.split(",")
-                    if int(p)<0:
-                        self.Motors[int(m)]['steps_fromled']=self.Motors[int(m)]['steps_fromled']+int(p)
-                        self.Motors[int(m)]['zerostep_now']=deepcopy(self.Motors[int(m)]['steps_fromled'])
-                        self.logger.info('Got keyworkd: "M,m,-p" -> Move motor '+str(m)+' ('+str(self.Motors[int(m)]['id'])+')'+\
-                                         ' '+str(p)+' steps backwards and set new zerostep_now ('+\
-                                         str(self.Motors[int(m)]['zerostep_now'])+')')
-                    else:
-                        self.Motors[int(m)]['steps_fromled'] =int(p) #Store the last selected position of this motor
-                        self.logger.info('Got keyworkd: "M,m,p" -> Move motor '+str(m)+' ('+str(self.Motors[int(m)]['id'])+')'+\
-                                         ' to step '+str(p)+'.')
-                    ss=self.update_motor_pos(int(m))
-                    self.logger.info(ss)
-                    #Update Gdict status:
-
-                    #Micrometer
-                    if self.Motors[10]["steps_fromled"] in [501,51,67]:
-                        self.Gdict[544][2]["status"]=1  #Micrometer at maximum-wavelength position
-                    else:
-                        self.Gdict[544][2]["status"]=0
-
-                    #Azimuth tracker motor - CW end stop
-                    if self.Motors[2]["steps_fromled"] <= 0:
-                        self.Gdict[800][2]["status"]=1 #Azimuth CW opto sensor blocked
-                    elif self.Motors[2]["steps_fromled"]>=self.spr-400 and self.Motors[2]["steps_fromled"]<=self.spr:
-                        self.Gdict[800][2]["status"]=1 #Azimuth CW opto sensor blocked (needed for sr.rtn)
-                    else:
-                        self.Gdict[800][2]["status"]=0
-
-                    #Zenith prism motor - fully closed end stop
-                    if self.Motors[1]["steps_fromled"] == 0: #Zenith prism pointing down
-                        self.Gdict[800][4]["status"]=0 #Zenith prism pointing down (active low)
-                    else:
-                        self.Gdict[800][4]["status"]=1
-
-                    #Iris motor - fully closed end stop
-                    if self.Motors[3]["steps_fromled"] == 0: #iris fully closed
-                        self.Gdict[1056][4]["status"]=0 #Iris fully closed (active low)
-                    else:
-                        self.Gdict[1056][4]["status"]=1
-
-                    #Iris motor - fully opened end stop
-                    if self.Motors[3]["steps_fromled"] == 250: #iris fully open
-                        self.Gdict[1056][5]["status"]=0 #Iris fully open (active low)
-                    else:
-                        self.Gdict[1056][5]["status"]=1
-
-
-
-
-                    answer=["wait1.0"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-
-                elif 'F,' in line: #For example "F,0,2"
-                    #Define the fill characters (those characters transmited as a 'header' before each output message)
-                    # to be used at the start of every transmission from the Brewer to the controller, when using the TTY interface low level protocol.
-                    # F,p1,p2. p1 = repetitions. p2 = fill character.
-                    # the default values are 6 and 0 respectively, producing 6 ascii nulls
-                    # ASCII characters: https://theasciicode.com.ar/
-                    #_,Fcount,Fascicode=line.split(",") ignore it, leave as default.
-                    self.logger.info('Got keyword: "F,count,ascicode" -> Define the fill characters for low level communication')
-                    answer = ["wait0.2"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                elif 'V,' in line: #For example "V,cps,echo": Set baudrate and the flag which controls echoing
-                    _,cps,echo=line.split(",")
-                    self.logger.info('Got keyword: "V,cps,echo" -> Set Baudrate to '+str(10*int(cps))+' and echo to '+str(echo=="1"))
-                    self.curr_baudrate=int(cps)*10
-                    answer = ["wait0.2"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                # for example L,a,b: Set parameters, example: L,19414,120
-                elif "L," in line:
-                    _,a,b=line.split(",")
-                    self.lastL=[int(a),int(b)]
-                    self.logger.info('Got keyword: "L,a,b"')
-                    answer = ["wait0.5"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                elif "D," in line: #D,2955,2956
-                    #"D,p1,p2", Dump command: Transmit to the terminal the byte values located at COSMAC memory addresses p1,p2,...,pX.
-                    #p1,p2,...,pX are 16 bit COSMAC memory addresses written as signed decimal numbers in the range -32768..32767
-                    #Values corresponding to each pX are returned in a list.
-                    self.logger.info('Got keyword: "D", Get data from COSMAC memory.')
-                    Dlist=line.split(",")
-                    Dlist=Dlist[1:]
-                    Dlistansw=[]
-                    allok=True
-                    for p in Dlist:
-                        if int(p)==2955:
-                            self.logger.info('Address 2955: Check for UART (0).')
-                            Dlistansw+=["   0,"]
-                        elif int(p)==2956:
-                            self.logger.info('Address 2956: Check for UART (1).')
-                            Dlistansw+=["   0,"]
-                        else:
-                            self.logger.warning("Unknown D address")
-                            allok=False
-                            break
-                    if allok:
-                        gotkey=True
-                        answer=["wait0.5"]+Dlistansw+deepcopy(self.BC['brewer_something'])
-
-            elif ncommas==3:
-
-                #R,p1,p2,p3: Measure light intensity.
-                # p1 -Initial wavelenght position: may take values form 0 to 7.
-                # p2 -Final wavelenght position: may take values from p1 to 7.
-                # p3 - repetitions: may take values from 1 to 255
-                #if there are no parameters specified, the parameters from the previous R command are used.
-                #the measurements are then read by the O, command.
-                if "R" in line:
-                    _,Rp1,Rp2,Rp3=line.split(",")
-                    self.Rp1=int(Rp1) #save last p1
-                    self.Rp2=int(Rp2) #save last p2
-                    self.Rp3=int(Rp3) #save last p3
-                    self.lastwvpmeasured=range(self.Rp1,self.Rp2+1) #For example, if R,2,4,1 -> wv positions to be measured = [2,3,4]
-                    #Generate signals depending of different conditions:
-                    #Signal will be stored in self.lastwvpsignal dictionary.
-
-                    #While running an HG routine:
-                    if self.HG_lamp:
-                        self.logger.info("In HG measurement")
-                        self.lastwvpsignal={}
-                        if "R,0,7,1" in line: #initial quick scan over all wvp
-                            signals=[1068,0,38,73,17035,51,22,115]
-                            self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i] for i in self.lastwvpmeasured}
-                        elif "R,2,2,4" in line: #hs.rtn
-                            self.lastwvpsignal[2]=int(10*rand()) #This is simply to avoid division by zero in hs.rtn
-                        else: #HG.rtn: check of signal at different motor[10] positions:
-                            #The signal with depend of the latest motor[10] position, and selected wvp. (only wvp 0 is measured)
-                            mstep=self.Motors[10]['steps_fromled']
-                            #gaussian multiplicator factor [0-1], centered at step 148. (Center should be between [147 to 149])
-                            if self.bmodel=="mkiii":
-                                mult=self.gaussian(mstep,148,60) #B185, std of 60. -> adjust the std until having a correlation factor > 0.9
-                            else:
-                                mult=self.gaussian(mstep,148,20) #B072, std of 20. -> adjust the std until having a correlation factor > 0.9
-                            signal=int(mult*self.hglevel)
-                            self.logger.info("step="+str(mstep)+", mult="+str(mult)+", signal="+str(signal))
-                            for wvp in self.lastwvpmeasured: #Generate signals for each wv position:
-                                if wvp==0:
-                                    self.lastwvpsignal[wvp]=deepcopy(signal)
-                                else:
-                                    self.lastwvpsignal[wvp]=0
-
-                    #While FEL lamp is on:
-                    elif self.FEL_lamp:
-                        self.logger.info("In FEL measurement")
-                        self.lastwvpsignal={}
-                        if "R,0,7," in line: #SL.rtn (R,0,7,1) or RS.rtn (R,0,7,5) -> initial quick scan over all wvp
-                            _,_,_,mult=line.split(",")
-                            signals=[3747,0,35927,40439,45369,40758,32717,79062]
-                            self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i]*int(mult) for i in self.lastwvpmeasured}
-                        elif "R,0,6,20" in line: #SL.rtn -> measurements
-                            signals=[77444,7,746834,840075,939058,846241,678921]
-                            #self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i]+int(10*rand()) for i in self.lastwvpmeasured}
-                            self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i] for i in self.lastwvpmeasured}
-                        elif "R,6,6,4" in line: #HP.rtn
-                            #The signal with depend of the latest motor[9] position, and selected wvp. (only wvp 6 is measured)
-                            mstep=self.Motors[9]['steps_fromled'] #in theory, while doing an HP, it usually vary from 0 to 160, in 10 steps.
-                            signal=self.FEL_signal[mstep]
-                            for wvp in self.lastwvpmeasured: #Generate signals for each wv position:
-                                if wvp==6:
-                                    self.lastwvpsignal[wvp]=int(signal)
-                                else:
-                                    self.lastwvpsignal[wvp]=0
-                        else: #For any other case, like RS.rtn, Generate random signals for each wv position:
-                            for wvp in self.lastwvpmeasured:
-                                if wvp==1:
-                                    signal=5+int(10*rand())
-                                    self.lastwvpsignal[wvp]=int(signal)
-                                else:
-                                    signal=1000+int(100*rand())
-                                    self.lastwvpsignal[wvp]=int(signal)
-
-                    #In general operation:
-                    else:
-                        #Give a random signal
-                        self.lastwvpsignal={}
-                        for wvp in self.lastwvpmeasured:
-                            if wvp==0: #HG calibration 302.1
-                                self.lastwvpsignal[wvp]=int(0.0)
-                            elif wvp==1: #Dark count
-                                self.lastwvpsignal[wvp]=int(0.0)
-                            elif wvp==2: #wv1 306nm (used in uv scan)
-                                self.lastwvpsignal[wvp]=int(19.0)
-                            elif wvp==3: #wv2 310nm
-                                self.lastwvpsignal[wvp]=int(84)
-                            elif wvp==4: #wv3 313.5nm
-                                self.lastwvpsignal[wvp]=int(307)
-                            elif wvp==5: #wv4 316.8nm
-                                self.lastwvpsignal[wvp]=int(581)
-                            elif wvp==6: #wv5 320.0nm
-                                self.lastwvpsignal[wvp]=int(2)
-                            elif wvp==7: #wv2 & wv4 -> Deadtime test
-                                self.lastwvpsignal[wvp]=int(10)
-
-                            self.lastwvpsignal[wvp]+=int(rand()*5) #Add some random counts to avoid problems when calculating the statistics
-
-                    ss='Got keyword: "R,p1,p2,p3" '
-                    if self.FEL_lamp:
-                        ss+="(FEL Lamp ON) "
-                    if self.HG_lamp:
-                        ss+="(HG Lamp ON) "
-                    self.logger.info(ss+'-> Measuring light for wv positions '+str(self.lastwvpmeasured)+", signals: "+str(self.lastwvpsignal))
-                    gotkey = True
-                    wait=len(self.lastwvpmeasured)*0.5
-                    answer = ["wait"+str(wait)]+deepcopy(self.BC['brewer_none'])
-
-            elif ncommas==4:
-                # for example L,a,b,c,d: Set parameters, like set the brewer clock #example: L,20248,0,20249,255
-                if "L," in line:
-                    _,a,b,c,d=line.split(",")
-                    self.lastL=[int(a),int(b),int(c),int(d)]
-                    self.logger.info('Got keyword: "L,a,b,c,d"')
-                    answer = ["wait1.0"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-                elif '!TIME' in line: #Used in TD.rtn
-                    self.logger.info('Got keyworkd: "!TIME year, day, hour, min, sec"')
-                    answer=['wait0.2']+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-            elif ncommas==8: #L,16811,5,16812,79,16813,3,16814,255:Z
-                if "L," in line:
-                    _,a,b,c,d,e,f,g,h=line.split(",")
-                    self.lastL=[int(a),int(b),int(c),int(d),int(e),int(f),int(g),int(h)]
-                    self.logger.info('Got keyword: "L,a,b,c,d,e,f,g,h"')
-                    answer = ["wait1.0"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
-
-            elif ncommas==10:
-                if "L," in line: #L,16905,90,18041,14,16953,110,18057,64,16977,90 (change tracker baudrate)
-                    _,a,b,c,d,e,f,g,h,i,j=line.split(",")
-                    self.lastL=[int(a),int(b),int(c),int(d),int(e),int(f),int(g),int(h),int(i),int(j)]
-                    self.logger.info('Got keyword: "L,a,b,c,d,e,f,g,h,i,j"')
-                    answer = ["wait1.0"]+deepcopy(self.BC['brewer_none'])
-                    gotkey = True
+        return fullline.split(":")
 
+    #Function to assign an answer to each com port question
+    def check_line(self,fullline):
+        gotkey=False
+        lines=self.split_line(fullline)
+        answers=[] #to store the answer of each command.
 
+        for line in lines:
+            answer=()
+            handler,args=self.parse_command(line)
+            if handler is not None:
+                key,answer=handler(*args)
+                gotkey=gotkey or key
 
             if not gotkey:
                 s = 'Unknown command [' + str(line.replace('\r', '\\r').replace('\n', '\\n').replace('\x00', 'null')) + '] - No answer configured for this command !!'
                 self.logger.warning(s)
-                answer=[]
+                answer=()
 
             answers.append(answer) #Store the answer of the current analyzed command.
 
         #Once all commands has been processed, and all the answers are known: decide which will be the final answer.
-        if ncommands==1: #Case of only one command in the fullline
+        if len(lines)==1: #Case of only one command in the fullline
             fanswer=answers[0]
         else: #Case of multiple commands in the fullline:
             # the final answer will be the first one that contains the brewer_somehting characters in.
             # Otherwise, it will be the last answer.
             for fanswer in answers:
-                if len(fanswer)>=self.bsl:
-                    if fanswer[-self.bsl:] == self.BC['brewer_something']:
-                        self.lastanswer=deepcopy(fanswer)
-                        break
+                if len(fanswer)>0 and fanswer[-1].payload.endswith(self.BC['brewer_something']):
+                    self.lastanswer=fanswer
+                    break
 
         return gotkey, fanswer
 
+    #------------------
+    #Commands without arguments
+
+    def cmd_newline(self):
+        self.logger.info('Got keyword: "\\n"')
+        return True, self.none(0.1)
+
+    def cmd_return(self):
+        self.logger.info('Got keyword: "\\r"')
+        return True, self.none(0)
+
+    def cmd_null(self):
+        #Note, depending of the sw used to create the com port bridge,
+        # a null character might not be received when the brewer software
+        # changes the baudrate from 1200 to 300bps.
+        # In this case, we could force the brewer software to write a signal to know when is it happening:
+        # in re-mb, add the line:
+        # 13091 IF Q16%=0 THEN O1$="NULL":GOSUB 9450
+        self.logger.info('Got keyworkd: "Null"')
+        if not self.onre:
+            self.onre=True #first time passing here: start of re.rtn
+            if not self.IOS_board:
+                self.curr_baudrate=300 #change baudrate to 300
+        else:
+            self.onre=False #second time passing here: end of re.rtn
+            if not self.IOS_board:
+                self.curr_baudrate=deepcopy(self.com_baudrate) #change baudrate back to its original value
+        return True, self.NULL_ANSWER
+
+    #Answer to the break (see cmd_null): the Brewer start-up banner, at 300bps
+    NULL_ANSWER=(Frame(5,tobytes('\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00BREWER OZONE SPECTROPHOTOMETER\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00         #072\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00     ')),
+                 Frame(2,tobytes('AES  SCI-TEC\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00        CANADA\r\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\n\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00  VERSION 39.5 NOV 22, 1982\r\n\x00\x00\x00\x00\x00\x00\x00\x00')),
+                 Frame(0.8,tobytes('\x00\x00\x00\x00\r\n\x00\x00\x00\x00\x00\x00-> ')))
+
+    def cmd_O(self): #Return the measured signals of the last R,p1,p2,p3 command.
+        self.logger.info('Got keyworkd: "O" -> Get last measurement data ')
+        signals=[]
+        for wvp in self.lastwvpmeasured:
+            try:
+                signals.append(str(self.lastwvpsignal[wvp]).rjust(9))
+            except:
+                self.logger.error("Cannot concatenate signal, self.lastwvpsignal[wvp]="+str(self.lastwvpsignal[wvp]))
+        return True, self.something(1.0,",".join(signals))
+
+    def cmd_Z(self): #get last read sensor value
+        gotkey=False
+        answer=()
+        ss='Got keyworkd: "Z", get sensor reading: '
+        if len(self.lastL)==2: #for example L,19414,120
+            if self.lastL==[19414,120]:
+                ss+="move az to AZC, value: none"
+                self.logger.info(ss)
+                answer=self.none(0.2)
+            if self.lastL==[19414,255]:
+                ss+="move ze to ZEC, value: none"
+                self.logger.info(ss)
+                answer=self.none(0.2)
+        elif len(self.lastL)==4: ##for example L,20248,0,20249,255:Z
+            if [self.lastL[0],self.lastL[2],self.lastL[3]]==[20248,20249,255]: # for example: [20248,x,20249,255]:
+                x=self.lastL[1] #sensor index
+                v=self.AnalogSensors[x]["value_"+self.bmodel] #get value for respective sensor and respective model
+                n=self.AnalogSensors[x]["name"]
+                ss+=n + ", value: "+str(v)
+                self.logger.info(ss)
+                answer=self.something(0.2,str(v).rjust(4))
+                gotkey = True
+        elif len(self.lastL)==8: #for example L,16811,5,16812,79,16813,3,16814,255
+            if self.lastL==[16811,5,16812,79,16813,3,16814,255]: #AP.rtn, communication test with AD board
+                ss+="Communication test with AD board, value: 49"
+                self.logger.info(ss)
+                answer = self.something(0.2,"49".rjust(4))
+        elif len(self.lastL)==10: #for example L,16905,90,18041,14,16953,110,18057,64,16977,90
+            if self.lastL==[16905,90,18041,14,16953,110,18057,64,16977,90]: #Change tracker baudrate
+                ss+="Change tracker baudrate, value: none"
+                self.logger.info(ss)
+                answer = self.none(0.2)
+        return gotkey, answer
+
+    def cmd_T(self): #Re-transmit the output of the most recent non-null response
+        self.logger.info('Got keyworkd: "T"')
+        return True, self.lastanswer
+
+    def cmd_R_repeat(self): #Command R: repeat last R,p1,p2,p3 measurement
+        self.logger.info('Got keyword: "R", replaced by the last R command: "R,'+str(self.Rp1)+","+str(self.Rp2)+","+str(self.Rp3)+'"')
+        return self.cmd_R(self.Rp1,self.Rp2,self.Rp3)
+
+    def cmd_RH_SLOPE(self):
+        self.logger.info('Got keyworkd: "?RH.SLOPE"')
+        return True, self.something(0.2,'0.031088')
+
+    def cmd_RH_ORIGIN(self):
+        self.logger.info('Got keyworkd: "?RH.ORIGIN"')
+        return True, self.something(0.2,'0.863000')
+
+    def cmd_STEPS(self):
+        #The number of steps ina complete revolution of the azimuth tracker
+        self.logger.info('Got keyword: STEPS')
+        return True, self.something(0.1,str(self.spr).rjust(9)) #is needed to check that the rjust is correct
+
+    def cmd_LOGENTRY(self):
+        self.logger.info('Got keyworkd: "LOGENTRY"')
+        return True, self.none(0.2,"All log items reported.")
+
+    #------------------
+    #Queries ?NAME[x]
+
+    def cmd_MOTOR_CLASS(self,x):
+        self.logger.info('Got keyword: "?MOTOR.CLASS[x]"')
+        if x==2:
+            return True, self.something(0.1,'TRACKERMOTOR')
+        return False, ()
+
+    def cmd_MOTOR_POS(self,x):
+        self.logger.info('Got keyword: ?MOTOR.POS[x]') #Get current position (not sure if from zero, or fromled)
+        return True, self.something(0.1,str(self.Motors[x]["steps_fromzero"]).rjust(9)) #is needed to check that the rjust is correct
+
+    def cmd_MOTOR_ZERO_POS(self,x):
+        self.logger.info('Got keyword: ?MOTOR.ZERO.POS[x]')
+        return True, self.something(0.1,str(self.Motors[x]["zerostep_now"]).rjust(9)) #is needed to check that the rjust is correct
+
+    def cmd_MOTOR_ORIGIN(self,x):
+        self.logger.info('Got keyword: ?MOTOR.ORIGIN[x]')
+        return True, self.something(0.1,str(self.Motors[x]["zerostep_ini"]).rjust(9)) #is needed to check that the rjust is correct
+
+    def cmd_MOTOR_SLOPE(self,x):
+        self.logger.info('Got keyword: ?MOTOR.SLOPE[x]')
+        #Not tested, I think it is to get the steps/degree
+        #The azimuth steps per turn can be taken from the OP_ST.xxx, row 17; Azimuth steps per revolution
+        #is needed to check that the rjust is correct
+        return True, self.something(0.1,str(self.Motors[x]["spd"]).rjust(9))
+
+    def cmd_MOTOR_DISCREPANCY(self,x):
+        self.logger.info('Got keyword: ?MOTOR.DISCREPANCY[x]')
+        return True, self.something(0.1,str(0).rjust(9)) #is needed to check that the rjust is correct
+
+    TEMPERATURES={'PMT':'19.158888','FAN':'19.633333','BASE':'17.637777','EXTERNAL':'-37.777777'}
+
+    def cmd_TEMP(self,x):
+        if x not in self.TEMPERATURES:
+            return False, ()
+        self.logger.info('Got keyworkd: "?TEMP['+x+']"')
+        return True, self.something(0.2,self.TEMPERATURES[x])
+
+    def cmd_ANALOG_NOW(self,x):
+        answer = self.something(0.1,str(self.AnalogSensors[x]["value_"+self.bmodel]).rjust(9)) #is needed to check that the rjust is correct
+        self.logger.info('Got keyworkd: "?ANALOG.NOW[x]" -> Get sensor reading of: '+self.AnalogSensors[x]["name"])
+        return True, answer
+
+    #------------------
+    #Commands with arguments
+
+    def cmd_B(self,l): #Turn on/off the lamps
+        self.AnalogSensors=dict((k,dict(v)) for k,v in self.AnalogSensors_ini.items()) #(copy of the 2 levels, faster than deepcopy)
+        if l==0:
+            self.logger.info('Got keyword: "B,0" -> Turn off all Lamps')
+            self.FEL_lamp=False
+            self.HG_lamp=False
+        elif l==1:
+            self.logger.info('Got keyword: "B,1" -> Turn on the Mercury Lamp')
+            self.FEL_lamp=False
+            self.HG_lamp=True
+            self.AnalogSensors[16]['value_mkiii']=755
+            self.AnalogSensors[17]['value_mkiii']=679
+            self.AnalogSensors[18]['value_mkiii']=256
+            self.AnalogSensors[19]['value_mkiii']=99
+            self.AnalogSensors[21]['value_mkiii']=20.58
+            self.AnalogSensors[22]['value_mkiii']=8
+            self.AnalogSensors[23]['value_mkiii']=17
+
+            self.AnalogSensors[16]['value_mkii']=755
+            self.AnalogSensors[17]['value_mkii']=679
+            self.AnalogSensors[18]['value_mkii']=256
+            self.AnalogSensors[19]['value_mkii']=99
+            self.AnalogSensors[21]['value_mkii']=20.58
+            self.AnalogSensors[22]['value_mkii']=8
+            self.AnalogSensors[23]['value_mkii']=17
+
+        elif l==2:
+            self.logger.info('Got keyword: "B,2" -> Turn on the Quartz Halogen Lamp (FEL)')
+            self.FEL_lamp=True
+            self.HG_lamp=False
+            self.AnalogSensors[8]['value_mkiii']=305
+            self.AnalogSensors[14]['value_mkiii']=776
+            self.AnalogSensors[15]['value_mkiii']=886
+
+            self.AnalogSensors[8]['value_mkii']=6
+            self.AnalogSensors[14]['value_mkii']=156
+            self.AnalogSensors[15]['value_mkii']=239
+
+        elif l==3:
+            self.logger.info('Got keyword: "B,3" -> Turn on Quartz and Mercury Lamp')
+            self.FEL_lamp=True
+            self.HG_lamp=True
+            self.AnalogSensors[8]['value_mkii']=305
+            self.AnalogSensors[8]['value_mkiii']=305
+        else:
+            return False, ()
+        return True, self.none(0.2)
+
+    def cmd_G(self,*Glist): #G,544
+        #Get command, Transmit to the terminal the byte values located at the COSMAC Input Output addresses, p1, p2, ..., pX
+        #For example, G,544 read end stop status of motor 10. It returns a value in the range 0-255 for each byte queried.
+        #544= Status of slit mask & micromter motors
+        #800=Status of Zen-prism & Az-tracker motors
+        #1056=Status of Iris & Filterwheel motors
+        #20244-20257=A/D table (not implemented here)
+        #16440-61447=Real-Time Clock (not implemented here)
+        #63488-65535=Battery-backed-up Ram (not implemented here)
+        self.logger.info('Got keyword: "G" Get data from COSMAC I/O.')
+        Gnames={544:'Address 544: Get status of Slit Mask and Micrometer motors.',
+                800:'Address 800: Get status of Zen-prism and Az tracker motors.',
+                1056:'Address 1056: Get status of Iris and Filterwheel motors.'}
+        Glistansw=[]
+        for p in Glist:
+            if p in Gnames:
+                self.logger.info(Gnames[p])
+                res,stid=self.getGstatus(p)
+                self.logger.info('Address '+str(p)+' status= '+str(res))
+                for i in stid:
+                    self.logger.info("Status enabled: "+str(i))
+                Glistansw+=[str(res).rjust(4)+","]
+            else:
+                self.logger.warning("Unknown G address, p="+str(p))
+                return False, ()
+        return True, self.something(0.5,''.join(Glistansw))
+
+    def cmd_I(self,m): #Initialize the specified motor to its zero position and set the corresponding step up accumulator to 0
+        self.Motors[m]['steps_fromled']=deepcopy(self.Motors[m]['zerostep_now'])
+        self.update_motor_pos(m)
+        self.logger.info('Got keyword: "I,m" -> Initialize motor ('+str(m)+'), to its zero position (zerostep_now='+str(self.Motors[m]['zerostep_now'])+')')
+        return True, self.none(0.5)
+
+    def cmd_E(self,x):
+        if x==1:
+            self.logger.info('Got keyword: "E,1" -> unknown (related to zenith motor zeroing)')
+            return True, self.something(0.5,"-   61")
+        elif x==2:
+            self.logger.info('Got keyword: "E,2" -> unknown (related to azimuth motor zeroing)')
+            return True, self.something(0.5,"- 6503")
+        return False, ()
+
+    def cmd_M(self,m,p): # for example M,m,p: Move the m motor, to the x position
+        if p<0:
+            self.Motors[m]['steps_fromled']=self.Motors[m]['steps_fromled']+p
+            self.Motors[m]['zerostep_now']=deepcopy(self.Motors[m]['steps_fromled'])
+            self.logger.info('Got keyworkd: "M,m,-p" -> Move motor '+str(m)+' ('+str(self.Motors[m]['id'])+')'+\
+                             ' '+str(p)+' steps backwards and set new zerostep_now ('+\
+                             str(self.Motors[m]['zerostep_now'])+')')
+        else:
+            self.Motors[m]['steps_fromled'] =p #Store the last selected position of this motor
+            self.logger.info('Got keyworkd: "M,m,p" -> Move motor '+str(m)+' ('+str(self.Motors[m]['id'])+')'+\
+                             ' to step '+str(p)+'.')
+        ss=self.update_motor_pos(m)
+        self.logger.info(ss)
+        #Update Gdict status:
+
+        #Micrometer
+        if self.Motors[10]["steps_fromled"] in [501,51,67]:
+            self.Gdict[544][2]["status"]=1  #Micrometer at maximum-wavelength position
+        else:
+            self.Gdict[544][2]["status"]=0
 
+        #Azimuth tracker motor - CW end stop
+        if self.Motors[2]["steps_fromled"] <= 0:
+            self.Gdict[800][2]["status"]=1 #Azimuth CW opto sensor blocked
+        elif self.Motors[2]["steps_fromled"]>=self.spr-400 and self.Motors[2]["steps_fromled"]<=self.spr:
+            self.Gdict[800][2]["status"]=1 #Azimuth CW opto sensor blocked (needed for sr.rtn)
+        else:
+            self.Gdict[800][2]["status"]=0
 
+        #Zenith prism motor - fully closed end stop
+        if self.Motors[1]["steps_fromled"] == 0: #Zenith prism pointing down
+            self.Gdict[800][4]["status"]=0 #Zenith prism pointing down (active low)
+        else:
+            self.Gdict[800][4]["status"]=1
 
+        #Iris motor - fully closed end stop
+        if self.Motors[3]["steps_fromled"] == 0: #iris fully closed
+            self.Gdict[1056][4]["status"]=0 #Iris fully closed (active low)
+        else:
+            self.Gdict[1056][4]["status"]=1
 
+        #Iris motor - fully opened end stop
+        if self.Motors[3]["steps_fromled"] == 250: #iris fully open
+            self.Gdict[1056][5]["status"]=0 #Iris fully open (active low)
+        else:
+            self.Gdict[1056][5]["status"]=1
+
+        return True, self.none(1.0)
+
+    def cmd_F(self,count,ascicode): #For example "F,0,2"
+        #Define the fill characters (those characters transmited as a 'header' before each output message)
+        # to be used at the start of every transmission from the Brewer to the controller, when using the TTY interface low level protocol.
+        # F,p1,p2. p1 = repetitions. p2 = fill character.
+        # the default values are 6 and 0 respectively, producing 6 ascii nulls
+        # ASCII characters: https://theasciicode.com.ar/
+        # ignore it, leave as default.
+        self.logger.info('Got keyword: "F,count,ascicode" -> Define the fill characters for low level communication')
+        return True, self.none(0.2)
+
+    def cmd_V(self,cps,echo): #For example "V,cps,echo": Set baudrate and the flag which controls echoing
+        self.logger.info('Got keyword: "V,cps,echo" -> Set Baudrate to '+str(10*cps)+' and echo to '+str(echo=="1"))
+        self.curr_baudrate=cps*10
+        return True, self.none(0.2)
+
+    def cmd_L(self,*args):
+        # for example L,a,b: Set parameters, example: L,19414,120
+        # or L,a,b,c,d: Set parameters, like set the brewer clock #example: L,20248,0,20249,255
+        # or L,16811,5,16812,79,16813,3,16814,255:Z
+        # or L,16905,90,18041,14,16953,110,18057,64,16977,90 (change tracker baudrate)
+        self.lastL=list(args)
+        self.logger.info('Got keyword: "L,'+','.join('abcdefghij'[:len(args)])+'"')
+        return True, self.none(0.5 if len(args)==2 else 1.0)
+
+    def cmd_D(self,*Dlist): #D,2955,2956
+        #"D,p1,p2", Dump command: Transmit to the terminal the byte values located at COSMAC memory addresses p1,p2,...,pX.
+        #p1,p2,...,pX are 16 bit COSMAC memory addresses written as signed decimal numbers in the range -32768..32767
+        #Values corresponding to each pX are returned in a list.
+        self.logger.info('Got keyword: "D", Get data from COSMAC memory.')
+        Dlistansw=[]
+        for p in Dlist:
+            if p==2955:
+                self.logger.info('Address 2955: Check for UART (0).')
+                Dlistansw+=["   0,"]
+            elif p==2956:
+                self.logger.info('Address 2956: Check for UART (1).')
+                Dlistansw+=["   0,"]
+            else:
+                self.logger.warning("Unknown D address")
+                return False, ()
+        return True, self.something(0.5,''.join(Dlistansw))
+
+    def cmd_R(self,Rp1,Rp2,Rp3):
+        #R,p1,p2,p3: Measure light intensity.
+        # p1 -Initial wavelenght position: may take values form 0 to 7.
+        # p2 -Final wavelenght position: may take values from p1 to 7.
+        # p3 - repetitions: may take values from 1 to 255
+        #if there are no parameters specified, the parameters from the previous R command are used (see cmd_R_repeat).
+        #the measurements are then read by the O, command.
+        self.Rp1=Rp1 #save last p1
+        self.Rp2=Rp2 #save last p2
+        self.Rp3=Rp3 #save last p3
+        self.lastwvpmeasured=range(self.Rp1,self.Rp2+1) #For example, if R,2,4,1 -> wv positions to be measured = [2,3,4]
+        #Generate signals depending of different conditions:
+        #Signal will be stored in self.lastwvpsignal dictionary.
+
+        #While running an HG routine:
+        if self.HG_lamp:
+            self.logger.info("In HG measurement")
+            self.lastwvpsignal={}
+            if (Rp1,Rp2,Rp3)==(0,7,1): #initial quick scan over all wvp
+                signals=[1068,0,38,73,17035,51,22,115]
+                self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i] for i in self.lastwvpmeasured}
+            elif (Rp1,Rp2,Rp3)==(2,2,4): #hs.rtn
+                self.lastwvpsignal[2]=int(10*rand()) #This is simply to avoid division by zero in hs.rtn
+            else: #HG.rtn: check of signal at different motor[10] positions:
+                #The signal with depend of the latest motor[10] position, and selected wvp. (only wvp 0 is measured)
+                mstep=self.Motors[10]['steps_fromled']
+                #gaussian multiplicator factor [0-1], centered at step 148. (Center should be between [147 to 149])
+                if self.bmodel=="mkiii":
+                    mult=self.gaussian(mstep,148,60) #B185, std of 60. -> adjust the std until having a correlation factor > 0.9
+                else:
+                    mult=self.gaussian(mstep,148,20) #B072, std of 20. -> adjust the std until having a correlation factor > 0.9
+                signal=int(mult*self.hglevel)
+                self.logger.info("step="+str(mstep)+", mult="+str(mult)+", signal="+str(signal))
+                for wvp in self.lastwvpmeasured: #Generate signals for each wv position:
+                    if wvp==0:
+                        self.lastwvpsignal[wvp]=deepcopy(signal)
+                    else:
+                        self.lastwvpsignal[wvp]=0
+
+        #While FEL lamp is on:
+        elif self.FEL_lamp:
+            self.logger.info("In FEL measurement")
+            self.lastwvpsignal={}
+            if (Rp1,Rp2)==(0,7): #SL.rtn (R,0,7,1) or RS.rtn (R,0,7,5) -> initial quick scan over all wvp
+                signals=[3747,0,35927,40439,45369,40758,32717,79062]
+                self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i]*Rp3 for i in self.lastwvpmeasured}
+            elif (Rp1,Rp2,Rp3)==(0,6,20): #SL.rtn -> measurements
+                signals=[77444,7,746834,840075,939058,846241,678921]
+                #self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i]+int(10*rand()) for i in self.lastwvpmeasured}
+                self.lastwvpsignal={self.lastwvpmeasured[i]:signals[i] for i in self.lastwvpmeasured}
+            elif (Rp1,Rp2,Rp3)==(6,6,4): #HP.rtn
+                #The signal with depend of the latest motor[9] position, and selected wvp. (only wvp 6 is measured)
+                mstep=self.Motors[9]['steps_fromled'] #in theory, while doing an HP, it usually vary from 0 to 160, in 10 steps.
+                signal=self.FEL_signal[mstep]
+                for wvp in self.lastwvpmeasured: #Generate signals for each wv position:
+                    if wvp==6:
+                        self.lastwvpsignal[wvp]=int(signal)
+                    else:
+                        self.lastwvpsignal[wvp]=0
+            else: #For any other case, like RS.rtn, Generate random signals for each wv position:
+                for wvp in self.lastwvpmeasured:
+                    if wvp==1:
+                        signal=5+int(10*rand())
+                        self.lastwvpsignal[wvp]=int(signal)
+                    else:
+                        signal=1000+int(100*rand())
+                        self.lastwvpsignal[wvp]=int(signal)
 
+        #In general operation:
+        else:
+            #Give a random signal
+            self.lastwvpsignal={}
+            for wvp in self.lastwvpmeasured:
+                if wvp==0: #HG calibration 302.1
+                    self.lastwvpsignal[wvp]=int(0.0)
+                elif wvp==1: #Dark count
+                    self.lastwvpsignal[wvp]=int(0.0)
+                elif wvp==2: #wv1 306nm (used in uv scan)
+                    self.lastwvpsignal[wvp]=int(19.0)
+                elif wvp==3: #wv2 310nm
+                    self.lastwvpsignal[wvp]=int(84)
+                elif wvp==4: #wv3 313.5nm
+                    self.lastwvpsignal[wvp]=int(307)
+                elif wvp==5: #wv4 316.8nm
+                    self.lastwvpsignal[wvp]=int(581)
+                elif wvp==6: #wv5 320.0nm
+                    self.lastwvpsignal[wvp]=int(2)
+                elif wvp==7: #wv2 & wv4 -> Deadtime test
+                    self.lastwvpsignal[wvp]=int(10)
+
+                self.lastwvpsignal[wvp]+=int(rand()*5) #Add some random counts to avoid problems when calculating the statistics
+
+        ss='Got keyword: "R,p1,p2,p3" '
+        if self.FEL_lamp:
+            ss+="(FEL Lamp ON) "
+        if self.HG_lamp:
+            ss+="(HG Lamp ON) "
+        self.logger.info(ss+'-> Measuring light for wv positions '+str(self.lastwvpmeasured)+", signals: "+str(self.lastwvpsignal))
+        return True, self.none(len(self.lastwvpmeasured)*0.5)
+
+    def cmd_TIME(self,year,day,hour,minute,second): #Used in TD.rtn: !TIME year, day, hour, min, sec
+        self.logger.info('Got keyworkd: "!TIME year, day, hour, min, sec"')
+        try:
+            brewertime=datetime.datetime(int(year),1,1)+datetime.timedelta(days=int(day)-1,hours=int(hour),minutes=int(minute),seconds=float(second))
+            simulatedtime=datetime.datetime.utcfromtimestamp(self.clock.time())
+            self.logger.info('Brewer clock set to '+brewertime.strftime("%Y-%m-%d %H:%M:%S")+', simulated time is '+simulatedtime.strftime("%Y-%m-%d %H:%M:%S")+\
+                             ' ('+str(int(round((brewertime-simulatedtime).total_seconds())))+' seconds of difference)')
+        except (ValueError,OverflowError):
+            self.logger.warning('Cannot understand the time of the "!TIME" command: '+','.join([year,day,hour,minute,second]))
+        return True, self.none(0.2)
 
 
 
 
 
 
-    def run(self):
-        #Open serial connection:
+
+
+    def open_port(self):
+        #Open serial connection (its input is flushed in run, once all the ports are open):
         self.logger.info('Opening '+str(self.com_port)+' serial connection...')
         sw = serial.Serial(self.com_port, baudrate=self.com_baudrate, timeout=self.com_timeout)
         try:
@@ -949,75 +1076,321 @@ class Brewer_simulator:
         except:
             pass
         sw.open()
+        return sw
 
-        #this is for changing the end of line detection
-        #sio = io.TextIOWrapper(io.BufferedRWPair(sw, sw))
+    def answer_line(self,fullline):
+        '''
+        gotkey, answer, baudrate = self.answer_line(fullline)
 
-        time.sleep(1)
-        sw.flushInput()
-        line_counter=0
-        self.logger.info('Done. Monitoring serial...')
+        Answer a line received from the serial port (see check_line), and log it.
+        <baudrate> baudrate to be set in the port before writing the answer.
+        '''
+        self.logger.info('Command received: '+str(fullline).replace('\r','\\r').replace('\n','\\n').replace('\x00','\\x00'))
+        try:
+            gotkey, answer = self.check_line(fullline)
+        except ValueError:
+            logl="Could not parse line {}, skipping".format(fullline.replace('\r','\\r').replace('\n','\\n').replace('\x00','\\x00'))
+            self.logger.warning(logl)
+            warnings.warn(logl)
+            return False, (), self.curr_baudrate
+        except Exception as e: #Not to stop the other instruments of the SerialLoop
+            self.logger.error("Exception happened: "+str(e))
+            return False, (), self.curr_baudrate
+        if gotkey:
+            self.logger.info('Writing answer to com port:'+str(answer))
+            if len(answer)==0:
+                self.logger.warning('len(answer)==0!!!!')
         self.logger.info('--------------------------')
+        return gotkey, answer, self.curr_baudrate
+
+    def run(self):
+        #Simulate this instrument, and the ones given with --instrument, all of them served by the same SerialLoop
+        simulators=[self]+[Brewer_simulator(i) for i in self.instruments]
+        loop=SerialLoop()
+        ports=[]
+        for simulator in simulators:
+            try:
+                ports.append((simulator.open_port(),simulator))
+            except Exception as e:
+                if len(simulators)==1:
+                    raise
+                simulator.logger.error("Cannot open "+str(simulator.com_port)+", instrument not simulated: "+str(e))
+        time.sleep(1)
+        for sw,simulator in ports:
+            sw.flushInput()
+            loop.add(sw,simulator)
+            simulator.logger.info('Done. Monitoring serial...')
+            simulator.logger.info('--------------------------')
         try:
-            with sw:
-                while True:
-                    if sw.inWaiting() > 0:
-                        try:
-                            #line = sio.readline()
-                            fullline=''
-                            c=''
-                            while (c != '\r'): #while2
-                                c=sw.read(1)
-                                if python_version[0]>2:
-                                    c=c.decode("latin1") #Convert received bytes into str
-                                fullline += c
-                                if (fullline == '\x00') or (fullline == 'NULL'):
-                                    break #Exit while2 loop
-                            time.sleep(0.01) #Minimum process time
-                            self.logger.info('Command received: '+str(fullline).replace('\r','\\r').replace('\n','\\n').replace('\x00','\\x00'))
-                            gotkey, answer = self.check_line(fullline)
-                            if gotkey:
-                                if sw.baudrate != self.curr_baudrate:
-                                    self.logger.info('Changing baudrate to '+str(self.curr_baudrate))
-                                    sw.baudrate=deepcopy(self.curr_baudrate)
-
-                                self.logger.info('Writing answer to com port:'+str(answer))
-
-                                if len(answer)==0:
-                                    self.logger.warning('len(answer)==0!!!!')
-                                for a in answer:
-                                    if 'wait' in a:
-                                        time.sleep(float(a.split('wait')[1]))
-                                    elif 'flush' in a:
-                                        #sio.flush()
-                                        sw.flush()
-                                    else:
-                                        try:
-                                            if python_version[0]>2:
-                                                sw.write(a.encode("latin1")) #convert str to bytes
-                                            else:
-                                                sw.write(a)
-                                        except Exception as e:
-                                            self.logger.error("Cannot write into serial")
-                            self.logger.info('--------------------------')
-
-                        except ValueError:
-                            logl="Could not parse line {}, skipping".format(fullline.replace('\r','\\r').replace('\n','\\n').replace('\x00','\\x00'))
-                            self.logger.warning(logl)
-                            warnings.warn(logl)
-                        except KeyboardInterrupt:
-                            sw.close()
-                            #ctrl+c
-                            self.logger.info('-------Exiting--------')
-                            break
-                    else:
-                        time.sleep(0.1) #General loop timer
-            self.logger.info("The COM port has been closed")
+            loop.run()
+        except KeyboardInterrupt:
+            #ctrl+c
+            self.logger.info('-------Exiting--------')
         except Exception as e:
             self.logger.error("Exception happened: "+str(e))
+        finally:
+            loop.close()
+        for sw,simulator in ports:
+            simulator.logger.info("The COM port has been closed")
+
+    #------------------
+    #Golden transcript: file with one command per line, in json format {"line": received line, "gotkey": bool,
+    #"frames": [[delay, written text], ...]} (see frames). The commands are checked in order, since the answers depend on
+    #the state left by the previous ones (motors positions, lamps...). The random signals are seeded, so they are repeatable.
+
+    def check_transcript(self):
+        '''
+        Answer the commands of the transcript file, and compare the answers with the ones saved in it.
+        With --record, the answers are saved into the transcript file instead.
+        Returns the number of different answers.
+        '''
+        import json
+        import random
+        random.seed(0)
+        with open(self.transcript,'r') as f:
+            entries=[json.loads(l) for l in f if l.strip()!='']
+        ndiff=0
+        for i,entry in enumerate(entries):
+            gotkey,answer=self.check_line(entry['line'])
+            result={'line':entry['line'],'gotkey':gotkey,'frames':frames(answer)}
+            if self.record:
+                entries[i]=result
+            elif result!=entry:
+                ndiff+=1
+                sys.stdout.write("Different answer to "+json.dumps(entry['line'])+":\n expected "+json.dumps(entry)+"\n got      "+json.dumps(result)+"\n")
+        if self.record:
+            with open(self.transcript,'w') as f:
+                for entry in entries:
+                    f.write('{"line": '+json.dumps(entry['line'])+', "gotkey": '+json.dumps(entry['gotkey'])+', "frames": '+json.dumps(entry['frames'])+'}\n')
+            sys.stdout.write(str(len(entries))+" answers saved into "+self.transcript+"\n")
+        else:
+            sys.stdout.write(str(len(entries))+" commands checked, "+str(ndiff)+" different answers\n")
+        return ndiff
+
+    def run_benchmark(self):
+        #Time to answer the lines of the transcript file (without the waits, nor the serial port), and to dispatch their
+        #commands, repeated self.benchmark times.
+        import json
+        import random
+        random.seed(0)
+        with open(self.transcript,'r') as f:
+            lines=[json.loads(l)['line'] for l in f if l.strip()!='']
+        t0=time.time()
+        for i in range(self.benchmark):
+            for line in lines:
+                self.check_line(line)
+        seconds=time.time()-t0
+        n=self.benchmark*len(lines)
+        sys.stdout.write(str(n)+" lines answered in "+('%.3f' % seconds)+" s, "+('%.1f' % (1e6*seconds/n))+" us per line\n")
+        #Only the dispatch: finding the handler of every command, and parsing its arguments
+        commands=sum([self.split_line(line) for line in lines],[])
+        t0=time.time()
+        for i in range(self.benchmark):
+            for command in commands:
+                self.parse_command(command)
+        seconds=time.time()-t0
+        n=self.benchmark*len(commands)
+        sys.stdout.write(str(n)+" commands dispatched in "+('%.3f' % seconds)+" s, "+('%.2f' % (1e6*seconds/n))+" us per command\n")
+        #Memory allocated to answer every line (peak)
+        try:
+            import tracemalloc
+            tracemalloc.start()
+            peak=0
+            for line in lines:
+                start=tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                self.check_line(line)
+                peak+=tracemalloc.get_traced_memory()[1]-start
+            tracemalloc.stop()
+            sys.stdout.write("Memory allocated per line: "+str(peak//len(lines))+" bytes (peak)\n")
+        except (ImportError,AttributeError): #python<3.9
+            pass
+
+#------------------
+#Simulated time
+
+class VirtualClock(logging.Filter):
+    '''
+    Clock of the simulated time of a Brewer, <speed> times faster than the real time, so the delays of the answers
+    (waitX, see Frame) are compressed by <speed>, or, if <speed> is None ('max'), the answers are sent without waiting
+    and the simulated time jumps forward by their delays instead. The simulated time starts at the current time.
+    It is also a logging filter, that sets the time of the log messages to the simulated time.
+    '''
+    def __init__(self,speed=1.):
+        logging.Filter.__init__(self)
+        self.speed=speed
+        self.realtime0=clock()
+        self.time0=time.time()
+        self.skipped=0. #Seconds of delays not waited (speed max)
+
+    def time(self):
+        #Current simulated time (seconds since the epoch, like time.time)
+        return self.time0+(clock()-self.realtime0)*(self.speed or 1.)+self.skipped
+
+    def realdelay(self,delay):
+        #Real seconds to wait for the simulated <delay>
+        if self.speed is None:
+            self.skipped+=delay
+            return 0.
+        return delay/self.speed
+
+    def filter(self,record):
+        record.created=self.time()
+        record.msecs=(record.created-int(record.created))*1000
+        return True
+
+#------------------
+#Serial ports I/O
+
+class SerialPort(object):
+    '''
+    Serial port <sw> of a simulated Brewer <simulator>, in a SerialLoop.
+    The received bytes are kept in a buffer until a complete line is received (ended with '\r', or the '\x00' and 'NULL'
+    break markers of re.rtn, see cmd_null), and the frames of the answers are kept in an output queue
+    [[time, payload or baudrate], ...] until their time comes (see Frame).
+    '''
+    def __init__(self,sw,simulator):
+        self.sw=sw
+        self.simulator=simulator
+        self.inbuf=b''
+        self.outqueue=deque()
+        self.lasttime=0. #Time of the last queued frame (the answers are written in order)
+        self.baudrate=sw.baudrate #Baudrate of the port once the queued frames are written
+        try:
+            self.fd=sw.fileno()
+            import fcntl
+            fcntl.fcntl(self.fd,fcntl.F_SETFL,fcntl.fcntl(self.fd,fcntl.F_GETFL)|os.O_NONBLOCK)
+        except Exception: #Windows: the port is read by a thread (see SerialLoop)
+            self.fd=None
+
+    def received(self,data,now):
+        #Process the received bytes <data>: answer every complete line, and queue its answer.
+        self.inbuf+=data
+        while len(self.inbuf)>0:
+            if self.inbuf[:1]==b'\x00':
+                line=b'\x00'
+            elif self.inbuf[:4]==b'NULL':
+                line=b'NULL'
+            else:
+                i=self.inbuf.find(b'\r')
+                if i<0:
+                    break
+                line=self.inbuf[:i+1]
+            self.inbuf=self.inbuf[len(line):]
+            if python_version[0]>2:
+                line=line.decode("latin1") #Convert received bytes into str
+            gotkey,answer,baudrate=self.simulator.answer_line(line)
+            if gotkey:
+                self.lasttime=max(now,self.lasttime)
+                if baudrate!=self.baudrate:
+                    self.outqueue.append([self.lasttime,baudrate])
+                    self.baudrate=baudrate
+                for frame in answer:
+                    self.lasttime+=self.simulator.clock.realdelay(frame.delay)
+                    self.outqueue.append([self.lasttime,frame.payload])
+
+    def send(self,now):
+        '''
+        Write the frames of the output queue whose time has come, without blocking.
+        Returns True if the port cannot accept more data now (the rest of the frame is kept in the queue).
+        '''
+        while len(self.outqueue)>0 and self.outqueue[0][0]<=now:
+            item=self.outqueue[0]
+            if isinstance(item[1],int):
+                self.simulator.logger.info('Changing baudrate to '+str(item[1]))
+                self.sw.baudrate=item[1]
+            elif self.fd is None:
+                self.sw.write(item[1])
+            else:
+                try:
+                    n=os.write(self.fd,item[1])
+                except OSError as e:
+                    if e.errno not in [errno.EAGAIN,errno.EWOULDBLOCK]:
+                        raise
+                    n=0
+                if n<len(item[1]):
+                    item[1]=item[1][n:]
+                    return True
+            self.outqueue.popleft()
+        return False
+
+    def nexttime(self):
+        #Time of the next frame to be written, or None
+        return self.outqueue[0][0] if len(self.outqueue)>0 else None
+
+class SerialLoop(object):
+    '''
+    Event loop of the serial ports of the simulator: it waits (select) until a port receives data, or can be written,
+    or until the time of the next frame of an answer, so the answers are only delayed by their waitX.
+    In Windows, where select does not work with serial ports, every port is read by a thread.
+    '''
+    def __init__(self):
+        self.ports=[]
+        self.events=None #Queue of the data read by the threads [(port, data)], in Windows
+
+    def add(self,sw,simulator):
+        port=SerialPort(sw,simulator)
+        self.ports.append(port)
+        if port.fd is None:
+            if self.events is None:
+                self.events=Queue()
+            thread=threading.Thread(target=self.reader,args=(port,))
+            thread.daemon=True
+            thread.start()
+        return port
+
+    def reader(self,port):
+        #Thread reading the port (Windows): read(1) waits until a byte is received (or the port timeout).
+        while True:
+            data=port.sw.read(1)
+            if data:
+                data+=port.sw.read(port.sw.in_waiting)
+                self.events.put((port,data))
+
+    def run(self):
+        while True:
+            now=clock()
+            blocked=[port for port in self.ports if port.send(now)]
+            times=[port.nexttime() for port in self.ports if port not in blocked and port.nexttime() is not None]
+            timeout=max(0.,min(times)-now) if len(times)>0 else None
+            if self.events is not None:
+                try:
+                    port,data=self.events.get(timeout=timeout)
+                    port.received(data,clock())
+                except Empty:
+                    pass
+                continue
+            readable,writable,_=select.select([port.fd for port in self.ports],[port.fd for port in blocked],[],timeout)
+            for port in self.ports:
+                if port.fd in readable:
+                    try:
+                        data=os.read(port.fd,4096)
+                    except OSError as e:
+                        if e.errno in [errno.EAGAIN,errno.EWOULDBLOCK]:
+                            continue
+                        raise
+                    port.received(data,clock())
+
+    def close(self):
+        for port in self.ports:
+            try:
+                port.sw.close()
+            except Exception:
+                pass
+
+def frames(answer):
+    #Convert an <answer> of check_line (tuple of frames) into a list of [delay, written text], for the transcript files.
+    return [[frame.delay,frame.payload.decode('latin1')] for frame in answer]
+
+TRANSCRIPT=os.path.join(os.path.dirname(os.path.abspath(__file__)),'Brw_simulator_transcript.jsonl')
 
 if __name__ == '__main__':
     Bs=Brewer_simulator()
-    Bs.run()
+    if Bs.benchmark>0:
+        Bs.run_benchmark()
+    elif Bs.transcript!='':
+        sys.exit(1 if Bs.check_transcript()>0 else 0)
+    else:
+        Bs.run()
 
 
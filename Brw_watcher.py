@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+#Live index of the files of the PROGRAM_PATH and bdata trees, for the long-running modes of Brw_functions.py
+#(--batch and --daemon), enabled with the BREWFUNCT_WATCH environment variable (see startwatcher in Brw_functions.py).
+
+#The index is kept up to date with the inotify events of the directories (Linux), or, if inotify is not available,
+#by checking periodically the modification time of the directories. It is used to answer the case insensitive
+#searches of exists2 and the dir queries without scanning the directories, and to log the files created with the
+#same name as another file, but with different capitalization (like DIR.TMP and dir.tmp), as soon as they appear.
+
+#This module is only imported by Brw_functions.py when the watcher is started.
+
+import os
+import time
+import struct
+import threading
+from Brw_functions import add2log, flushlog, scandir2, Context, contexts, get_ident, getenv, RACY_TIME
+
+#inotify constants (see inotify.h)
+IN_MOVED_FROM=0x40
+IN_MOVED_TO=0x80
+IN_CREATE=0x100
+IN_DELETE=0x200
+IN_DELETE_SELF=0x400
+IN_MOVE_SELF=0x800
+IN_Q_OVERFLOW=0x4000
+IN_IGNORED=0x8000
+IN_ONLYDIR=0x1000000
+IN_ISDIR=0x40000000
+IN_CLOEXEC=0o2000000
+WATCH_MASK=IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE|IN_DELETE_SELF|IN_MOVE_SELF|IN_ONLYDIR
+POLL_INTERVAL=5.0 #Seconds between the checks of the directories, when inotify is not available.
+
+
+def _fsencode(path):
+    if isinstance(path,bytes):
+        return path #python 2 str
+    return path.encode('utf-8','surrogateescape')
+
+def _fsdecode(name):
+    if isinstance(name,str):
+        return name #python 2 str
+    return name.decode('utf-8','surrogateescape')
+
+class Inotify(object):
+    '''
+    Minimal interface to the Linux inotify API, through ctypes.
+    Raises OSError if inotify is not available.
+    '''
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+        if not hasattr(self.libc,'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd=self.libc.inotify_init1(os.O_NONBLOCK|IN_CLOEXEC)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+        self.get_errno=ctypes.get_errno
+
+    def add_watch(self,path,mask=WATCH_MASK):
+        #Watch the directory <path>, and return its watch descriptor.
+        wd=self.libc.inotify_add_watch(self.fd,_fsencode(path),mask)
+        if wd<0:
+            raise OSError(self.get_errno(),"inotify_add_watch failed for "+path)
+        return wd
+
+    def read(self):
+        #Return the list of pending events [(wd, mask, name), ...], without blocking.
+        events=[]
+        while True:
+            try:
+                data=os.read(self.fd,65536)
+            except OSError: #EAGAIN, no more events
+                break
+            pos=0
+            while pos+16<=len(data):
+                wd,mask,cookie,length=struct.unpack_from('iIII',data,pos)
+                name=_fsdecode(data[pos+16:pos+16+length].rstrip(b'\x00'))
+                events.append((wd,mask,name))
+                pos+=16+length
+        return events
+
+    def close(self):
+        #Close the inotify file descriptor (and so, remove all its watches).
+        if self.fd>=0:
+            os.close(self.fd)
+            self.fd=-1
+
+class DirWatcher(object):
+    '''
+    watcher = DirWatcher(roots,mode='inotify')
+
+    Keep an in-memory index of the files of every directory of the <roots> trees (following the inotify events, or
+    checking the directories modification time if <mode> is 'poll' or inotify is not available), and log the
+    duplicated files (same name but different capitalization) as soon as they are created.
+    The messages are written with the environment variables of the context where the watcher is created
+    (so into the Brw_functions log file of its instrument).
+    '''
+    def __init__(self,roots,mode='inotify'):
+        self.roots=sorted(set([os.path.realpath(i) for i in roots if i!='' and os.path.isdir(i)]))
+        self.lock=threading.RLock()
+        self.names={} #{dirpath: {lowercase filename: [real filenames]}}
+        self.indexes={} #{dirpath: {lowercase filename: real filename}}, as returned by getdirindex
+        self.stats={} #{dirpath: [mtime, scantime]}, used in poll mode
+        self.wds={} #{watch descriptor: dirpath}, only in inotify mode
+        self.context=Context(env=dict((k,getenv(k)) for k in ['PROGRAM_PATH','BREWFUNCT_LOG_DIR','BREWFUNCT_LOG_MAXSIZE','BREWFUNCT_INSTRUMENT'] if getenv(k) is not None))
+        self.inotify=None
+        if mode!='poll':
+            try:
+                self.inotify=Inotify()
+            except (OSError,AttributeError) as e:
+                add2log("Brw_functions.py, watcher, inotify not available ("+str(e)+"), checking the directories every "+str(POLL_INTERVAL)+" seconds.",level="WARNING")
+        self.mode='inotify' if self.inotify is not None else 'poll'
+        with self.lock:
+            for root in self.roots:
+                self.adddir(root,log=False)
+        self.thread=threading.Thread(target=self.run,name='Brw_functions_watcher')
+        self.thread.daemon=True
+        self.thread.start()
+        add2log("Brw_functions.py, watcher, watching "+', '.join(self.roots)+" ("+self.mode+" mode, "+str(len(self.names))+" directories).")
+
+    def adddir(self,dirpath,log=True):
+        #Add the directory <dirpath> and its subdirectories to the index.
+        dirs=[dirpath]
+        while len(dirs)>0:
+            path=dirs.pop()
+            if self.inotify is not None:
+                try:
+                    self.wds[self.inotify.add_watch(path)]=path
+                except OSError as e: #Usually, the limit of watches (fs.inotify.max_user_watches) has been reached
+                    self.log("cannot watch "+path+" ("+str(e)+"), checking the directories every "+str(POLL_INTERVAL)+" seconds.","WARNING")
+                    self.inotify.close()
+                    self.inotify=None
+                    self.wds={}
+                    self.mode='poll'
+            scantime=time.time()
+            try:
+                mtime=os.stat(path).st_mtime
+                entries=list(scandir2(path))
+            except OSError:
+                continue
+            self.stats[path]=[mtime,scantime]
+            self.names[path]={}
+            self.indexes[path]={}
+            for entry in entries:
+                self.addname(path,entry.name,log)
+                if entry.is_dir() and not entry.is_symlink():
+                    dirs.append(entry.path)
+
+    def removedir(self,dirpath):
+        #Remove the directory <dirpath> and its subdirectories from the index.
+        prefix=os.path.join(dirpath,'')
+        for path in [i for i in self.names if i==dirpath or i.startswith(prefix)]:
+            del self.names[path]
+            del self.indexes[path]
+            self.stats.pop(path,None)
+
+    def addname(self,dirpath,name,log=True):
+        names=self.names[dirpath].setdefault(name.lower(),[])
+        if name not in names:
+            names.append(name)
+        self.indexes[dirpath].setdefault(name.lower(),name)
+        if log and len(names)>1:
+            self.log("!!!! found duplicated files in "+dirpath+": "+str(names),"ERROR")
+
+    def removename(self,dirpath,name):
+        names=self.names[dirpath].get(name.lower(),[])
+        if name in names:
+            names.remove(name)
+        if len(names)>0:
+            self.indexes[dirpath][name.lower()]=names[0]
+        else:
+            self.names[dirpath].pop(name.lower(),None)
+            self.indexes[dirpath].pop(name.lower(),None)
+
+    def log(self,message,level):
+        #Write a message of the watcher thread into the Brw_functions log file.
+        ident=get_ident()
+        previous=contexts.get(ident)
+        contexts[ident]=self.context
+        try:
+            add2log("Brw_functions.py, watcher, "+message,level=level)
+            flushlog()
+        finally:
+            if previous is None:
+                del contexts[ident]
+            else:
+                contexts[ident]=previous
+
+    def update(self):
+        #Apply the pending changes of the directories to the index.
+        if self.inotify is not None:
+            for wd,mask,name in self.inotify.read():
+                if mask & IN_Q_OVERFLOW:
+                    self.log("too many inotify events, scanning again all the directories.","WARNING")
+                    self.names,self.indexes,self.stats={},{},{}
+                    for root in self.roots:
+                        self.adddir(root,log=False)
+                    continue
+                dirpath=self.wds.get(wd)
+                if mask & IN_IGNORED:
+                    self.wds.pop(wd,None)
+                if dirpath is None or dirpath not in self.names or name=='':
+                    continue
+                path=os.path.join(dirpath,name)
+                if mask & (IN_CREATE|IN_MOVED_TO):
+                    self.addname(dirpath,name)
+                    if mask & IN_ISDIR:
+                        self.adddir(path)
+                elif mask & (IN_DELETE|IN_MOVED_FROM):
+                    self.removename(dirpath,name)
+                    if mask & IN_ISDIR:
+                        self.removedir(path)
+        else:
+            for dirpath in list(self.names):
+                self.refresh(dirpath)
+
+    def refresh(self,dirpath):
+        #Poll mode: scan again the directory <dirpath> if it has changed, and apply the differences to the index.
+        if dirpath not in self.names:
+            return
+        try:
+            mtime=os.stat(dirpath).st_mtime
+        except OSError:
+            self.removedir(dirpath)
+            return
+        [imtime,iscantime]=self.stats.get(dirpath,[None,0.])
+        if imtime==mtime and iscantime-imtime>RACY_TIME:
+            return
+        scantime=time.time()
+        try:
+            entries=dict((entry.name,entry) for entry in scandir2(dirpath))
+        except OSError:
+            self.removedir(dirpath)
+            return
+        self.stats[dirpath]=[mtime,scantime]
+        old=set(sum(self.names[dirpath].values(),[]))
+        for name in old-set(entries):
+            self.removename(dirpath,name)
+            self.removedir(os.path.join(dirpath,name))
+        for name in set(entries)-old:
+            self.addname(dirpath,name)
+            if entries[name].is_dir() and not entries[name].is_symlink():
+                self.adddir(entries[name].path)
+
+    def run(self):
+        #Thread of the watcher: apply the changes as soon as they happen (or every POLL_INTERVAL seconds in poll mode)
+        import select
+        while True:
+            try:
+                if self.inotify is not None:
+                    select.select([self.inotify.fd],[],[])
+                else:
+                    time.sleep(POLL_INTERVAL)
+                with self.lock:
+                    self.update()
+            except Exception as e:
+                self.log("exception happened: "+str(e),"ERROR")
+                time.sleep(POLL_INTERVAL)
+
+    def getindex(self,dirpath):
+        '''
+        index = watcher.getindex(dirpath)
+
+        Return the index {lowercase filename: real filename} of the directory <dirpath> (see getdirindex),
+        or None if it is not watched. The pending changes are applied first, so it is always up to date.
+        '''
+        with self.lock:
+            if dirpath not in self.names:
+                return None
+            if self.inotify is not None:
+                self.update()
+            else:
+                self.refresh(dirpath)
+            return self.indexes.get(dirpath)
+
+    def listdir(self,dirpath):
+        #Return the list of filenames of the directory <dirpath> (like os.listdir), or None if it is not watched.
+        with self.lock:
+            if self.getindex(dirpath) is None:
+                return None
+            return sum(self.names[dirpath].values(),[])
@@ -66,6 +66,61 @@ BRWFUNCT_PATH='/home/danitegue/PCBREWER/Brw_functions.py'
 # This log file is helpful to check if the SHELL commands are working fine or not.
 export BREWFUNCT_LOG_DIR='/home/danitegue/Temp'
 
+# BREWFUNCT_LOG_MAXSIZE: (Optional) maximum size in bytes of the Brw_functions log file of the day. When it is reached,
+# the log file is renamed as Brw_functions_log_YYYYMMDD_N.txt and compressed. Empty means no size limit.
+# (The log files of the previous days are always compressed)
+export BREWFUNCT_LOG_MAXSIZE=
+
+# BREWFUNCT_SOCKET: Unix socket where the Brw_functions daemon is going to listen.
+# The daemon executes all the SHELL commands of the brewer software in the same python process, which is much faster
+# than starting a new python interpreter for every SHELL call (the PCBASIC SHELL calls are redirected through the
+# Brw_functions_client.py shim, that will execute the commands by itself if the daemon is not running).
+# Leave it empty to not use the daemon. Example: export BREWFUNCT_SOCKET='/tmp/Brw_functions_072.sock'
+export BREWFUNCT_SOCKET=
+
+# BREWFUNCT_CACHE_DIR: (Optional) folder where Brw_functions saves the index of the directories contents, used to find
+# files with different capitalization. It lets the separate SHELL calls re-use the index instead of scanning again
+# the directories. Leave it empty to keep the index only in memory.
+export BREWFUNCT_CACHE_DIR=
+
+# BREWFUNCT_METRICS_DIR: (Optional) folder where Brw_functions saves the metrics of every SHELL command (wall time, bytes
+# read and written, files touched, directory scans): Brw_functions_metrics.csv (one line per command) and
+# Brw_functions.prom (Prometheus textfile). To export them with the node_exporter textfile collector, point this
+# folder to its --collector.textfile.directory. Leave it empty to not save metrics.
+export BREWFUNCT_METRICS_DIR=
+
+# BREWFUNCT_TRACE_DIR: (Optional) folder where Brw_functions records every SHELL call (arguments, current directory,
+# environment variables, and size and checksum of the input files) into Brw_functions_trace_YYYYMMDD.jsonl, to replay
+# them later with Brw_replay.py. It reads completely the input files of every call, so enable it only to collect traces.
+# Leave it empty to not record them.
+export BREWFUNCT_TRACE_DIR=
+
+# BREWFUNCT_FSYNC: (Optional) how the files written by Brw_functions are synced to disk. They are always written into a
+# temporary file, which is renamed when it is complete, so a power cut never leaves a half-written file.
+# 'none': no sync (fastest, and less writes on SD cards), 'file': sync every written file (default),
+# 'file+dir': sync also the directory after the rename.
+export BREWFUNCT_FSYNC=
+
+# BREWFUNCT_ASYNC: (Optional, only with the Brw_functions daemon) SHELL commands that are executed in background, so
+# PCBASIC does not wait for them. DOS wildcard patterns of the command line, separated by ';'. Example: 'append *;copy *+* *'
+# A later command touching the same files waits for them, and while they are pending the hidden file .ASYNC.PND exists in the
+# program folder. A routine can wait for them with: SHELL "wait" (or SHELL "wait filename").
+# Leave it empty to execute all the commands synchronously.
+export BREWFUNCT_ASYNC=
+
+# BREWFUNCT_INSTRUMENT: (Optional, only with the Brw_functions daemon) identifier of the instrument in the daemon.
+# One daemon can serve several instruments at the same time (each one with its own PROGRAM_PATH, MOUNT_C, MOUNT_D,
+# log file and directories index): use the same BREWFUNCT_SOCKET and a different BREWFUNCT_INSTRUMENT in their launchers.
+# The commands of one instrument never wait for the commands of the others.
+export BREWFUNCT_INSTRUMENT=072
+
+# BREWFUNCT_WATCH: (Optional, only with the Brw_functions daemon) keep a live index of the files of the program and bdata
+# folders, updated with the inotify events of the folders ('inotify'), or checking them every few seconds ('poll').
+# The case insensitive file searches and the dir commands are answered from it, and the files created with the same
+# name as another one but different capitalization (like DIR.TMP and dir.tmp) are logged as soon as they appear.
+# Leave it empty to not use it.
+export BREWFUNCT_WATCH=
+
 
 # ---------NEEDED ENVIRONMENT VARIABLES FOR BREWER PROGRAM: BREWDIR AND NOBREW:----------
 
@@ -108,19 +163,33 @@ ISODATE=$(date '+%Y%m%dT%H%M%SZ')
 # Change the current path to the Brewer program directory to ensure correct operation (full path)
 cd ${PROGRAM_PATH}
 
-# Set the date in the OP_ST file before launching the software:
-${PYTHON_EXEC} ${BRWFUNCT_PATH} setdate
-
-# Check for duplicated files in the current path
-${PYTHON_EXEC} ${BRWFUNCT_PATH} look4duplicates
+# Set the date in the OP_ST file before launching the software, and
+# check for duplicated files in the PROGRAM_PATH and bdata trees (both in the same python process)
+printf 'setdate\nlook4duplicates /s\n' | ${PYTHON_EXEC} ${BRWFUNCT_PATH} --batch
+
+# Start the Brw_functions daemon (if configured), and redirect the SHELL calls through the client shim
+BRWFUNCT_SHELL=${BRWFUNCT_PATH}
+if [ -n "${BREWFUNCT_SOCKET}" ]; then
+    ${PYTHON_EXEC} ${BRWFUNCT_PATH} --daemon &
+    BRWFUNCT_SHELL=$(dirname ${BRWFUNCT_PATH})/Brw_functions_client.py
+    # Wait until the daemon answers (up to 10 seconds), so the first SHELL calls are already served by it
+    for i in $(seq 1 50); do
+        ${PYTHON_EXEC} ${BRWFUNCT_SHELL} --ping >/dev/null && break
+        sleep 0.2
+    done
+fi
 
 # * Run the Brewer software with PCBASIC
 echo "loading pcbasic"
-echo ${PYTHON_EXEC} -m pcbasic --interface=graphical --mount=Z:.,C:${MOUNT_C},D:${MOUNT_D} --current-device=Z --com1=${COM_PORT_1} --com2=${COM_PORT_2} --run=${PROGRAM} --quit=False -f=10 --shell="${PYTHON_EXEC} ${BRWFUNCT_PATH}" --debug=${DEBUG_MODE} --logfile=${PCBASIC_LOG_DIR}/pcbasic_brewer_log_${ID}_${ISODATE}.txt
+echo ${PYTHON_EXEC} -m pcbasic --interface=graphical --mount=Z:.,C:${MOUNT_C},D:${MOUNT_D} --current-device=Z --com1=${COM_PORT_1} --com2=${COM_PORT_2} --run=${PROGRAM} --quit=False -f=10 --shell="${PYTHON_EXEC} ${BRWFUNCT_SHELL}" --debug=${DEBUG_MODE} --logfile=${PCBASIC_LOG_DIR}/pcbasic_brewer_log_${ID}_${ISODATE}.txt
 
-${PYTHON_EXEC} -m pcbasic --interface=graphical --mount=Z:.,C:${MOUNT_C},D:${MOUNT_D} --current-device=Z --com1=${COM_PORT_1} --com2=${COM_PORT_2} --run=${PROGRAM} --quit=False -f=10 --shell="${PYTHON_EXEC} ${BRWFUNCT_PATH}" --debug=${DEBUG_MODE} --logfile=${PCBASIC_LOG_DIR}/pcbasic_brewer_log_${ID}_${ISODATE}.txt
+${PYTHON_EXEC} -m pcbasic --interface=graphical --mount=Z:.,C:${MOUNT_C},D:${MOUNT_D} --current-device=Z --com1=${COM_PORT_1} --com2=${COM_PORT_2} --run=${PROGRAM} --quit=False -f=10 --shell="${PYTHON_EXEC} ${BRWFUNCT_SHELL}" --debug=${DEBUG_MODE} --logfile=${PCBASIC_LOG_DIR}/pcbasic_brewer_log_${ID}_${ISODATE}.txt
 
 echo "loaded pcbasic"
+# * Stop the Brw_functions daemon
+if [ -n "${BREWFUNCT_SOCKET}" ]; then
+    ${PYTHON_EXEC} ${BRWFUNCT_SHELL} --shutdown
+fi
 # * On exit, undo the changes what were done above
 # restore the current dir
 cd ${CURR_DIR}
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+#Startup budget of the commands of Brw_functions.py (see Brw_benchmark.check_startup): every registered command
+#(Brw_functions.COMMANDS) is run in a synthetic Brewer tree with 'python -X importtime' (python >= 3.7).
+#Run them with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+PACKAGE_PATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,PACKAGE_PATH)
+import Brw_functions
+import Brw_benchmark
+
+
+@unittest.skipUnless(sys.version_info>=(3,7),"python -X importtime needs python >= 3.7")
+class TestStartup(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root=tempfile.mkdtemp(prefix='Brw_benchmark_')
+        cls.env=Brw_benchmark.build_tree(cls.root,nfiles=20,size=1000)
+        cls.commands=dict((args[0],(args,prepare)) for name,args,prepare,check in reversed(Brw_benchmark.get_commands(cls.env)))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root,ignore_errors=True)
+
+    def check_command(self,command):
+        self.assertIn(command,self.commands,"no benchmark command for "+command)
+        args,prepare=self.commands[command]
+        prepare()
+        result=Brw_benchmark.check_startup(args,self.env,Brw_benchmark.STARTUP_BUDGET/1000.)
+        self.assertTrue(result['ok'],command+": "+('%.2f' % (1000*result['import_time']))+" ms, imports "+', '.join(sorted(result['modules'])))
+
+def make_test(command):
+    return lambda self: self.check_command(command)
+
+for command in Brw_functions.COMMANDS:
+    setattr(TestStartup,'test_'+command,make_test(command))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#Tests of the dir command of Brw_functions.py (see Brw_dir.py).
+#Every command is run as the PCBASIC SHELL calls do: python Brw_functions.py dir ... >dir.tmp
+#Run them with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+BRWFUNCT_PATH=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Brw_functions.py')
+
+
+class TestShellDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir=tempfile.mkdtemp()
+        self.program_path=os.path.join(self.tmpdir,'brw#072')
+        os.makedirs(os.path.join(self.program_path,'bdata'))
+        for name in ['a.rtn','B.RTN','c.txt','noext']:
+            with open(os.path.join(self.program_path,name),'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def shell(self,*arguments):
+        #Run a SHELL call, and return its exit status
+        env=dict(os.environ)
+        env.update({'PROGRAM_PATH':self.program_path,'MOUNT_C':self.tmpdir})
+        for k in ['BREWFUNCT_LOG_DIR','BREWFUNCT_CACHE_DIR','BREWFUNCT_SOCKET','BREWFUNCT_WATCH']:
+            env.pop(k,None)
+        with open(os.devnull,'w') as devnull:
+            return subprocess.call([sys.executable,BRWFUNCT_PATH]+list(arguments),cwd=self.program_path,env=env,
+                                   stdout=devnull,stderr=devnull)
+
+    def readoutput(self):
+        with open(os.path.join(self.program_path,'dir.tmp'),'r') as f:
+            return [os.path.basename(l.rstrip('\n').rstrip('/')) for l in f]
+
+    def test_missing_directory(self):
+        #The output file is rewritten empty, so the Brewer software does not read a stale listing
+        with open(os.path.join(self.program_path,'dir.tmp'),'w') as f:
+            f.write('stale listing\n')
+        self.assertEqual(self.shell('dir','C:\\nodir\\*.rtn','/l','/o:n','/b','>dir.tmp'),0)
+        self.assertEqual(self.readoutput(),[])
+
+    def test_wildcard_case_insensitive(self):
+        self.assertEqual(self.shell('dir','*.rtn','/l','/o:n','/b','>dir.tmp'),0)
+        self.assertEqual(self.readoutput(),['a.rtn','b.rtn'])
+
+    def test_wildcard_needs_dot(self):
+        #As with glob, '*.*' does not match the filenames without extension
+        self.assertEqual(self.shell('dir','*.*','/o:n','/b','>dir.tmp'),0)
+        self.assertNotIn('noext',self.readoutput())
+        self.assertIn('c.txt',self.readoutput())
+
+    def test_directory_itself(self):
+        #As with glob, a directory path lists the directory itself, not its contents
+        self.assertEqual(self.shell('dir','C:\\brw#072\\bdata\\','/b','>dir.tmp'),0)
+        self.assertEqual(self.readoutput(),['bdata'])
+
+
+if __name__ == '__main__':
+    unittest.main()
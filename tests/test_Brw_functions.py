@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+#Tests of the shell commands of Brw_functions.py, run both as the PCBASIC SHELL calls do (a new python process), and as
+#the Brw_functions daemon does (execute_request, with the environment and current directory of the request).
+#Run them with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+PACKAGE_PATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BRWFUNCT_PATH=os.path.join(PACKAGE_PATH,'Brw_functions.py')
+sys.path.insert(0,PACKAGE_PATH)
+import Brw_functions
+
+
+class TestShellCopy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir=tempfile.mkdtemp()
+        self.program_path=os.path.join(self.tmpdir,'brw#072')
+        os.makedirs(self.program_path)
+        with open(os.path.join(self.program_path,'a.txt'),'w') as f:
+            f.write('a')
+        self.env={'PROGRAM_PATH':self.program_path,'MOUNT_C':self.tmpdir}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def shell(self,*arguments):
+        #SHELL call in a new python process
+        env=dict((k,v) for k,v in os.environ.items() if not k.startswith('BREWFUNCT_'))
+        env.update(self.env)
+        with open(os.devnull,'w') as devnull:
+            return subprocess.call([sys.executable,BRWFUNCT_PATH]+list(arguments),cwd=self.program_path,env=env,
+                                   stdout=devnull,stderr=devnull)
+
+    def daemon(self,*arguments):
+        #SHELL call executed by the daemon
+        status,output=Brw_functions.execute_request({'cwd':self.program_path,'env':self.env,'args':list(arguments)})
+        return status
+
+    def check_missing_destdir(self,shell):
+        #copy into a directory that does not exist: nothing is created
+        for orig in ['a.txt','*.txt']:
+            shell('copy',orig,'C:\\missing\\')
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir,'missing')),orig)
+
+    def test_missing_destdir(self):
+        self.check_missing_destdir(self.shell)
+
+    def test_missing_destdir_daemon(self):
+        self.check_missing_destdir(self.daemon)
+
+    def test_existing_destdir(self):
+        os.makedirs(os.path.join(self.tmpdir,'backup'))
+        for shell in [self.shell,self.daemon]:
+            shell('copy','a.txt','C:\\backup\\')
+            self.assertTrue(os.path.isfile(os.path.join(self.tmpdir,'backup','a.txt')))
+            os.remove(os.path.join(self.tmpdir,'backup','a.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+#Tests of the command dispatcher of Brw_simulator.py: the answers to the commands of the golden transcript
+#(Brw_simulator_transcript.jsonl, see check_transcript) must not change.
+#Run them with: python -m unittest discover tests
+
+import os
+import sys
+import logging
+import unittest
+
+PACKAGE_PATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,PACKAGE_PATH)
+import Brw_simulator
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        #The simulator takes its options from the command line arguments
+        argv=sys.argv
+        sys.argv=['Brw_simulator.py','--transcript='+Brw_simulator.TRANSCRIPT]
+        try:
+            self.simulator=Brw_simulator.Brewer_simulator()
+        finally:
+            sys.argv=argv
+        self.simulator.logger.disabled=False #With --transcript the (root) logger is disabled
+        self.simulator.logger.setLevel(logging.CRITICAL)
+
+    def test_transcript(self):
+        with open(os.devnull,'w') as devnull:
+            stdout=sys.stdout
+            sys.stdout=devnull
+            try:
+                ndiff=self.simulator.check_transcript()
+            finally:
+                sys.stdout=stdout
+        self.assertEqual(ndiff,0)
+
+    def test_malformed_arguments(self):
+        #A command with arguments of a wrong type is an unknown command
+        for line in ['B,x\r','M,1,x\r','?MOTOR.CLASS[x]\r']:
+            gotkey,answer=self.simulator.check_line(line)
+            self.assertFalse(gotkey,line)
+
+
+if __name__ == '__main__':
+    unittest.main()